@@ -0,0 +1,138 @@
+""" Ramp to thousands of concurrent connections, then overload the join path.
+
+    Reports per-step accept latency (connect to join accept, including retries after rate-limit
+    rejects), reject reasons, server memory per connection, and the chat round-trip seen by a few
+    long-lived probe sessions, which should stay healthy throughout.
+
+    python bench/admission_soak.py --target 4000 --step 500 --join-rate 500
+"""
+from common import Message, spawn_server, percentile, read_message, rss
+from collections import Counter
+import argparse
+import asyncio
+import time
+
+async def connect(port: int, name: str, reasons: Counter, retries: int):
+    """ Join as `name`, backing off and retrying on rate-limit rejects. Returns (writer, latency) or None. """
+    started = time.perf_counter()
+    delay = 0.05
+    for _ in range(retries + 1):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(Message(join_request=True, username=name, history_limit=0).serialize())
+        message = await read_message(reader)
+        if message is not None and message.is_join_accept:
+            writer.write(Message(username=name, room_leave=True, room='lobby').serialize())
+            return writer, time.perf_counter() - started
+        writer.close()
+        reasons[message.reason if message is not None else 'closed'] += 1
+        if message is None or message.reason != 'rate_limited':
+            return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    return None
+
+class Probe:
+    """ A long-lived session that keeps chatting in its own room and records the round trip. """
+
+    def __init__(self, port: int, name: str):
+        self.port = port
+        self.name = name
+        self.latencies = []
+
+    async def run(self, interval: float):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(Message(join_request=True, username=self.name).serialize())
+        writer.write(Message(username=self.name, room_join=True, room=f'probe-{self.name}').serialize())
+        writer.write(Message(username=self.name, room_leave=True, room='lobby').serialize())
+        asyncio.create_task(self.receive(reader))
+        while True:
+            writer.write(Message(username=self.name, room=f'probe-{self.name}', content=f't={time.perf_counter()}').serialize())
+            await asyncio.sleep(interval)
+
+    async def receive(self, reader: asyncio.StreamReader):
+        while (message := await read_message(reader)) is not None:
+            if message.content and message.content.startswith('t='):
+                self.latencies.append(time.perf_counter() - float(message.content[2:]))
+
+    def take(self):
+        latencies, self.latencies = self.latencies, []
+        return latencies
+
+async def wave(port: int, names, concurrency: int, reasons: Counter, retries: int):
+    limit = asyncio.Semaphore(concurrency)
+    async def one(name):
+        async with limit:
+            return await connect(port, name, reasons, retries)
+    results = await asyncio.gather(*(one(name) for name in names), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            reasons[type(result).__name__] += 1
+    return [result for result in results if isinstance(result, tuple)]
+
+def report(label: str, accepted, attempted: int, reasons: Counter, probes, open_count: int, memory: int, base: int):
+    latencies = [latency for _, latency in accepted]
+    probe = [latency for p in probes for latency in p.take()]
+    print(f'{label:>10} {open_count:>7,} {len(accepted):>6,}/{attempted:<6,} '
+          f'{percentile(latencies, 50) * 1e3:>8.1f} {percentile(latencies, 99) * 1e3:>8.1f} '
+          f'{percentile(probe, 50) * 1e3:>8.1f} {percentile(probe, 99) * 1e3:>8.1f} '
+          f'{memory / 2 ** 20:>7.0f} {(memory - base) / max(1, open_count) / 1024:>7.1f}  '
+          f'{dict(reasons) or ""}')
+
+async def main(args):
+    process = await spawn_server(
+        args.port, capacity=args.target + args.probes + args.burst // 2,
+        max_connections=args.target + args.probes + args.burst // 2 + 64,
+        max_connections_per_ip=args.target * 2, join_rate=args.join_rate, join_burst=int(args.join_rate) // 4,
+        join_history=0, queue_size=256
+    )
+    try:
+        base = rss(process.pid)
+        probes = [Probe(args.port, f'probe{i}') for i in range(args.probes)]
+        probe_tasks = [asyncio.create_task(p.run(args.probe_interval)) for p in probes]
+        await asyncio.sleep(0.5)
+        writers = []
+        print(f'{"step":>10} {"open":>7} {"accepted":>13} {"acc p50":>8} {"acc p99":>8} '
+              f'{"rtt p50":>8} {"rtt p99":>8} {"rss MB":>7} {"KB/conn":>7}  rejects')
+        step = 0
+        while len(writers) < args.target:
+            reasons = Counter()
+            names = [f'user{len(writers) + i}' for i in range(min(args.step, args.target - len(writers)))]
+            accepted = await wave(args.port, names, args.concurrency, reasons, args.retries)
+            writers += [writer for writer, _ in accepted]
+            step += 1
+            await asyncio.sleep(0.2)
+            report(f'ramp {step}', accepted, len(names), reasons, probes, len(writers) + len(probes), rss(process.pid), base)
+            if not accepted:
+                break
+
+        # Overload: a burst of joins far beyond the rate limit and the free connection slots, without retries.
+        reasons = Counter()
+        names = [f'burst{i}' for i in range(args.burst)]
+        accepted = await wave(args.port, names, args.burst, reasons, 0)
+        await asyncio.sleep(0.2)
+        report('overload', accepted, len(names), reasons, probes, len(writers) + len(probes) + len(accepted),
+               rss(process.pid), base)
+
+        await asyncio.sleep(args.hold)
+        report('hold', [], 0, Counter(), probes, len(writers) + len(probes) + len(accepted), rss(process.pid), base)
+        for task in probe_tasks:
+            task.cancel()
+        for writer in writers + [writer for writer, _ in accepted]:
+            writer.close()
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18030)
+    parser.add_argument('--target', type=int, default=4000, help='connections to ramp up to')
+    parser.add_argument('--step', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50, help='joins in flight during the ramp')
+    parser.add_argument('--join-rate', type=float, default=500)
+    parser.add_argument('--retries', type=int, default=8)
+    parser.add_argument('--burst', type=int, default=1000, help='simultaneous joins in the overload phase')
+    parser.add_argument('--probes', type=int, default=10)
+    parser.add_argument('--probe-interval', type=float, default=0.1)
+    parser.add_argument('--hold', type=float, default=2.0, help='seconds to hold every connection open at the end')
+    asyncio.run(main(parser.parse_args()))
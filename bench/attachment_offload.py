@@ -0,0 +1,105 @@
+""" Event loop lag while users upload attachments, with the heavy work on the loop or in a worker pool.
+
+    Uploaders in a room of their own each send `--rate` base64 attachments a second, and every one
+    is relayed to them all, compressed for those that negotiated compression. Meanwhile a probe in
+    the default room sends short chat messages and times their echo. The loop lag percentiles are
+    the server's own loop_lag_seconds histogram: how late it ran its timers while the uploads went
+    on. Server CPU is the main process's only; a process pool's workers are not counted.
+
+    python bench/attachment_offload.py --uploaders 8 --rate 20 --seconds 5 --attachment-size 32768
+"""
+from common import Message, spawn_server, join, percentile, cpu_seconds, read_message
+from pool import PoolKind
+import argparse
+import asyncio
+import base64
+import os
+import time
+
+MODES = {
+    'loop':    dict(offload_bytes=None),
+    'thread':  dict(pool=PoolKind.THREAD),
+    'process': dict(pool=PoolKind.PROCESS)
+}
+
+async def upload(port: int, name: str, content: str, rate: float, deadline: float) -> int:
+    """ Send attachments until `deadline`, draining what the server relays back. Returns how many were sent. """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 27)
+    writer.write(Message(join_request=True, username=name, compression='zlib').serialize())
+    writer.write(Message(username=name, room_join=True, room='uploads').serialize())
+    drain = asyncio.create_task(reader.read(-1))
+    sent = 0
+    started = time.perf_counter()
+    while (now := time.perf_counter()) < deadline:
+        writer.write(Message(username=name, room='uploads', filename=f'{name}-{sent}.bin', content=content).serialize())
+        await writer.drain()
+        sent += 1
+        await asyncio.sleep(max(0.0, started + sent / rate - now))
+    writer.close()
+    drain.cancel()
+    return sent
+
+async def probe(port: int, deadline: float, interval: float) -> list:
+    """ Chat round trips in seconds: from sending a message to reading it back. """
+    reader, writer = await join(port, 'probe', limit=2 ** 27)
+    rtts = []
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        token = f'probe {len(rtts)}'
+        writer.write(Message(username='probe', content=token).serialize())
+        while (message := await read_message(reader)) is not None and message.content != token:
+            pass
+        rtts.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    writer.close()
+    return rtts
+
+async def server_stats(port: int) -> dict:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 27)
+    writer.write(Message(status_request=True).serialize())
+    while (message := await read_message(reader)) is not None and not message.is_status_response:
+        pass
+    writer.close()
+    return message.stats
+
+async def measure(port: int, mode: str, args) -> dict:
+    process = await spawn_server(
+        port, ping_interval=None, join_history=0, loop_lag_interval=0.01, pool_workers=args.workers,
+        stream_limit=2 ** 20, **MODES[mode]
+    )
+    try:
+        content = base64.b64encode(os.urandom(args.attachment_size // 2) + bytes(args.attachment_size // 2)).decode()
+        cpu = cpu_seconds(process.pid)
+        deadline = time.perf_counter() + args.seconds
+        rtts, *sent = await asyncio.gather(
+            probe(port, deadline, args.probe_interval),
+            *(upload(port, f'uploader{i}', content, args.rate, deadline) for i in range(args.uploaders))
+        )
+        cpu = cpu_seconds(process.pid) - cpu
+        stats = await server_stats(port)
+        return {'sent': sum(sent), 'rtts': rtts, 'lag': stats['loop_lag_seconds'], 'offloaded': stats['offloaded'], 'cpu': cpu}
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{"mode":>8} {"uploads":>8} {"offloaded":>10} {"lag p50":>9} {"lag p95":>9} {"lag p99":>9} '
+          f'{"rtt p50":>9} {"rtt p99":>9} {"server cpu":>11}')
+    for i, mode in enumerate(args.modes):
+        result = await measure(args.port + i, mode, args)
+        lag, rtts = result['lag'], result['rtts']
+        print(f'{mode:>8} {result["sent"]:>8,} {result["offloaded"]:>10,} '
+              f'{lag["p50"] * 1e3:>7.2f}ms {lag["p95"] * 1e3:>7.2f}ms {lag["p99"] * 1e3:>7.2f}ms '
+              f'{percentile(rtts, 50) * 1e3:>7.2f}ms {percentile(rtts, 99) * 1e3:>7.2f}ms {result["cpu"] * 1e3:>9.0f}ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18400)
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--uploaders', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=20.0, help='attachments each uploader sends a second')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--attachment-size', type=int, default=32 * 1024, help='bytes before base64; half random, half zeros')
+    parser.add_argument('--workers', type=int, default=2, help='pool workers')
+    parser.add_argument('--probe-interval', type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
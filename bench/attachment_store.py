@@ -0,0 +1,113 @@
+""" Attachments relayed inline versus kept in the blob store and referenced, on an attachment-heavy room.
+
+    An uploader sends `--attachments` files, a `--duplicates` share of them repeats of earlier
+    ones, to listeners that stay joined throughout. With the store, a `--fetch` share of the
+    listeners download each file they have not cached yet, as the interactive client does; the
+    rest only see the reference. A late joiner then asks for the room's history. Reports the bytes
+    the listeners read, the bytes the late joiner's history took, what the store kept on disk, and
+    the server's peak memory.
+
+    python bench/attachment_store.py --listeners 50 --attachments 100 --duplicates 0.5 --fetch 0.2
+"""
+from common import Message, spawn_server, join, rss, read_message
+import argparse
+import asyncio
+import base64
+import os
+import random
+import shutil
+import tempfile
+import time
+
+class Listener:
+
+    def __init__(self, fetches: bool):
+        self.fetches = fetches
+        self.cached = set()
+        self.read = 0
+
+    async def run(self, port: int, name: str, expected: int, done: asyncio.Event):
+        reader, writer = await join(port, name, limit=2 ** 27)
+        seen = fetching = 0
+        while (message := await read_message(reader)) is not None:
+            self.read += len(message.serialize())
+            if message.filename is not None and message.username != name:
+                seen += 1
+                if self.fetches and message.digest is not None and message.digest not in self.cached:
+                    self.cached.add(message.digest)
+                    fetching += 1
+                    writer.write(Message(username=name, blob_request=True, digest=message.digest).serialize())
+            fetching -= message.is_blob_response
+            if seen == expected and not fetching:
+                break
+        done.set()
+        writer.close()
+
+async def measure(port: int, store: bool, args) -> dict:
+    directory = tempfile.mkdtemp()
+    process = await spawn_server(
+        port, ping_interval=None, capacity=args.listeners + 10, max_connections=args.listeners + 10,
+        stream_limit=2 ** 20, blob_directory=os.path.join(directory, 'blobs') if store else None
+    )
+    try:
+        rng = random.Random(args.seed)
+        files = []
+        for i in range(args.attachments):
+            if files and rng.random() < args.duplicates:
+                files.append(rng.choice(files))
+            else:
+                files.append(os.urandom(args.attachment_size))
+        listeners = [Listener(store and i < args.listeners * args.fetch) for i in range(args.listeners)]
+        events = [asyncio.Event() for _ in listeners]
+        tasks = [asyncio.create_task(listener.run(port, f'listener{i}', args.attachments, event))
+                 for i, (listener, event) in enumerate(zip(listeners, events))]
+        await asyncio.sleep(0.5)
+        _, uploader = await join(port, 'uploader')
+        started = time.perf_counter()
+        for i, data in enumerate(files):
+            uploader.write(Message(username='uploader', filename=f'file{i}.bin', content=base64.b64encode(data).decode()).serialize())
+            await uploader.drain()
+            await asyncio.sleep(args.interval)
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events)), 120)
+        elapsed = time.perf_counter() - started
+        # The late joiner replays the room's history after its join.
+        reader, writer = await join(port, 'late', limit=2 ** 27)
+        writer.write(Message(username='late', history_request=True, history_limit=args.attachments).serialize())
+        history = 0
+        while (message := await read_message(reader)) is not None and not message.is_history_end:
+            history += len(message.serialize())
+        writer.close()
+        for task in tasks:
+            task.cancel()
+        stored = sum(entry.stat().st_size for shard in os.scandir(os.path.join(directory, 'blobs')) if shard.is_dir()
+                     for entry in os.scandir(shard.path)) if store else 0
+        return {
+            'read': sum(listener.read for listener in listeners),
+            'history': history,
+            'stored': stored,
+            'peak': rss(process.pid, 'VmHWM'),
+            'elapsed': elapsed
+        }
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+async def main(args):
+    print(f'{"mode":>7} {"listener bytes":>15} {"history bytes":>14} {"stored bytes":>13} {"server peak":>12} {"elapsed":>9}')
+    for i, store in enumerate((False, True)):
+        result = await measure(args.port + i, store, args)
+        print(f'{"store" if store else "inline":>7} {result["read"]:>15,} {result["history"]:>14,} {result["stored"]:>13,} '
+              f'{result["peak"] / 2 ** 20:>10.1f}MB {result["elapsed"]:>8.2f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18500)
+    parser.add_argument('--listeners', type=int, default=50)
+    parser.add_argument('--attachments', type=int, default=100)
+    parser.add_argument('--attachment-size', type=int, default=32 * 1024)
+    parser.add_argument('--duplicates', type=float, default=0.5, help='share of uploads repeating an earlier file')
+    parser.add_argument('--fetch', type=float, default=0.2, help='share of listeners that download every new file')
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between uploads')
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
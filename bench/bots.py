@@ -0,0 +1,95 @@
+""" Hundreds of SDK bots in one process: join time, delivery latency, and what each bot costs the process.
+
+    `--bots` ChatClients join a server in another process, `--room-size` to a room, and each says
+    `--rate` messages a second for `--seconds`, queueing them without waiting for the socket. Every
+    bot counts what its room delivers to it and times each delivery from its send, all on this
+    process's clock. CPU and memory are this process's, so they are the bots' own costs.
+
+    python bench/bots.py --bots 100 300 500 --room-size 10 --rate 2 --seconds 5
+"""
+from common import spawn_server, percentile, cpu_seconds, rss
+from sdk import ChatClient
+from server_address import ServerAddress
+import argparse
+import asyncio
+import gc
+import os
+import random
+import time
+
+class Bot:
+
+    def __init__(self, client: ChatClient, room: str):
+        self.client = client
+        self.room = room
+        self.sent = 0
+        self.latencies = []
+        client.on('chat', self.received)
+
+    def received(self, message):
+        if message.room == self.room and isinstance(message.content, str):
+            self.latencies.append(time.perf_counter() - float(message.content.split()[1]))
+
+    async def chat(self, rate: float, deadline: float):
+        await asyncio.sleep(random.uniform(0, 1 / rate))
+        started = time.perf_counter()
+        while (now := time.perf_counter()) < deadline:
+            await self.client.say(f'{self.client.username} {now!r}', self.room)
+            self.sent += 1
+            await asyncio.sleep(max(0.0, started + self.sent / rate - time.perf_counter()))
+
+async def measure(port: int, count: int, args) -> dict:
+    process = await spawn_server(
+        port, ping_interval=None, join_history=0, capacity=count + 10, max_connections=count + 10,
+        max_connections_per_ip=count + 10, join_rate=10_000.0, join_burst=count + 10
+    )
+    try:
+        gc.collect()
+        memory = rss(os.getpid())
+        cpu = cpu_seconds(os.getpid())
+        started = time.perf_counter()
+        clients = [ChatClient(ServerAddress('127.0.0.1', port)) for _ in range(count)]
+        await asyncio.gather(*(client.join(f'bot{i}') for i, client in enumerate(clients)))
+        bots = [Bot(client, f'room{i // args.room_size}') for i, client in enumerate(clients)]
+        await asyncio.gather(*(bot.client.join_room(bot.room) for bot in bots))
+        await asyncio.sleep(0.5)
+        joined = time.perf_counter() - started
+        deadline = time.perf_counter() + args.seconds
+        await asyncio.gather(*(bot.chat(args.rate, deadline) for bot in bots))
+        await asyncio.gather(*(bot.client.drain() for bot in bots))
+        await asyncio.sleep(1.0)
+        cpu = cpu_seconds(os.getpid()) - cpu
+        memory = rss(os.getpid()) - memory
+        await asyncio.gather(*(bot.client.close() for bot in bots))
+        latencies = [latency for bot in bots for latency in bot.latencies]
+        sent = sum(bot.sent for bot in bots)
+        expected = sum(bot.sent * min(args.room_size, count - i // args.room_size * args.room_size)
+                       for i, bot in enumerate(bots))
+        return {
+            'joined': joined, 'sent': sent, 'delivered': len(latencies), 'expected': expected,
+            'latencies': latencies, 'cpu': cpu, 'memory': memory
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{"bots":>6} {"join all":>9} {"sent":>7} {"delivered":>10} {"p50":>9} {"p99":>9} '
+          f'{"client cpu":>11} {"cpu/msg":>8} {"KiB/bot":>8}')
+    for i, count in enumerate(args.bots):
+        result = await measure(args.port + i, count, args)
+        latencies = result['latencies']
+        print(f'{count:>6} {result["joined"]:>8.2f}s {result["sent"]:>7,} '
+              f'{result["delivered"]:>5,}/{result["expected"]:<,} '
+              f'{percentile(latencies, 50) * 1e3:>7.2f}ms {percentile(latencies, 99) * 1e3:>7.2f}ms '
+              f'{result["cpu"]:>10.2f}s {result["cpu"] / max(1, result["delivered"]) * 1e6:>6.0f}µs '
+              f'{result["memory"] / count / 1024:>8.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18600)
+    parser.add_argument('--bots', type=int, nargs='+', default=[100, 300, 500])
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=2.0, help='messages each bot says a second')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
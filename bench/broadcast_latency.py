@@ -0,0 +1,93 @@
+""" Broadcast delivery latency with one slow reader and N fast readers.
+
+    python bench/broadcast_latency.py --fast 16 --messages 2000 --policy drop_oldest
+"""
+from common import start_server, stop_server, join, percentile
+from connection import SlowConsumerPolicy
+from server_config import ServerConfig
+from message import Message
+import argparse
+import asyncio
+import socket
+import time
+
+async def fast_reader(reader: asyncio.StreamReader, expected: int, latencies: list):
+    received = 0
+    while received < expected:
+        line = await reader.readline()
+        if not line:
+            return
+        message = Message.deserialize(line)
+        if message.username != 'sender':
+            continue
+        sent_at = float(message.content.split(' ', 1)[0])
+        latencies.append(time.perf_counter() - sent_at)
+        received += 1
+
+async def publish(sender: asyncio.StreamWriter, args, started: float):
+    padding = 'x' * args.size
+    interval = 1 / args.rate if args.rate else 0
+    for i in range(args.messages):
+        sender.write(Message(username='sender', content=f'{time.perf_counter()} {padding}').serialize())
+        await sender.drain()
+        if interval:
+            await asyncio.sleep(max(0, started + (i + 1) * interval - time.perf_counter()))
+
+async def main(args):
+    server = await start_server(args.port, config=ServerConfig(
+        capacity=args.fast + 2,
+        queue_size=args.queue_size,
+        slow_consumer_policy=SlowConsumerPolicy(args.policy)
+    ))
+    slow = await _slow_join(args.port)
+    readers = [await join(args.port, f'fast{i}') for i in range(args.fast)]
+    sender_reader, sender = await join(args.port, 'sender')
+    discard = asyncio.create_task(_discard(sender_reader))
+    latencies: list = []
+    tasks = [asyncio.create_task(fast_reader(r, args.messages, latencies)) for r, _ in readers]
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(publish(sender, args, started), *tasks), timeout=args.timeout
+        )
+        status = 'complete'
+    except asyncio.TimeoutError:
+        status = f'timed out after {args.timeout}s'
+    elapsed = time.perf_counter() - started
+    print(f'policy={args.policy} fast={args.fast} messages={args.messages} size={args.size} rate={args.rate}')
+    print(f'delivered={len(latencies)}/{args.messages * args.fast} elapsed={elapsed:.3f}s ({status})')
+    print(f'p50={percentile(latencies, 50) * 1e3:.3f}ms p99={percentile(latencies, 99) * 1e3:.3f}ms')
+    slow_conn = server.users.get('slow')
+    if slow_conn is not None:
+        print(f'slow client: queued={slow_conn.queue.qsize()} dropped={slow_conn.dropped}')
+    else:
+        print('slow client: disconnected')
+    discard.cancel()
+    slow.close()
+    await stop_server(server)
+
+async def _discard(reader: asyncio.StreamReader):
+    while await reader.read(65536):
+        pass
+
+async def _slow_join(port: int) -> socket.socket:
+    """ Join with a tiny receive buffer and never read, so the server's writes back up. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    await loop.sock_connect(sock, ('127.0.0.1', port))
+    await loop.sock_sendall(sock, Message(join_request=True, username='slow').serialize())
+    return sock
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18001)
+    parser.add_argument('--fast', type=int, default=16)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--rate', type=float, default=1000, help='messages/sec sent, 0 for unpaced')
+    parser.add_argument('--queue-size', type=int, default=256)
+    parser.add_argument('--policy', choices=[p.value for p in SlowConsumerPolicy], default='drop_oldest')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,323 @@
+""" Replay a traffic capture against a fresh server: throughput, delivery latency and what was delivered.
+
+    A capture is written by a server run with `--capture FILE` (each worker's to a file of its own,
+    which are merged here by time). Every captured connection is opened again and its bytes written
+    back on the captured schedule, scaled by `--speed` (2 is twice as fast, 0 as fast as possible), so
+    the server reads what it read before, framing and compression negotiation included. Each replayed
+    connection decodes what it is sent. Chat and direct messages are timed from the write that carried
+    them to each delivery, and every delivery is tallied by connection, ignoring times and sequence
+    numbers, to compare with an earlier replay's `--output` by `--baseline`. A capture holds only what
+    clients sent, not what they were sent, so the reference is a replay too: the first replay of a
+    capture against the build it was taken on, which later builds should match. Written much faster
+    than captured, one client's message could overtake another's it used to follow, such as a quit
+    overtaking the chat its user used to receive first, so the replay waits for the server wherever
+    that would change who receives what (see `Replay.run`), and an unchanged build delivers the same
+    at any speed. Those waits count in the time the replay took.
+
+    python bench/capture_replay.py traffic.cap --speed 1 --output reference.json
+    python bench/capture_replay.py traffic.cap --speed 4 --baseline reference.json
+    python bench/capture_replay.py traffic.cap --speed 0
+"""
+from common import Message, spawn_server, percentile, cpu_seconds, rss
+from capture import read_capture
+from framing import Framing, encode, scan_frames
+from compressor import Inflater
+from protocol import ServerEngine
+from sdk import kind
+from typing import Awaitable, Counter, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import collections
+import heapq
+import json
+import time
+
+READ_SIZE = 2 ** 16
+STREAM_LIMIT = 2 ** 27
+WRITE_BUFFER_HIGH = 2 ** 20     # Bytes waiting to be sent on one connection before the replay waits for them.
+ANSWER_TIMEOUT = 10.0           # Seconds to wait for the server to answer before writing on regardless.
+TIMED = ('chat', 'direct')
+
+def delivery(message: Message) -> Tuple:
+    """ What is compared of a delivery: who it is from and what it is, without the times, sequence
+        numbers and rendered history that differ from run to run. """
+    text = kind(message)
+    return (
+        text, message.username, message.room, tuple(message.recipients or ()),
+        content if text in TIMED and isinstance(content := message.content, str) else None,
+        message.filename, message.digest
+    )
+
+class Record:
+    __slots__ = ('time', 'data', 'keys', 'joins', 'moves', 'departs')
+
+    def __init__(self, time_ns: int, data: bytes):
+        self.time = time_ns
+        self.data = data
+        self.keys: List[Tuple[str, str]] = []      # The chat and direct messages this record completes.
+        self.joins = 0                              # The join requests it completes.
+        self.moves = False                          # Whether it completes a room join or leave.
+        self.departs = not data                     # Whether it completes a quit request, or ends the connection.
+
+class Replayed:
+    """ One captured connection: its records, and once replayed, what the server sent it. """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.records: List[Record] = []
+        self.ended = False
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        self.delivered: Counter[Tuple] = collections.Counter()
+        self.framing = Framing.JSON
+        self.joins = 0              # Join requests written so far, and answers to them read.
+        self.answers = 0
+        self.pings = 0              # Pings written so far, and the newest answered.
+        self.pong = 0
+        self.written = False        # Whether anything was written since the last ping.
+        self.answered = asyncio.Event()
+
+    def decode(self):
+        """ Note which records complete which chat and direct messages, to time them from when they are
+            written, and which change who receives what, to wait for the server to act on them. A join
+            request asking for binary framing switches it if the server agreed, which shows in the frame
+            after it: only JSON opens with `{`. """
+        buffer = bytearray()
+        framing = Framing.JSON
+        requested: Optional[str] = None
+        for record in self.records:
+            buffer += record.data
+            while True:
+                if requested is not None and buffer:
+                    framing = Framing.JSON if buffer[:1] == b'{' else Framing(requested)
+                    requested = None
+                messages, used = scan_frames(buffer, framing, STREAM_LIMIT)
+                if not messages or messages[-1] is None:
+                    break
+                del buffer[:used]
+                record.keys += [
+                    ((message.username or '').casefold(), message.content) for message in messages
+                    if kind(message) in TIMED and isinstance(message.content, str)
+                ]
+                record.joins += sum(message.is_join_request for message in messages)
+                record.moves |= any(message.is_room_join or message.is_room_leave for message in messages)
+                record.departs |= any(message.is_quit_request for message in messages)
+                if messages[-1].is_join_request and messages[-1].framing is not None:
+                    requested = messages[-1].framing
+
+    async def read(self, reader: asyncio.StreamReader, replay: 'Replay'):
+        inflater = Inflater()
+        framing = Framing.JSON
+        buffer = bytearray()
+        try:
+            while (data := await reader.read(READ_SIZE)):
+                buffer += inflater.feed(data)
+                while (scanned := scan_frames(buffer, framing, STREAM_LIMIT))[0]:
+                    messages, used = scanned
+                    del buffer[:used]
+                    for message in messages:
+                        if message is None:
+                            return
+                        if message.is_join_accept and message.framing is not None:
+                            framing = self.framing = Framing(message.framing)
+                        replay.received(self, message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.answered.set()     # Nothing more will be answered.
+
+    async def wait_answered(self):
+        """ Wait until every join request written has been accepted or rejected, or the connection has closed. """
+        while self.answers < self.joins and not self.task.done():
+            self.answered.clear()
+            await self.answered.wait()
+
+    async def barrier(self):
+        """ Wait until the server has handled everything written so far: it reads a connection in order
+            and answers a ping as it comes to it. """
+        self.written = False
+        if self.writer.is_closing():
+            return
+        self.pings += 1
+        self.writer.write(encode(Message(ping=self.pings), self.framing))
+        while self.pong < self.pings and not self.task.done():
+            self.answered.clear()
+            await self.answered.wait()
+
+class Replay:
+    """ The captured connections, the schedule of their records, and the tallies of a replay. """
+
+    def __init__(self, paths: List[str]):
+        self.connections: Dict[str, Replayed] = {}
+        streams = []
+        for i, path in enumerate(paths):
+            records = []
+            for connection_id, time_ns, data in read_capture(path):
+                name = f'{i}:{connection_id}'
+                if (connection := self.connections.get(name)) is None:
+                    connection = self.connections[name] = Replayed(name)
+                if data:
+                    connection.records.append(record := Record(time_ns, data))
+                else:
+                    connection.ended = True
+                    record = Record(time_ns, b'')
+                records.append((time_ns, name, record))
+            streams.append(records)
+        self.schedule = list(heapq.merge(*streams, key=lambda entry: entry[0]))
+        for connection in self.connections.values():
+            connection.decode()
+        self.sent_at: Dict[Tuple[str, str], float] = {}
+        self.latencies: List[float] = []
+        self.deliveries = 0
+        self.bytes = sum(len(record.data) for _, _, record in self.schedule)
+
+    @property
+    def duration(self) -> float:
+        return (self.schedule[-1][0] - self.schedule[0][0]) / 1e9 if self.schedule else 0.0
+
+    def received(self, connection: Replayed, message: Message):
+        if message.pong is not None:
+            if isinstance(message.pong, int):
+                connection.pong = max(connection.pong, message.pong)
+                connection.answered.set()
+            return
+        if message.ping is not None:
+            return
+        if message.is_join_accept or message.is_join_reject:
+            connection.answers += 1
+            connection.answered.set()
+        self.deliveries += 1
+        connection.delivered[delivery(message)] += 1
+        if kind(message) in TIMED and (started := self.sent_at.get(((message.username or '').casefold(), message.content))):
+            self.latencies.append(time.perf_counter() - started)
+
+    async def run(self, port: int, speed: float) -> float:
+        """ Write every record on its schedule, returning the seconds it took. The server reads each
+            connection on its own, so what is written to one can be handled before what was written to
+            another earlier. Where that changes who receives what, the replay waits for the server: after
+            a join request until it is answered, after a room join or leave until it is handled, and
+            before a quit or a connection's end until everything written before it is handled. """
+        started = time.perf_counter()
+        first = self.schedule[0][0] if self.schedule else 0
+        for time_ns, name, record in self.schedule:
+            if speed:
+                await asyncio.sleep(max(0.0, started + (time_ns - first) / 1e9 / speed - time.perf_counter()))
+            connection = self.connections[name]
+            if connection.writer is None:
+                reader, connection.writer = await asyncio.open_connection('127.0.0.1', port, limit=STREAM_LIMIT)
+                connection.task = asyncio.create_task(connection.read(reader, self))
+            if connection.writer.is_closing():
+                continue
+            if record.departs:
+                await self.wait(asyncio.gather(*(
+                    other.barrier() for other in self.connections.values() if other.written
+                )), f'connection {name}: what came before its departure')
+            if not record.data:
+                try:
+                    connection.writer.write_eof()
+                except OSError:
+                    pass
+                continue
+            now = time.perf_counter()
+            for key in record.keys:
+                self.sent_at[key] = now
+            connection.writer.write(record.data)
+            connection.written = True
+            if connection.writer.transport.get_write_buffer_size() > WRITE_BUFFER_HIGH:
+                await connection.writer.drain()
+            if record.joins:
+                connection.joins += record.joins
+                await self.wait(connection.wait_answered(), f'connection {name}: join request')
+            elif record.moves:
+                await self.wait(connection.barrier(), f'connection {name}: room change')
+        return time.perf_counter() - started
+
+    async def wait(self, awaitable: Awaitable, what: str):
+        try:
+            await asyncio.wait_for(awaitable, ANSWER_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f'{what} not handled in {ANSWER_TIMEOUT:g}s')
+
+    async def settle(self, timeout: float):
+        """ Wait up to `timeout` for the server to close the connections the capture ended, then close the rest. """
+        deadline = time.perf_counter() + timeout
+        replayed = [connection for connection in self.connections.values() if connection.task is not None]
+        tasks = [connection.task for connection in replayed]
+        if (ended := [connection.task for connection in replayed if connection.ended]):
+            await asyncio.wait(ended, timeout=timeout)
+        if len(ended) < len(tasks):
+            await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+        for connection in self.connections.values():
+            if connection.writer is not None:
+                connection.writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def compare(deliveries: Dict[str, Counter], baseline: Dict[str, Counter], show: int) -> int:
+    """ Print how the deliveries differ from the baseline's, connection by connection; returns how many do. """
+    differences = 0
+    examples = []
+    for name in sorted(set(deliveries) | set(baseline)):
+        this, before = deliveries.get(name, collections.Counter()), baseline.get(name, collections.Counter())
+        for item, count in ((before - this) + (this - before)).items():
+            differences += count
+            examples.append((name, 'missing' if before[item] > this[item] else 'extra', count, item))
+    print(f'deliveries differing from the baseline: {differences:,}')
+    for name, change, count, item in examples[:show]:
+        print(f'  connection {name}: {change} x{count} {list(item)}')
+    return differences
+
+def load(path: str) -> Dict[str, Counter]:
+    with open(path) as f:
+        results = json.load(f)
+    return {
+        name: collections.Counter({tuple(tuple(v) if isinstance(v, list) else v for v in item): count for item, count in items})
+        for name, items in results['deliveries'].items()
+    }
+
+async def main(args):
+    replay = Replay(args.captures)
+    records = len(replay.schedule)
+    print(f'{len(replay.connections):,} connections, {records:,} records, {replay.bytes / 2 ** 20:,.2f} MiB '
+          f'over {replay.duration:.1f}s captured; replaying at {f"{args.speed:g}x" if args.speed else "full speed"}')
+    count = len(replay.connections) + 10
+    process = await spawn_server(
+        args.port, engine=ServerEngine(args.engine), ping_interval=None, capacity=count, max_connections=count,
+        max_connections_per_ip=count, join_rate=10_000.0, join_burst=count
+    )
+    try:
+        cpu = cpu_seconds(process.pid)
+        elapsed = await replay.run(args.port, args.speed)
+        await replay.settle(args.settle)
+        cpu = cpu_seconds(process.pid) - cpu
+        memory = rss(process.pid, 'VmHWM')
+    finally:
+        process.terminate()
+        process.wait()
+    print(f'written in {elapsed:.2f}s: {records / max(elapsed, 1e-9):,.0f} records/s, '
+          f'{replay.bytes / max(elapsed, 1e-9) / 2 ** 20:,.2f} MiB/s; {replay.deliveries:,} deliveries')
+    latencies = replay.latencies
+    print(f'delivery latency over {len(latencies):,}: p50 {percentile(latencies, 50) * 1e3:.2f} ms '
+          f'p95 {percentile(latencies, 95) * 1e3:.2f} ms p99 {percentile(latencies, 99) * 1e3:.2f} ms')
+    print(f'server cpu {cpu:.2f}s ({cpu / max(1, replay.deliveries) * 1e6:.1f}µs/delivery), peak rss {memory / 2 ** 20:.0f} MiB')
+    deliveries = {name: connection.delivered for name, connection in replay.connections.items()}
+    differences = compare(deliveries, load(args.baseline), args.show) if args.baseline else 0
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'deliveries': {name: [[item, count] for item, count in sorted(tally.items(), key=repr)]
+                                      for name, tally in deliveries.items()}}, f)
+        print(f'Deliveries written to {args.output}')
+    return differences
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('captures', nargs='+', help='capture files, such as those of every worker of one run')
+    parser.add_argument('--speed', type=float, default=1.0, help='multiple of the captured pace; 0 replays as fast as possible')
+    parser.add_argument('--engine', default=ServerEngine.STREAMS.value, choices=[engine.value for engine in ServerEngine])
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to wait for deliveries after the last record')
+    parser.add_argument('--port', type=int, default=18800)
+    parser.add_argument('--output', help='write the deliveries as JSON to this file, to compare later replays with')
+    parser.add_argument('--baseline', help='deliveries written by an earlier replay to compare with')
+    parser.add_argument('--show', type=int, default=20, help='differences to print')
+    raise SystemExit(1 if asyncio.run(main(parser.parse_args())) else 0)
@@ -0,0 +1,83 @@
+""" Chat log write throughput, startup recovery time and replay throughput.
+
+    python bench/chatlog_replay.py --size-mb 1024 --directory /tmp/chatlog-bench
+    python bench/chatlog_replay.py --size-mb 10240 --keep      # the 10 GB case
+"""
+from common import Message
+from chatlog import ChatLog
+import argparse
+import os
+import random
+import shutil
+import time
+
+MB = 1024 * 1024
+
+def generate(directory: str, size: int, message_size: int) -> int:
+    log = ChatLog(directory, fsync_batch=4096)
+    sequence = log.last_sequence
+    frame = Message(username='bench', content='x' * message_size).serialize()
+    started = time.perf_counter()
+    written = 0
+    while sum(segment.size for segment in log.segments) < size:
+        for _ in range(1000):
+            sequence += 1
+            log.append(sequence, frame)
+        written += 1000
+    log.close()
+    elapsed = time.perf_counter() - started
+    print(f'write     {written:>12,} records {written / elapsed:>12,.0f} rec/s {written * len(frame) / elapsed / MB:>8.1f} MB/s')
+    return sequence
+
+def main(args):
+    size = args.size_mb * MB
+    existing = sum(os.path.getsize(os.path.join(args.directory, n)) for n in os.listdir(args.directory)) \
+        if os.path.isdir(args.directory) else 0
+    if existing < size:
+        generate(args.directory, size, args.message_size)
+
+    started = time.perf_counter()
+    log = ChatLog(args.directory)
+    recovery = time.perf_counter() - started
+    total = sum(segment.size for segment in log.segments)
+    print(f'recovery  {len(log.segments):>12,} segments {recovery * 1e3:>10.1f} ms for {total / MB:,.0f} MB '
+          f'(through sequence {log.last_sequence:,})')
+
+    started = time.perf_counter()
+    records = replayed = 0
+    for view in log.read(log.first_sequence):
+        records += 1
+        replayed += len(view)
+    elapsed = time.perf_counter() - started
+    print(f'replay    {records:>12,} records {records / elapsed:>12,.0f} rec/s {replayed / elapsed / MB:>8.1f} MB/s')
+
+    sample = min(records, 10000)
+    started = time.perf_counter()
+    for view in log.read(log.first_sequence, sample):
+        Message.deserialize(view)
+    decode = (time.perf_counter() - started) / sample
+    print(f'decode    {"(for contrast)":>12} {1 / decode:>12,.0f} rec/s if every record were parsed into a Message '
+          f'(~{decode * records:.1f}s for this log)')
+
+    latencies = []
+    for _ in range(args.ranges):
+        first = random.randint(log.first_sequence, max(log.first_sequence, log.last_sequence - 100))
+        started = time.perf_counter()
+        for _ in log.read(first, 100):
+            pass
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    print(f'range     {args.ranges:>12,} reads of 100 records, p50 {latencies[len(latencies) // 2] * 1e3:.3f} ms '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.3f} ms')
+    log.close()
+    if not args.keep:
+        shutil.rmtree(args.directory)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--directory', default='/tmp/chatlog-bench')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--message-size', type=int, default=200)
+    parser.add_argument('--ranges', type=int, default=1000)
+    parser.add_argument('--keep', action='store_true', help='keep the generated log for later runs')
+    main(parser.parse_args())
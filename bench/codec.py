@@ -0,0 +1,48 @@
+""" Message encode/decode throughput and memory per message, against the Message class it replaced.
+
+    The baseline is the original class, kept in baseline_message.py, encoding and decoding as the
+    original server did: JSON through its MessageEncoder and MessageDecoder.
+
+    python bench/codec.py --count 100000
+"""
+from common import Message
+import argparse
+import baseline_message
+import json
+import sys
+import time
+import tracemalloc
+
+def sample_message(i: int, cls: type = Message):
+    return cls(username=f'user{i % 50}', content=f'message number {i} ' + 'x' * 64)
+
+def run(label: str, fn, inputs: list):
+    started = time.perf_counter()
+    for item in inputs:
+        fn(item)
+    rate = len(inputs) / (time.perf_counter() - started)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [fn(item) for item in inputs]
+    retained = (tracemalloc.get_traced_memory()[0] - before) / len(inputs)
+    tracemalloc.stop()
+    del kept
+    print(f'{label:<28} {rate:>12,.0f} msg/s {retained:>10.0f} B/msg retained')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+    messages = [sample_message(i) for i in range(args.count)]
+    frames = [message.serialize() for message in messages]
+    baseline = [sample_message(i, baseline_message.Message) for i in range(args.count)]
+    baseline_frames = [message.serialize() for message in baseline]
+    for label, message in (('baseline', baseline[0]), ('current', messages[0])):
+        print(f'{label:<8} sys.getsizeof(Message()) = {sys.getsizeof(message)} bytes, '
+              f'has __dict__: {hasattr(message, "__dict__")}, frame {len(frames[0] if label == "current" else baseline_frames[0])} bytes')
+    run('baseline encode', baseline_message.Message.serialize, baseline)
+    run('encode Message.serialize', Message.serialize, messages)
+    run('baseline decode', lambda f: json.loads(f, cls=baseline_message.MessageDecoder), baseline_frames)
+    run('decode Message.deserialize', Message.deserialize, frames)
+    run('baseline construct', lambda i: sample_message(i, baseline_message.Message), list(range(args.count)))
+    run('construct Message()', sample_message, list(range(args.count)))
@@ -0,0 +1,97 @@
+""" Helpers shared by the benchmark scripts in this directory. """
+from typing import List, Tuple
+import asyncio
+import logging
+import os
+import pickle
+import subprocess
+import sys
+
+CHATROOM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chatroom')
+sys.path.insert(0, CHATROOM)
+
+from message import Message
+from framing import Framing, read_message
+from server import ChatroomServer
+from server_address import ServerAddress
+
+async def start_server(port: int, **kwargs) -> ChatroomServer:
+    """ Start a ChatroomServer inside the running loop and wait until it is listening. """
+    server = ChatroomServer(ServerAddress('127.0.0.1', port), **kwargs)
+    server.logger.setLevel(logging.WARNING)
+    asyncio.create_task(server.serve(), name='Server')
+    while not hasattr(server, 'server'):
+        await asyncio.sleep(0.01)
+    return server
+
+async def spawn_server(port: int, workers: int = 1, **config) -> subprocess.Popen:
+    """ Run a ChatroomServer with ServerConfig(**config) in a child process, so it gets its own
+        descriptor limit and CPU time, and wait until it accepts connections. With `workers` > 1
+        the child runs that many worker processes joined by a bus. """
+    # The config goes over pickled, since enum values such as the loop backend have no literal repr.
+    config = f'server_config.ServerConfig(**pickle.loads(bytes.fromhex("{pickle.dumps(config).hex()}")))'
+    if workers > 1:
+        script = (
+            'import logging, loops, pickle, server_config; from workers import serve_workers; from server_address import ServerAddress; '
+            f'logging.getLogger().setLevel(logging.WARNING); config = {config}; '
+            f'loops.run(serve_workers(ServerAddress("127.0.0.1", {port}), config, {workers}, logging.WARNING), config.loop)'
+        )
+    else:
+        script = (
+            'import logging, pickle, server_config; from server import ChatroomServer; from server_address import ServerAddress; '
+            f'server = ChatroomServer(ServerAddress("127.0.0.1", {port}), {config}); '
+            'server.logger.setLevel(logging.WARNING); server.startup()'
+        )
+    process = subprocess.Popen([sys.executable, '-c', script], cwd=CHATROOM)
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f'Server exited with status {process.returncode}')
+            await asyncio.sleep(0.05)
+
+async def join(port: int, username: str, framing: Framing = Framing.JSON, **kwargs) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """ Open a connection and join the chatroom as `username`, returning once accepted. """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, **kwargs)
+    request = Message(join_request=True, username=username)
+    if framing is not Framing.JSON:
+        request.framing = framing.value
+    writer.write(request.serialize())
+    await writer.drain()
+    while True:
+        message = await read_message(reader)
+        if message.is_join_accept:
+            if message.framing != request.framing:
+                raise RuntimeError(f'Server did not accept {framing.value} framing')
+            return reader, writer
+        if message.is_join_reject:
+            raise RuntimeError(message.content)
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+async def stop_server(server: ChatroomServer):
+    """ Shut the server down gracefully and wait until it has stopped. """
+    task = server.server_task
+    server.stop()
+    await task
+
+def cpu_seconds(pid: int) -> float:
+    """ User plus system CPU time consumed so far by process `pid`. """
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def rss(pid: int, field: str = 'VmRSS') -> int:
+    """ Resident memory of process `pid` in bytes, or its peak with `field` VmHWM. """
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
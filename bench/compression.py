@@ -0,0 +1,136 @@
+""" Bandwidth saved and CPU spent by each compression mode, on joins with history, chat and attachments.
+
+    Listeners join with a history of chat to catch up on, then receive a run of chat messages and
+    a few text attachments. Wire bytes are what the listeners read off their sockets; plain bytes
+    what that inflates to. Server CPU comes from /proc; client CPU is this process's, inflating and
+    decoding included, and is the same work for every mode apart from the inflating.
+
+    python bench/compression.py --listeners 50 --messages 500 --attachments 5
+"""
+from common import Message, spawn_server, join, cpu_seconds
+from compressor import Codec, Inflater, available
+from framing import Framing, scan_frames
+import argparse
+import asyncio
+import base64
+import random
+import time
+
+WORDS = (
+    'the a to and is it that of on for you in this we just be have not what are with can so but was at '
+    'lunch meeting deploy build test server tomorrow today anyone know why release fixed broken merge '
+    'review thanks ok sure yes no maybe later coffee weekend bug ticket logs staging prod rollback'
+).split()
+
+def chat_line(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+def attachment(rng: random.Random, size: int) -> bytes:
+    """ A CSV-like text file, which is what most shared attachments compress like. """
+    rows = ['timestamp,host,status,latency_ms']
+    while sum(map(len, rows)) < size:
+        rows.append(f'{1700000000 + len(rows)},host-{rng.randint(1, 20)},{rng.choice((200, 200, 200, 404, 500))},{rng.uniform(1, 300):.1f}')
+    return '\n'.join(rows).encode()
+
+class Listener:
+
+    def __init__(self, offered: str, framing: Framing):
+        self.offered = offered
+        self.requested_framing = framing
+        self.wire = 0
+        self.plain = 0
+        self.done = asyncio.Event()
+
+    async def run(self, port: int, name: str):
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 27)
+        self.writer.write(Message(
+            join_request=True, username=name, compression=self.offered or None,
+            framing=self.requested_framing.value if self.requested_framing is not Framing.JSON else None
+        ).serialize())
+        inflater = Inflater()
+        framing = Framing.JSON
+        buffer = bytearray()
+        while (data := await reader.read(2 ** 16)):
+            self.wire += len(data)
+            data = inflater.feed(data)
+            self.plain += len(data)
+            buffer += data
+            while (scanned := scan_frames(buffer, framing, 2 ** 27))[0]:
+                messages, used = scanned
+                del buffer[:used]
+                for message in messages:
+                    if message.framing == Framing.BINARY.value:
+                        framing = Framing.BINARY
+                    if message.content == 'done':
+                        self.done.set()
+
+async def measure(port: int, codec: Codec, stream: bool, args) -> dict:
+    rng = random.Random(args.seed)
+    process = await spawn_server(
+        port, capacity=args.listeners + 2, max_connections=args.listeners + 10, join_history=args.history,
+        compression=(codec,) if codec is not None else (), compression_stream=stream,
+        compression_threshold=args.threshold, ping_interval=None
+    )
+    try:
+        talker_reader, talker = await join(port, 'talker')
+        drain = asyncio.create_task(talker_reader.read(-1))
+        for _ in range(args.history):
+            talker.write(Message(username='talker', content=chat_line(rng)).serialize())
+        await talker.drain()
+        await asyncio.sleep(0.5)
+        files = [attachment(rng, args.attachment_size) for _ in range(args.attachments)]
+        server_cpu, client_cpu = cpu_seconds(process.pid), time.process_time()
+        started = time.perf_counter()
+        listeners = [Listener(codec.value if codec is not None else '', args.framing) for _ in range(args.listeners)]
+        tasks = [asyncio.create_task(listener.run(port, f'listener{i}')) for i, listener in enumerate(listeners)]
+        await asyncio.sleep(0.5)
+        for i in range(args.messages):
+            talker.write(Message(username='talker', content=chat_line(rng)).serialize())
+            if files and i % (args.messages // len(files) or 1) == 0 and i // (args.messages // len(files) or 1) < len(files):
+                data = files[i // (args.messages // len(files) or 1)]
+                talker.write(Message(username='talker', filename=f'log{i}.csv', content=base64.b64encode(data).decode()).serialize())
+            await talker.drain()
+            await asyncio.sleep(args.interval)
+        talker.write(Message(username='talker', content='done').serialize())
+        await asyncio.wait_for(asyncio.gather(*(listener.done.wait() for listener in listeners)), 60)
+        elapsed = time.perf_counter() - started
+        server_cpu, client_cpu = cpu_seconds(process.pid) - server_cpu, time.process_time() - client_cpu
+        for task in tasks + [drain]:
+            task.cancel()
+        return {
+            'wire': sum(listener.wire for listener in listeners),
+            'plain': sum(listener.plain for listener in listeners),
+            'server_cpu': server_cpu,
+            'client_cpu': client_cpu,
+            'elapsed': elapsed
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    modes = [(None, False)]
+    for codec in available():
+        modes += [(codec, False), (codec, True)]
+    print(f'{"mode":>12} {"wire bytes":>14} {"plain bytes":>14} {"saved":>7} {"server cpu":>11} {"client cpu":>11}')
+    baseline = None
+    for i, (codec, stream) in enumerate(modes):
+        result = await measure(args.port + i, codec, stream, args)
+        baseline = baseline or result
+        name = 'none' if codec is None else codec.value + ('+stream' if stream else '')
+        print(f'{name:>12} {result["wire"]:>14,} {result["plain"]:>14,} {1 - result["wire"] / result["plain"]:>7.1%} '
+              f'{(result["server_cpu"] - baseline["server_cpu"]) * 1e3:>+9.0f}ms {(result["client_cpu"] - baseline["client_cpu"]) * 1e3:>+9.0f}ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18300)
+    parser.add_argument('--listeners', type=int, default=50)
+    parser.add_argument('--history', type=int, default=100, help='chat messages each join catches up on')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--attachments', type=int, default=5)
+    parser.add_argument('--attachment-size', type=int, default=32 * 1024, help='kept under the server stream limit once base64 encoded')
+    parser.add_argument('--threshold', type=int, default=512)
+    parser.add_argument('--interval', type=float, default=0.002, help='seconds between chat messages')
+    parser.add_argument('--framing', type=Framing, default=Framing.JSON, choices=list(Framing))
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
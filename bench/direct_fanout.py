@@ -0,0 +1,96 @@
+""" What a direct message costs against a room broadcast, as the room around its recipients grows.
+
+    `--members` SDK clients join a server in another process and all stay in the lobby. One of them
+    then says `--messages` messages to the lobby, one at a time, each timed until every member has
+    it, and sends as many direct messages to `--recipients` of the others, each timed until they all
+    have it. The server's own time to queue each kind comes from its fanout and direct histograms,
+    as the growth in their sums over the growth in their counts.
+
+    python bench/direct_fanout.py --members 10 100 1000 --recipients 1 5 --messages 50
+"""
+from common import spawn_server, percentile
+from sdk import ChatClient
+from server_address import ServerAddress
+import argparse
+import asyncio
+import time
+
+class Tally:
+    """ Counts deliveries of the message in flight and wakes the sender once all are in. """
+
+    def __init__(self):
+        self.content = None
+        self.expected = 0
+        self.received = 0
+        self.done = asyncio.Event()
+
+    def expect(self, content: str, expected: int):
+        self.content = content
+        self.expected = expected
+        self.received = 0
+        self.done.clear()
+
+    def received_message(self, message):
+        if message.content == self.content:
+            self.received += 1
+            if self.received == self.expected:
+                self.done.set()
+
+async def server_time(client: ChatClient, histogram: str, before: dict) -> float:
+    """ The mean of the server's `histogram` over the observations made since the `before` snapshot. """
+    after = (await client.status()).stats[histogram]
+    return (after['sum'] - before['sum']) / max(1, after['count'] - before['count'])
+
+async def timed(tally: Tally, send, expected: int, count: int, label: str) -> list:
+    timings = []
+    for i in range(count):
+        tally.expect(f'{label} {i}', expected)
+        started = time.perf_counter()
+        await send(tally.content)
+        await tally.done.wait()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+async def measure(port: int, members: int, args) -> list:
+    process = await spawn_server(
+        port, ping_interval=None, join_history=0, capacity=members + 10, max_connections=members + 10,
+        max_connections_per_ip=members + 10, join_rate=10_000.0, join_burst=members + 10
+    )
+    try:
+        tally = Tally()
+        clients = [ChatClient(ServerAddress('127.0.0.1', port)) for _ in range(members)]
+        for client in clients:
+            client.on('chat', tally.received_message)
+            client.on('direct', tally.received_message)
+        await asyncio.gather(*(client.join(f'member{i}') for i, client in enumerate(clients)))
+        await asyncio.sleep(0.5)
+        sender = clients[0]
+        rows = []
+        before = (await sender.status()).stats['fanout_seconds']
+        room = await timed(tally, sender.say, members, args.messages, 'room')
+        rows.append(('room', members, room, await server_time(sender, 'fanout_seconds', before)))
+        for count in args.recipients:
+            names = [f'member{i}' for i in range(1, min(count, members - 1) + 1)]
+            before = (await sender.status()).stats['direct_seconds']
+            direct = await timed(tally, lambda content: sender.direct(names, content), len(names) + 1, args.messages, 'direct')
+            rows.append((f'direct to {len(names)}', len(names) + 1, direct, await server_time(sender, 'direct_seconds', before)))
+        await asyncio.gather(*(client.close() for client in clients))
+        return rows
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{"members":>8} {"message":<14} {"receivers":>9} {"all have it p50":>16} {"p99":>9} {"server queue":>13}')
+    for i, members in enumerate(args.members):
+        for label, receivers, timings, queued in await measure(args.port + i, members, args):
+            print(f'{members:>8} {label:<14} {receivers:>9} {percentile(timings, 50) * 1e3:>14.2f}ms '
+                  f'{percentile(timings, 99) * 1e3:>7.2f}ms {queued * 1e6:>11.1f}µs')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18700)
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--messages', type=int, default=50, help='messages of each kind, sent one at a time')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,44 @@
+""" Encode cost per broadcast: serializing per recipient versus one shared Frame.
+
+    python bench/encode_frames.py --iterations 200
+"""
+from common import Message
+from frame import Frame
+import argparse
+import time
+
+class NullWriter:
+    """ Stands in for a StreamWriter so only encode and hand-off cost is measured. """
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+def per_recipient(message: Message, writers: list):
+    for writer in writers:
+        writer.write(message.serialize())
+
+def shared_frame(message: Message, writers: list):
+    frame = Frame.from_message(message)
+    for writer in writers:
+        writer.write(frame.view)
+
+def measure(path, recipients: int, iterations: int) -> float:
+    writers = [NullWriter() for _ in range(recipients)]
+    message = Message(username='bench', content='x' * 256)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        path(message, writers)
+    return (time.perf_counter() - started) / iterations
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    print(f'{"recipients":>10} {"per-recipient":>16} {"shared frame":>16} {"speedup":>8}')
+    for recipients in (1, 10, 1000):
+        old = measure(per_recipient, recipients, args.iterations)
+        new = measure(shared_frame, recipients, args.iterations)
+        print(f'{recipients:>10} {old * 1e6:>14.1f}us {new * 1e6:>14.1f}us {old / new:>7.1f}x')
@@ -0,0 +1,80 @@
+""" Throughput of JSON versus binary framing for text chat and large attachments.
+
+    python bench/framing_throughput.py --messages 5000 --attachments 1 10 100
+"""
+from common import start_server, stop_server, join
+from framing import Framing, encode, read_message
+from message import Message
+from server_config import ServerConfig
+from connection import SlowConsumerPolicy
+import argparse
+import asyncio
+import os
+import time
+
+MB = 1024 * 1024
+
+async def transfer(port: int, framing: Framing, messages: list, label: str):
+    """ Send `messages` from one user and time until a second user has received them all. """
+    sender_reader, sender = await join(port, f'sender-{label}', framing, limit=2 ** 30)
+    receiver, receiver_writer = await join(port, f'receiver-{label}', framing, limit=2 ** 30)
+    # The sender also sees the receiver's join announcement.
+    await read_message(sender_reader, framing)
+    started = time.perf_counter()
+    wire_bytes = 0
+
+    async def send():
+        nonlocal wire_bytes
+        for message in messages:
+            data = encode(message, framing)
+            wire_bytes += len(data)
+            sender.write(data)
+            await sender.drain()
+
+    async def receive():
+        received = 0
+        while received < len(messages):
+            message = await read_message(receiver, framing)
+            if message.username == f'sender-{label}':
+                received += 1
+
+    async def discard():
+        while await sender_reader.read(MB):
+            pass
+
+    discarding = asyncio.create_task(discard())
+    await asyncio.gather(send(), receive())
+    elapsed = time.perf_counter() - started
+    discarding.cancel()
+    for writer in (sender, receiver_writer):
+        writer.close()
+    return elapsed, wire_bytes
+
+async def main(args):
+    server = await start_server(args.port, config=ServerConfig(
+        capacity=2, stream_limit=2 ** 30, max_frame_bytes=2 ** 30, queue_size=64, slow_consumer_policy=SlowConsumerPolicy.BLOCK,
+        session_ttl=None     # Each workload joins afresh; held sessions would fill the capacity.
+    ))
+    print(f'{"workload":<22} {"framing":<8} {"elapsed":>10} {"wire bytes":>14} {"msg/s":>10} {"payload MB/s":>14}')
+    workloads = [(f'text x{args.messages}', lambda f: [Message(username=f'sender-{f}', content='hello ' * 10) for _ in range(args.messages)])]
+    for size in args.attachments:
+        blob = os.urandom(int(size * MB))
+        workloads.append((f'attachment {size}MB', lambda f, blob=blob: [Message(username=f'sender-{f}', filename='blob.bin', content=blob)]))
+    for name, build in workloads:
+        for framing in (Framing.JSON, Framing.BINARY):
+            server.chat_history.clear()
+            label = f'{name}-{framing.value}'.replace(' ', '')
+            messages = build(label)
+            payload = sum(len(m.content) for m in messages)
+            elapsed, wire_bytes = await transfer(args.port, framing, messages, label)
+            await asyncio.sleep(0.1)
+            print(f'{name:<22} {framing.value:<8} {elapsed:>9.3f}s {wire_bytes:>14,} '
+                  f'{len(messages) / elapsed:>10,.0f} {payload / elapsed / MB:>14.1f}')
+    await stop_server(server)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18002)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--attachments', type=float, nargs='*', default=[1, 10, 100], help='attachment sizes in MB')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,51 @@
+""" Join latency as the chat history grows, with joins replaying only the newest messages.
+
+    python bench/history_join.py --sizes 1000 10000 100000 1000000
+"""
+from common import start_server, stop_server, join
+from history import ChatHistory
+from message import Message
+from server_config import ServerConfig
+import argparse
+import asyncio
+import time
+
+async def measure(port: int, size: int, joins: int, join_history: int, full_render_limit: int):
+    server = await start_server(port, config=ServerConfig(
+        capacity=joins + 1, history_size=size, history_bytes=2 ** 40, join_history=join_history
+    ))
+    started = time.perf_counter()
+    for i in range(size):
+        server.chat_history.append(Message(username=f'user{i % 100}', content=f'message {i} ' + 'x' * 40))
+    fill = time.perf_counter() - started
+    latencies = []
+    for i in range(joins):
+        started = time.perf_counter()
+        _, writer = await join(port, f'joiner{i}')
+        latencies.append(time.perf_counter() - started)
+        writer.close()
+    full = float('nan')
+    if size <= full_render_limit:
+        started = time.perf_counter()
+        ChatHistory.render(list(server.chat_history))
+        full = time.perf_counter() - started
+    await stop_server(server)
+    latencies.sort()
+    return fill, latencies[len(latencies) // 2], full
+
+async def main(args):
+    print(f'{"history":>10} {"fill":>10} {"join p50":>12} {"full render":>12}')
+    for i, size in enumerate(args.sizes):
+        fill, p50, full = await measure(args.port + i, size, args.joins, args.join_history, args.full_render_limit)
+        full = f'{full * 1e3:>10.1f}ms' if full == full else f'{"skipped":>12}'
+        print(f'{size:>10,} {fill:>9.2f}s {p50 * 1e3:>10.2f}ms {full}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18010)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--joins', type=int, default=20)
+    parser.add_argument('--join-history', type=int, default=100)
+    parser.add_argument('--full-render-limit', type=int, default=100000,
+                        help='also time rendering the whole history (the old join behaviour) up to this size')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,337 @@
+""" Synthetic chat load: users join, chat at a target rate, send attachments and quit, against a server
+    started in-process or in a child process.
+
+    A scenario is fixed by its parameters and seed: every user's send schedule and attachment bytes
+    come from a generator seeded with the scenario seed and the user's index, so the same command line
+    offers the same load. Every user sends into the lobby, so each message is delivered to all of them.
+    A few probe users decode everything they receive to time it (chat messages from send to delivery,
+    attachments from their first byte sent to the end of the transfer); the rest only count frames.
+
+    Reports throughput, latency percentiles, server CPU and RSS, and the server's own metrics from a
+    status request, and with --output writes them as JSON, so runs can be compared with --baseline.
+
+    python bench/loadgen.py --scenario chat --users 50 --duration 10 --output chat.json
+    python bench/loadgen.py --scenario attachments --attachment-size 1048576 --baseline chat.json
+"""
+from common import (Message, start_server, stop_server, spawn_server, join, percentile, cpu_seconds, rss,
+                    read_message)
+from framing import read_frame, decode_frame, frame_size
+from loops import LoopBackend
+from protocol import ServerEngine
+from server_config import ServerConfig
+from typing import Dict, List, NamedTuple, Optional
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+CHUNK_SIZE = 32 * 1024
+
+class Scenario(NamedTuple):
+    users:              int     = 20
+    rate:               float   = 2.0       # Chat messages per second from each user.
+    message_size:       int     = 64        # Bytes of padding in each chat message.
+    attachment_size:    int     = 0         # Bytes per attachment; 0 sends none.
+    attachment_every:   float   = 5.0       # Seconds between one user's attachments.
+    duration:           float   = 10.0      # Seconds of load, after every user has joined.
+    ramp:               float   = 1.0       # Seconds over which the users join.
+    probes:             int     = 4         # Users that decode and time everything they receive.
+    seed:               int     = 1
+
+SCENARIOS = {
+    'chat':         Scenario(),
+    'crowd':        Scenario(users=200, rate=0.5, ramp=4.0, probes=8),
+    'chatty':       Scenario(users=10, rate=50.0, message_size=256),
+    'attachments':  Scenario(users=10, rate=1.0, attachment_size=256 * 1024, attachment_every=2.0),
+}
+
+class Run:
+    """ State shared by every synthetic user of one run. """
+
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self.measuring = False
+        self.sent = 0
+        self.attachments_sent = 0
+        self.frames = 0
+        self.bytes = 0
+        self.latencies: List[float] = []
+        self.server_latencies: List[float] = []     # From the server receiving a chat message to a probe decoding it.
+        self.attachment_latencies: List[float] = []
+        self.join_latencies: List[float] = []
+        self.transfers: Dict[str, float] = {}   # Transfer id to when its first frame was sent.
+
+class User:
+
+    def __init__(self, run: Run, index: int, probe: bool):
+        self.run = run
+        self.index = index
+        self.name = f'load{index}'
+        self.probe = probe
+        self.rng = random.Random(f'{run.scenario.seed}-{index}')
+        self.attachment = self.rng.randbytes(run.scenario.attachment_size)
+
+    async def connect(self, port: int):
+        started = time.perf_counter()
+        self.reader, self.writer = await join(port, self.name)
+        self.run.join_latencies.append(time.perf_counter() - started)
+        self.receiver = asyncio.create_task(self.decode() if self.probe else self.count())
+
+    async def count(self):
+        """ Count the frames delivered while the run is measuring, without decoding them. """
+        run = self.run
+        while (data := await self.reader.read(2 ** 16)):
+            if run.measuring:
+                run.frames += data.count(b'\n')
+                run.bytes += len(data)
+
+    async def decode(self):
+        """ Decode every frame delivered, timing chat messages and finished attachments. """
+        run = self.run
+        while (frame := await read_frame(self.reader)) is not None:
+            if not run.measuring:
+                continue
+            run.frames += 1
+            run.bytes += frame_size(*frame)
+            message = decode_frame(*frame)
+            if message.is_transfer_end:
+                if (started := run.transfers.get(message.transfer_id)) is not None:
+                    run.attachment_latencies.append(time.perf_counter() - started)
+            elif not message.flags and message.username and message.content:
+                run.latencies.append(time.perf_counter() - float(message.content.split(' ', 1)[0]))
+                if message.time_ns is not None:
+                    run.server_latencies.append((time.time_ns() - message.time_ns) / 1e9)
+
+    async def chat(self, until: float):
+        """ Send chat messages at the scenario rate from a seeded offset until `until`. """
+        scenario = self.run.scenario
+        padding = 'x' * scenario.message_size
+        interval = 1 / scenario.rate
+        due = time.perf_counter() + self.rng.uniform(0, interval)
+        while due < until:
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            self.writer.write(Message(username=self.name, content=f'{time.perf_counter():.6f} {padding}').serialize())
+            self.run.sent += 1
+            due += interval
+            await self.writer.drain()
+
+    async def attach(self, until: float):
+        """ Send the user's attachment every `attachment_every` seconds, from a seeded offset, until `until`. """
+        scenario = self.run.scenario
+        due = time.perf_counter() + self.rng.uniform(0, scenario.attachment_every)
+        sent = 0
+        while due < until:
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            transfer_id = f'{self.name}-{sent}'
+            self.run.transfers[transfer_id] = time.perf_counter()
+            self.writer.write(Message(
+                username=self.name, transfer_begin=True, transfer_id=transfer_id,
+                filename=f'{transfer_id}.bin', total_size=len(self.attachment), offset=0
+            ).serialize())
+            for offset in range(0, len(self.attachment), CHUNK_SIZE):
+                self.writer.write(Message(
+                    username=self.name, transfer_chunk=True, transfer_id=transfer_id,
+                    offset=offset, content=self.attachment[offset:offset + CHUNK_SIZE]
+                ).serialize())
+                await self.writer.drain()
+            self.writer.write(Message(
+                username=self.name, transfer_end=True, transfer_id=transfer_id, total_size=len(self.attachment)
+            ).serialize())
+            await self.writer.drain()
+            self.run.attachments_sent += 1
+            sent += 1
+            due += scenario.attachment_every
+
+    async def load(self, until: float):
+        tasks = [self.chat(until)]
+        if self.run.scenario.attachment_size:
+            tasks.append(self.attach(until))
+        await asyncio.gather(*tasks)
+
+    async def quit(self):
+        self.writer.write(Message(username=self.name, quit_request=True).serialize())
+        await self.writer.drain()
+
+def summary(samples: List[float]) -> dict:
+    """ Percentiles of `samples` in milliseconds. """
+    if not samples:
+        return {'samples': 0}
+    return {
+        'samples': len(samples),
+        'p50': percentile(samples, 50) * 1e3,
+        'p95': percentile(samples, 95) * 1e3,
+        'p99': percentile(samples, 99) * 1e3,
+        'max': max(samples) * 1e3
+    }
+
+async def server_stats(port: int) -> dict:
+    """ The server's metrics, from a status request. """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(Message(status_request=True).serialize())
+    message = await read_message(reader)
+    writer.close()
+    stats = dict(message.stats or {})
+    stats.pop('queue_depth', None)     # One entry per connection; the totals are kept.
+    return stats
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_scenario(scenario: Scenario, args) -> dict:
+    config = dict(
+        loop=LoopBackend(args.loop), engine=ServerEngine(args.engine), capacity=scenario.users + 10,
+        max_connections=scenario.users + 20, max_connections_per_ip=scenario.users + 20,
+        join_rate=max(100.0, scenario.users / max(scenario.ramp, 0.1) * 2), join_burst=scenario.users + 10,
+        coalesce_delay=args.coalesce_ms / 1000
+    )
+    if args.server == 'subprocess':
+        process = await spawn_server(args.port, **config)
+        pid, server = process.pid, None
+    else:
+        config.pop('loop')      # The server shares this process's loop.
+        server = await start_server(args.port, config=ServerConfig(**config))
+        pid, process = os.getpid(), None
+    run = Run(scenario)
+    users = [User(run, i, i < scenario.probes) for i in range(scenario.users)]
+    try:
+        ramp_started = time.perf_counter()
+        for i, user in enumerate(users):
+            await asyncio.sleep(max(0, ramp_started + scenario.ramp * i / scenario.users - time.perf_counter()))
+            await user.connect(args.port)
+        await asyncio.sleep(0.5)
+        cpu = cpu_seconds(pid)
+        started = time.perf_counter()
+        run.measuring = True
+        await asyncio.gather(*(user.load(started + scenario.duration) for user in users))
+        await asyncio.sleep(args.settle)        # Let what is in flight arrive.
+        run.measuring = False
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(pid) - cpu
+        stats = await server_stats(args.port)
+        memory, peak = rss(pid), rss(pid, 'VmHWM')
+        for user in users:
+            await user.quit()
+        await asyncio.sleep(0.2)
+        for user in users:
+            user.writer.close()
+            user.receiver.cancel()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        else:
+            await stop_server(server)
+    return {
+        'sent_per_s': run.sent / scenario.duration,
+        'delivered_per_s': run.frames / elapsed,
+        'delivered_mb_per_s': run.bytes / elapsed / 2 ** 20,
+        'chat_delivery_ratio': len(run.latencies) / (run.sent * scenario.probes) if run.sent and scenario.probes else None,
+        'attachments_sent': run.attachments_sent,
+        'latency_ms': summary(run.latencies),
+        'server_to_client_ms': summary(run.server_latencies),
+        'attachment_ms': summary(run.attachment_latencies),
+        'join_ms': summary(run.join_latencies),
+        # In-process, CPU and memory are this whole process's, clients included.
+        'cpu_scope': 'server' if args.server == 'subprocess' else 'process',
+        'cpu_s': cpu,
+        'cpu_us_per_delivery': cpu / run.frames * 1e6 if run.frames else None,
+        'rss_mb': memory / 2 ** 20,
+        'peak_rss_mb': peak / 2 ** 20,
+        'server_stats': stats
+    }
+
+def report(results: dict, baseline: Optional[dict]):
+    rows = [
+        ('sent/s', ('sent_per_s',), '{:,.0f}'),
+        ('delivered/s', ('delivered_per_s',), '{:,.0f}'),
+        ('delivered MB/s', ('delivered_mb_per_s',), '{:,.2f}'),
+        ('chat p50 ms', ('latency_ms', 'p50'), '{:.2f}'),
+        ('chat p95 ms', ('latency_ms', 'p95'), '{:.2f}'),
+        ('chat p99 ms', ('latency_ms', 'p99'), '{:.2f}'),
+        ('server->client p50', ('server_to_client_ms', 'p50'), '{:.2f}'),
+        ('server->client p99', ('server_to_client_ms', 'p99'), '{:.2f}'),
+        ('attachment p50 ms', ('attachment_ms', 'p50'), '{:.1f}'),
+        ('attachment p99 ms', ('attachment_ms', 'p99'), '{:.1f}'),
+        ('join p99 ms', ('join_ms', 'p99'), '{:.2f}'),
+        ('delivery ratio', ('chat_delivery_ratio',), '{:.3f}'),
+        ('cpu s', ('cpu_s',), '{:.2f}'),
+        ('cpu us/delivery', ('cpu_us_per_delivery',), '{:.1f}'),
+        ('rss MB', ('rss_mb',), '{:.1f}'),
+        ('peak rss MB', ('peak_rss_mb',), '{:.1f}'),
+    ]
+
+    def lookup(source: dict, keys: tuple):
+        for key in keys:
+            source = source.get(key) if isinstance(source, dict) else None
+        return source
+
+    print(f'{"":>18} {"this run":>12}' + (f' {"baseline":>12} {"change":>8}' if baseline else ''))
+    for label, keys, form in rows:
+        value = lookup(results['results'], keys)
+        line = f'{label:>18} {form.format(value) if value is not None else "-":>12}'
+        if baseline:
+            before = lookup(baseline['results'], keys)
+            line += f' {form.format(before) if before is not None else "-":>12}'
+            if value is not None and before:
+                line += f' {(value - before) / before:>+8.1%}'
+        print(line)
+
+async def main(args):
+    scenario = SCENARIOS[args.scenario]._replace(**{
+        field: value for field in Scenario._fields if (value := getattr(args, field)) is not None
+    })
+    print(f'{args.scenario}: {", ".join(f"{field}={value}" for field, value in scenario._asdict().items())}')
+    print(f'server {args.server}, {args.engine} engine, {args.loop} loop')
+    results = {
+        'scenario': args.scenario,
+        'parameters': scenario._asdict(),
+        'server': {'mode': args.server, 'engine': args.engine, 'loop': args.loop, 'coalesce_ms': args.coalesce_ms},
+        'environment': {
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'results': await run_scenario(scenario, args)
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', default='chat', choices=SCENARIOS)
+    for field, default in Scenario._field_defaults.items():
+        parser.add_argument(f'--{field.replace("_", "-")}', type=type(default), help=f'overrides the scenario\'s {field}')
+    parser.add_argument('--server', default='subprocess', choices=['subprocess', 'inprocess'])
+    parser.add_argument('--engine', default=ServerEngine.STREAMS.value, choices=[engine.value for engine in ServerEngine])
+    parser.add_argument('--loop', default=LoopBackend.AUTO.value, choices=[backend.value for backend in LoopBackend],
+                        help='server loop backend, in subprocess mode')
+    parser.add_argument('--coalesce-ms', type=float, default=0.0)
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds to wait for deliveries after the load stops')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--output', help='write the results as JSON to this file, or - for stdout')
+    parser.add_argument('--baseline', help='a results file from an earlier run to compare with')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,92 @@
+""" Echo and broadcast throughput of the server on each event loop backend and server engine.
+
+    The server runs in a child process on the backend and engine under test. In the echo phase every client
+    sits alone in its own room, so each message comes straight back to its sender; in the broadcast
+    phase every client is in the lobby and each message reaches all of them. Clients keep a fixed
+    window of their own messages in flight. Server CPU time is read from /proc.
+
+    python bench/loop_backends.py --clients 50 --window 8 --duration 5 --engines streams protocol
+"""
+from common import Message, spawn_server, join, read_message, cpu_seconds
+from loops import LoopBackend, available
+from protocol import ServerEngine
+import argparse
+import asyncio
+import time
+
+async def client(port: int, name: str, room: str, window: int, stop_at: float, counts: dict):
+    """ Keep `window` messages from `name` in flight until `stop_at`, counting everything delivered. """
+    reader, writer = await join(port, name)
+    if room != 'lobby':
+        writer.write(Message(username=name, room_join=True, room=room, history_limit=0).serialize())
+        writer.write(Message(username=name, room_leave=True, room='lobby').serialize())
+    frame = Message(username=name, room=None if room == 'lobby' else room, content='x' * 64).serialize()
+    await asyncio.sleep(0.5)
+    writer.write(frame * window)
+    while (message := await read_message(reader)) is not None:
+        if message.content != 'x' * 64:
+            continue
+        counts['delivered'] += 1
+        if message.username == name:
+            if time.perf_counter() >= stop_at:
+                break
+            counts['sent'] += 1
+            writer.write(frame)
+    writer.close()
+
+async def phase(port: int, pid: int, rooms: list, args) -> dict:
+    counts = {'sent': 0, 'delivered': 0}
+    started = time.perf_counter()
+    stop_at = started + 0.5 + args.duration
+    cpu = cpu_seconds(pid)
+    await asyncio.gather(*(
+        client(port, f'{room}-user{i}', room, args.window, stop_at, counts) for i, room in enumerate(rooms)
+    ))
+    elapsed = time.perf_counter() - started
+    return {
+        'sent/s': counts['sent'] / elapsed,
+        'delivered/s': counts['delivered'] / elapsed,
+        'cpu us/delivery': (cpu_seconds(pid) - cpu) / max(1, counts['delivered']) * 1e6
+    }
+
+async def measure(port: int, backend: LoopBackend, engine: ServerEngine, args) -> dict:
+    process = await spawn_server(
+        port, loop=backend, engine=engine, capacity=args.clients + 1, join_history=0,
+        history_size=1000, max_rooms=args.clients + 1,
+        session_ttl=None     # The broadcast phase joins afresh; held echo sessions would fill the capacity.
+    )
+    try:
+        return {
+            'echo': await phase(port, process.pid, [f'echo{i}' for i in range(args.clients)], args),
+            'broadcast': await phase(port, process.pid, ['lobby'] * args.clients, args)
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    backends = [LoopBackend(backend) for backend in args.backends] if args.backends else available()
+    missing = [backend.value for backend in LoopBackend if backend not in available() and backend is not LoopBackend.AUTO]
+    print(f'{args.clients} clients, window {args.window}, {args.duration}s per phase'
+          + (f' (not installed: {", ".join(missing)})' if missing else ''))
+    print(f'{"backend":>10} {"engine":>10} {"phase":>10} {"sent/s":>10} {"delivered/s":>12} {"cpu us/delivery":>16}')
+    port = args.port
+    for backend in backends:
+        for engine in map(ServerEngine, args.engines):
+            results = await measure(port, backend, engine, args)
+            port += 1
+            for name, result in results.items():
+                print(f'{backend.value:>10} {engine.value:>10} {name:>10} {result["sent/s"]:>10,.0f} '
+                      f'{result["delivered/s"]:>12,.0f} {result["cpu us/delivery"]:>16.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18050)
+    parser.add_argument('--backends', nargs='*', choices=[backend.value for backend in LoopBackend],
+                        help='defaults to every backend installed here')
+    parser.add_argument('--engines', nargs='*', choices=[engine.value for engine in ServerEngine],
+                        default=[engine.value for engine in ServerEngine])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--window', type=int, default=8, help='messages each client keeps in flight')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per phase')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+""" Server CPU per message under a flood of small messages, for each server engine and framing.
+
+    Every sender sits alone in its own room and writes its messages in large batches, so the server
+    reads many frames per receive and each message is delivered once, back to its sender. Connections
+    use the block policy, so nothing is dropped and the flood runs at the server's pace. The server
+    runs in a child process; its CPU time is read from /proc.
+
+    python bench/protocol_flood.py --senders 20 --messages 20000 --size 16
+"""
+from common import Message, Framing, spawn_server, join, read_message, cpu_seconds
+from connection import SlowConsumerPolicy
+from framing import encode
+from loops import LoopBackend, available
+from protocol import ServerEngine
+import argparse
+import asyncio
+import time
+
+async def sender(port: int, i: int, framing: Framing, args, ready: asyncio.Event, go: asyncio.Event):
+    name = f'sender{i}'
+    reader, writer = await join(port, name, framing)
+    writer.write(encode(Message(username=name, room_join=True, room=name, history_limit=0), framing))
+    writer.write(encode(Message(username=name, room_leave=True, room='lobby'), framing))
+    while not (message := await read_message(reader, framing)).is_room_leave:
+        pass
+    frame = encode(Message(username=name, room=name, content='x' * args.size), framing)
+    ready.set()
+    await go.wait()
+
+    async def flood():
+        for start in range(0, args.messages, args.batch):
+            writer.write(frame * min(args.batch, args.messages - start))
+            await writer.drain()
+
+    task = asyncio.create_task(flood())
+    received = 0
+    while received < args.messages:
+        message = await read_message(reader, framing)
+        if message.content == 'x' * args.size:
+            received += 1
+    await task
+    writer.close()
+
+async def measure(port: int, engine: ServerEngine, framing: Framing, args) -> tuple:
+    process = await spawn_server(
+        port, loop=LoopBackend(args.loop), engine=engine, capacity=args.senders + 1, join_history=0,
+        history_size=1000, max_rooms=args.senders + 1, slow_consumer_policy=SlowConsumerPolicy.BLOCK
+    )
+    try:
+        readies = [asyncio.Event() for _ in range(args.senders)]
+        go = asyncio.Event()
+        tasks = [asyncio.create_task(sender(port, i, framing, args, readies[i], go)) for i in range(args.senders)]
+        for ready in readies:
+            await ready.wait()
+        cpu = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        go.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), args.timeout)
+        elapsed = time.perf_counter() - started
+        total = args.senders * args.messages
+        return total / elapsed, (cpu_seconds(process.pid) - cpu) / total * 1e6
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{args.senders} senders x {args.messages:,} messages of {args.size} bytes, {args.loop} loop')
+    print(f'{"engine":>10} {"framing":>8} {"msgs/s":>10} {"cpu us/msg":>11}')
+    port = args.port
+    for framing in map(Framing, args.framings):
+        for engine in map(ServerEngine, args.engines):
+            rate, cpu = await measure(port, engine, framing, args)
+            port += 1
+            print(f'{engine.value:>10} {framing.value:>8} {rate:>10,.0f} {cpu:>11.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18060)
+    parser.add_argument('--engines', nargs='*', choices=[engine.value for engine in ServerEngine],
+                        default=[engine.value for engine in ServerEngine])
+    parser.add_argument('--framings', nargs='*', choices=[framing.value for framing in Framing],
+                        default=[framing.value for framing in Framing])
+    parser.add_argument('--loop', default=LoopBackend.ASYNCIO.value,
+                        choices=[backend.value for backend in available()])
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=20000, help='messages per sender')
+    parser.add_argument('--size', type=int, default=16, help='content bytes per message')
+    parser.add_argument('--batch', type=int, default=500, help='messages per client write')
+    parser.add_argument('--timeout', type=float, default=300)
+    asyncio.run(main(parser.parse_args()))
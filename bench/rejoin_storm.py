@@ -0,0 +1,90 @@
+""" Every user's connection drops at once and they all rejoin: fresh joins versus session resumes.
+
+    A fresh rejoin is sent the newest `join_history` messages again; a resume sends its session token
+    and the newest sequence it saw, and gets only what was said while it was away. Reports the time
+    until every user is back, the bytes they were sent, and the server CPU spent.
+
+    python bench/rejoin_storm.py --users 1000 --history 1000 --missed 5
+"""
+from common import Message, spawn_server, cpu_seconds, read_message
+import argparse
+import asyncio
+import time
+
+async def join(port: int, name: str, session: str = None, cursor: int = None):
+    """ Join as `name`, retrying after rate-limit rejects. Returns (reader, writer, accept, bytes read). """
+    while True:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(Message(join_request=True, username=name, session=session, cursor=cursor).serialize())
+        message = await read_message(reader)
+        if message is not None and message.is_join_accept:
+            return reader, writer, message, len(message.serialize())
+        writer.close()
+        if message is None or message.reason != 'rate_limited':
+            raise RuntimeError(f'@{name} Could Not Rejoin: {message.content if message else "closed"}')
+        await asyncio.sleep(0.05)
+
+async def storm(args, resume: bool, port: int):
+    server = await spawn_server(
+        port, capacity=args.users + 10, max_connections=args.users + 10, max_connections_per_ip=args.users + 10,
+        join_rate=args.join_rate, join_burst=args.users, join_history=args.join_history,
+        session_ttl=60.0 if resume else None, ping_interval=None, idle_timeout=None
+    )
+    try:
+        # The chatter never drops; it fills the history before the outage and talks during it.
+        _, chatter, _, _ = await join(port, 'chatter')
+        for i in range(args.history):
+            chatter.write(Message(username='chatter', content=f'before {i} ' + 'x' * 60).serialize())
+        users = []
+        for i in range(args.users):
+            users.append(await join(port, f'user{i}'))
+        # Let the join announcements and the history settle, tracking the newest sequence each user saw.
+        cursors = [accept.cursor for _, _, accept, _ in users]
+        async def drain(i, reader):
+            try:
+                while (message := await asyncio.wait_for(read_message(reader), args.settle)) is not None:
+                    if message.sequence is not None:
+                        cursors[i] = max(cursors[i], message.sequence)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.gather(*(drain(i, reader) for i, (reader, _, _, _) in enumerate(users)))
+        for _, writer, _, _ in users:
+            writer.transport.abort()
+        await asyncio.sleep(args.settle)
+        for i in range(args.missed):
+            chatter.write(Message(username='chatter', content=f'missed {i}').serialize())
+        await asyncio.sleep(args.settle)
+
+        cpu = cpu_seconds(server.pid)
+        started = time.perf_counter()
+        rejoined = await asyncio.gather(*(
+            join(port, f'user{i}', accept.session if resume else None, cursors[i] if resume else None)
+            for i, (_, _, accept, _) in enumerate(users)
+        ))
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(server.pid) - cpu
+        sent = sum(size for _, _, _, size in rejoined)
+        for _, writer, _, _ in rejoined:
+            writer.close()
+        return elapsed, sent, cpu
+    finally:
+        server.terminate()
+        server.wait()
+
+async def main(args):
+    print(f'{"rejoin":>8} {"users":>7} {"all back":>10} {"accept bytes":>14} {"per user":>10} {"server cpu":>11}')
+    for i, resume in enumerate((False, True)):
+        elapsed, sent, cpu = await storm(args, resume, args.port + i)
+        print(f'{"resume" if resume else "fresh":>8} {args.users:>7} {elapsed * 1e3:>8.0f}ms {sent:>14,} '
+              f'{sent / args.users:>10,.0f} {cpu * 1e3:>9.0f}ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18200)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--history', type=int, default=1000, help='messages said before the outage')
+    parser.add_argument('--missed', type=int, default=5, help='messages said during the outage')
+    parser.add_argument('--join-history', type=int, default=100)
+    parser.add_argument('--join-rate', type=float, default=100.0)
+    parser.add_argument('--settle', type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
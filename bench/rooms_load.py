@@ -0,0 +1,111 @@
+""" Many users spread over many rooms: join cost, room fan-out latency and server memory.
+
+    The server runs in a child process; every user joins, moves into room `i % rooms` and leaves
+    the lobby, then each room carries chat traffic that should only reach its own members.
+
+    python bench/rooms_load.py --users 10000 --rooms 1000
+"""
+from common import Message, spawn_server, join, percentile, read_message, rss
+import argparse
+import asyncio
+import random
+import time
+import timeit
+
+class User:
+
+    def __init__(self, name: str, room: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.name = name
+        self.room = room
+        self.reader = reader
+        self.writer = writer
+        self.latencies = []
+        self.misrouted = 0
+        self.joined = asyncio.Event()
+
+    async def receive(self):
+        while (message := await read_message(self.reader)) is not None:
+            if message.is_room_join and message.username == self.name:
+                self.joined.set()
+            elif message.content and message.content.startswith('t='):
+                if message.room != self.room:
+                    self.misrouted += 1
+                self.latencies.append(time.perf_counter() - float(message.content[2:]))
+
+async def connect(port: int, i: int, rooms: int, limit: asyncio.Semaphore, join_latencies: list) -> User:
+    async with limit:
+        started = time.perf_counter()
+        reader, writer = await join(port, f'user{i}')
+        user = User(f'user{i}', f'room{i % rooms}', reader, writer)
+        user.task = asyncio.create_task(user.receive())
+        writer.write(Message(username=user.name, room_join=True, room=user.room, history_limit=0).serialize())
+        writer.write(Message(username=user.name, room_leave=True, room='lobby').serialize())
+        await user.joined.wait()
+        join_latencies.append(time.perf_counter() - started)
+        return user
+
+def lookup_cost(users: int):
+    """ The old per-message username check against the new case-folded index, at `users` users. """
+    names = {f'User{i}': None for i in range(users)}
+    folded = {name.casefold(): None for name in names}
+    old = lambda: 'user1'.lower() in list(map(lambda s: s.lower(), list(names.keys())))
+    new = lambda: 'User1'.casefold() in folded
+    return min(timeit.repeat(old, number=10, repeat=3)) / 10, min(timeit.repeat(new, number=10000, repeat=3)) / 10000
+
+async def main(args):
+    old, new = lookup_cost(args.users)
+    print(f'username check at {args.users:,} users: list scan {old * 1e6:,.1f} us, index {new * 1e9:,.0f} ns')
+
+    process = await spawn_server(
+        args.port, capacity=args.users + 1, max_rooms=args.rooms + 1, join_history=0, queue_size=256,
+        max_connections=args.users + 64, max_connections_per_ip=args.users + 64, join_rate=1e6, join_burst=args.users
+    )
+    base = rss(process.pid)
+    try:
+        limit = asyncio.Semaphore(args.concurrency)
+        join_latencies = []
+        started = time.perf_counter()
+        users = await asyncio.gather(*(connect(args.port, i, args.rooms, limit, join_latencies) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        memory = rss(process.pid)
+        print(f'joined {args.users:,} users into {args.rooms:,} rooms in {elapsed:.1f}s, '
+              f'join+room p50 {percentile(join_latencies, 50) * 1e3:.1f} ms p99 {percentile(join_latencies, 99) * 1e3:.1f} ms')
+        print(f'server rss {memory / 2 ** 20:,.0f} MB ({(memory - base) / args.users / 1024:.1f} KB per user)')
+
+        members = {}
+        for user in users:
+            members.setdefault(user.room, []).append(user)
+        expected = 0
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            for room, group in members.items():
+                sender = random.choice(group)
+                sender.writer.write(Message(username=sender.name, room=room, content=f't={time.perf_counter()}').serialize())
+                expected += len(group)
+            await asyncio.sleep(args.interval)
+        deadline = time.perf_counter() + args.timeout
+        while sum(len(user.latencies) for user in users) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        latencies = [latency for user in users for latency in user.latencies]
+        misrouted = sum(user.misrouted for user in users)
+        print(f'room fan-out: {len(latencies):,}/{expected:,} deliveries in {elapsed:.1f}s '
+              f'({len(latencies) / elapsed:,.0f}/s), misrouted {misrouted}')
+        print(f'delivery latency p50 {percentile(latencies, 50) * 1e3:.1f} ms p95 {percentile(latencies, 95) * 1e3:.1f} ms '
+              f'p99 {percentile(latencies, 99) * 1e3:.1f} ms')
+        for user in users:
+            user.writer.close()
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18020)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=5, help='messages sent into every room')
+    parser.add_argument('--interval', type=float, default=1.0, help='pause between rounds of room messages')
+    parser.add_argument('--concurrency', type=int, default=20, help='joins in flight at once')
+    parser.add_argument('--timeout', type=float, default=60)
+    asyncio.run(main(parser.parse_args()))
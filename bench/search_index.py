@@ -0,0 +1,91 @@
+""" Search index memory and query latency at a million messages, against scanning the history.
+
+    Messages are drawn from a Zipf-like vocabulary, so a few words are in most messages and most
+    words are rare, as in real chat. Memory is the growth in resident memory while indexing, the
+    texts having been generated beforehand; latencies are for one page of results, over many
+    queries of each kind.
+
+    python bench/search_index.py --messages 1000000 --queries 200
+"""
+from common import Message, percentile, rss
+from search import SearchIndex, tokenize
+import argparse
+import gc
+import itertools
+import os
+import random
+import time
+
+def vocabulary(size: int):
+    """ Words and the cumulative weights to draw them with, the word of rank r weighing 1/r. """
+    words = [f'w{i}' for i in range(size)]
+    return words, list(itertools.accumulate(1 / (rank + 1) for rank in range(size)))
+
+def measure(label: str, queries, search) -> None:
+    timings = []
+    hits = 0
+    for query in queries:
+        started = time.perf_counter()
+        results = search(query)
+        timings.append(time.perf_counter() - started)
+        hits += len(results)
+    print(f'{label:<28} {percentile(timings, 50) * 1e6:>10.1f}µs {percentile(timings, 99) * 1e6:>10.1f}µs '
+          f'{hits / len(queries):>8.1f}')
+
+def main(args):
+    rng = random.Random(args.seed)
+    words, cumulative = vocabulary(args.vocabulary)
+    # The texts stand in for the history a scan reads; they are not the index's.
+    texts = [' '.join(rng.choices(words, cum_weights=cumulative, k=rng.randint(3, 15))) for _ in range(args.messages)]
+    users = [f'user{rng.randrange(args.users)}' for _ in range(args.messages)]
+    gc.collect()
+    before = rss(os.getpid())
+    index = SearchIndex(args.messages)
+    started = time.perf_counter()
+    time_ns = 1_700_000_000 * 10 ** 9
+    for sequence, (text, user) in enumerate(zip(texts, users), 1):
+        time_ns += rng.randint(1, 10 ** 9)
+        index.add(Message(username=user, content=text, sequence=sequence, time_ns=time_ns))
+    build = time.perf_counter() - started
+    gc.collect()
+    held = rss(os.getpid()) - before
+    print(f'{args.messages:,} messages indexed in {build:.1f}s ({build / args.messages * 1e6:.1f}µs each), '
+          f'{len(index.postings):,} words, {held / 2 ** 20:.0f} MiB ({held / args.messages:.0f} B/message)')
+
+    first, last = index.times[0], index.times[-1]
+    common = [rng.choice(words[:10]) for _ in range(args.queries)]
+    rare = [rng.choice(words[1000:]) for _ in range(args.queries)]
+    pairs = [f'{rng.choice(words[:50])} {rng.choice(words[50:500])}' for _ in range(args.queries)]
+    print(f'{"query (page of " + str(args.page) + ")":<28} {"p50":>12} {"p99":>12} {"hits":>8}')
+    measure('common word', common, lambda q: index.search(q, limit=args.page)[0])
+    measure('rare word', rare, lambda q: index.search(q, limit=args.page)[0])
+    measure('two words', pairs, lambda q: index.search(q, limit=args.page)[0])
+    measure('common word by user', common, lambda q: index.search(q, author=f'user{rng.randrange(args.users)}', limit=args.page)[0])
+    measure('common word in last hour', common, lambda q: index.search(q, since_ns=last - 3600 * 10 ** 9, limit=args.page)[0])
+    measure('two words, first day', pairs, lambda q: index.search(q, until_ns=first + 86400 * 10 ** 9, limit=args.page)[0])
+    def next_page(query):
+        _, cursor = index.search(query, limit=args.page)
+        return index.search(query, before=cursor, limit=args.page)[0] if cursor else []
+    measure('two words, page 2', pairs, next_page)
+
+    def scan(query):
+        wanted = set(tokenize(query))
+        results = []
+        for sequence in range(len(texts), 0, -1):
+            if wanted.issubset(tokenize(texts[sequence - 1])):
+                results.append(sequence)
+                if len(results) == args.page:
+                    break
+        return results
+    measure('two words, history scan', pairs[:args.scan_queries], scan)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--vocabulary', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--scan-queries', type=int, default=5, help='the scan takes seconds per query at a million')
+    parser.add_argument('--page', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+""" Delivered messages per second as the server runs on 1..N worker processes.
+
+    Client load comes from separate processes so the server is what saturates. Each user sits in
+    one room; a share of them send as fast as the server reads, and every delivered frame is counted.
+    Scaling needs spare cores: the clients take some, so run with --workers up to roughly half of them.
+
+    python bench/workers_scaling.py --workers 1 2 4 --users 400 --rooms 40
+"""
+from common import Message, spawn_server, join
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+async def run_clients(port: int, first: int, count: int, rooms: int, senders: int, start: float, duration: float):
+    users = []
+    for i in range(first, first + count):
+        reader, writer = await join(port, f'user{i}')
+        writer.write(Message(username=f'user{i}', room_join=True, room=f'room{i % rooms}', history_limit=0).serialize())
+        writer.write(Message(username=f'user{i}', room_leave=True, room='lobby').serialize())
+        users.append((i, reader, writer))
+    received = [0]
+    sent = [0]
+
+    async def receive(reader):
+        while time.time() < start:
+            await reader.read(2 ** 16)
+        while (data := await reader.read(2 ** 16)) and time.time() < start + duration:
+            received[0] += data.count(b'\n')
+
+    async def send(i, writer):
+        frame = Message(username=f'user{i}', room=f'room{i % rooms}', content='x' * 100).serialize()
+        await asyncio.sleep(max(0, start - time.time()))
+        while time.time() < start + duration:
+            writer.write(frame)
+            sent[0] += 1
+            await writer.drain()
+
+    tasks = [asyncio.create_task(receive(reader)) for _, reader, _ in users]
+    tasks += [asyncio.create_task(send(i, writer)) for i, _, writer in users[:senders]]
+    await asyncio.sleep(max(0, start + duration - time.time()) + 0.5)
+    for task in tasks:
+        task.cancel()
+    for _, _, writer in users:
+        writer.close()
+    return sent[0], received[0]
+
+def client_process(*args):
+    return asyncio.run(run_clients(*args))
+
+async def measure(port: int, workers: int, args) -> tuple:
+    process = await spawn_server(
+        port, workers=workers, capacity=args.users + 1, max_connections=args.users + 64,
+        max_connections_per_ip=args.users + 64, join_rate=1e6, join_burst=10 ** 6, join_history=0
+    )
+    try:
+        per_process = args.users // args.client_processes
+        senders = max(1, int(per_process * args.senders))
+        start = time.time() + args.warmup
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(args.client_processes) as pool:
+            result = pool.starmap_async(client_process, [
+                (port, n * per_process, per_process, args.rooms, senders, start, args.duration)
+                for n in range(args.client_processes)
+            ])
+            results = await asyncio.get_running_loop().run_in_executor(None, result.get)
+        sent = sum(s for s, _ in results)
+        received = sum(r for _, r in results)
+        return sent / args.duration, received / args.duration
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{os.cpu_count()} CPUs, {args.users} users in {args.rooms} rooms, {args.client_processes} client processes')
+    print(f'{"workers":>8} {"sent/s":>10} {"delivered/s":>12} {"scaling":>8}')
+    baseline = None
+    for i, workers in enumerate(args.workers):
+        sent, delivered = await measure(args.port + i, workers, args)
+        baseline = baseline or delivered
+        print(f'{workers:>8} {sent:>10,.0f} {delivered:>12,.0f} {delivered / baseline:>7.2f}x')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18040)
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--rooms', type=int, default=40)
+    parser.add_argument('--senders', type=float, default=0.25, help='share of users that send')
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds allowed for joining before sending starts')
+    parser.add_argument('--duration', type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
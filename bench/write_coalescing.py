@@ -0,0 +1,92 @@
+""" Server write syscalls and delivery with and without write coalescing, at several message rates.
+
+    One sender posts small messages to the lobby at a fixed rate and every receiver gets each one.
+    Write and read syscall counts come from the server's /proc/<pid>/io, delivery counts from the
+    receivers, and latency from one receiver that decodes everything it gets.
+
+    python bench/write_coalescing.py --rates 100 1000 10000 --receivers 20 --coalesce-ms 2
+"""
+from common import Message, spawn_server, join, read_message, percentile
+import argparse
+import asyncio
+import time
+
+def syscalls(pid: int) -> tuple:
+    with open(f'/proc/{pid}/io') as f:
+        fields = dict(line.split(': ') for line in f.read().splitlines())
+    return int(fields['syscr']), int(fields['syscw'])
+
+async def count(reader: asyncio.StreamReader, counts: list, i: int):
+    while (data := await reader.read(2 ** 16)):
+        counts[i] += data.count(b'\n')
+
+async def probe(reader: asyncio.StreamReader, latencies: list):
+    while (message := await read_message(reader)) is not None:
+        if message.username == 'sender':
+            latencies.append(time.perf_counter() - float(message.content))
+
+async def send(writer: asyncio.StreamWriter, rate: int, duration: float):
+    started = time.perf_counter()
+    sent = 0
+    while (elapsed := time.perf_counter() - started) < duration:
+        due = min(int(elapsed * rate) + 1, int(duration * rate))
+        while sent < due:
+            writer.write(Message(username='sender', content=str(time.perf_counter())).serialize())
+            sent += 1
+        # No drain: past what the server can take, the excess waits in the socket and this buffer.
+        await asyncio.sleep(0.001)
+    return sent
+
+async def measure(port: int, rate: int, coalesce: float, args) -> dict:
+    process = await spawn_server(port, capacity=args.receivers + 2, join_history=0, coalesce_delay=coalesce)
+    try:
+        receivers = [await join(port, f'receiver{i}') for i in range(args.receivers)]
+        probe_reader, probe_writer = await join(port, 'probe')     # Keep the writers: collecting one closes it.
+        sender_reader, writer = await join(port, 'sender')
+        counts = [0] * args.receivers
+        latencies = []
+        tasks = [asyncio.create_task(count(reader, counts, i)) for i, (reader, _) in enumerate(receivers)]
+        tasks.append(asyncio.create_task(probe(probe_reader, latencies)))
+        await asyncio.sleep(0.5)
+        counts[:] = [0] * args.receivers
+        reads, writes = syscalls(process.pid)
+        started = time.perf_counter()
+        sent = await send(writer, rate, args.duration)
+        await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - started
+        reads, writes = (now - before for now, before in zip(syscalls(process.pid), (reads, writes)))
+        for task in tasks:
+            task.cancel()
+        return {
+            'sent/s': sent / args.duration,
+            'delivered/s': sum(counts) / elapsed,
+            'writes/s': writes / elapsed,
+            'reads/s': reads / elapsed,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99)
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    print(f'{args.receivers} receivers, {args.duration}s per run')
+    print(f'{"rate":>7} {"coalesce":>9} {"sent/s":>8} {"delivered/s":>12} {"writes/s":>9} {"reads/s":>8} '
+          f'{"p50 ms":>7} {"p99 ms":>7}')
+    port = args.port
+    for rate in args.rates:
+        for coalesce in (0.0, args.coalesce_ms / 1000):
+            result = await measure(port, rate, coalesce, args)
+            port += 1
+            print(f'{rate:>7,} {"off" if not coalesce else f"{args.coalesce_ms:g} ms":>9} {result["sent/s"]:>8,.0f} '
+                  f'{result["delivered/s"]:>12,.0f} {result["writes/s"]:>9,.0f} {result["reads/s"]:>8,.0f} '
+                  f'{result["p50"] * 1e3:>7.1f} {result["p99"] * 1e3:>7.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18070)
+    parser.add_argument('--rates', type=int, nargs='*', default=[100, 1000, 10000], help='messages/sec sent')
+    parser.add_argument('--receivers', type=int, default=20)
+    parser.add_argument('--coalesce-ms', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=3.0)
+    asyncio.run(main(parser.parse_args()))
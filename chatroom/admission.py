@@ -0,0 +1,31 @@
+from enum import Enum
+import time
+
+class RejectReason(Enum):
+    """ Machine-readable reasons carried in the `reason` field of a join reject. """
+    CAPACITY = 'capacity'               # The server already has `capacity` users.
+    USERNAME_TAKEN = 'username_taken'
+    PER_IP_LIMIT = 'per_ip_limit'       # Too many open connections from the client's address.
+    RATE_LIMITED = 'rate_limited'       # Joins are arriving faster than the join rate limit allows; retry later.
+    INVALID_USERNAME = 'invalid_username'   # The join request named no one.
+
+class TokenBucket:
+    """ Allows bursts of up to `burst` events, refilled at `rate` tokens per second. """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        """ Consume one token if one is available. """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from message import Message
+from typing import Dict, Optional, Tuple
+import hashlib
+import os
+import re
+import tempfile
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+def blob_digest(data: bytes) -> str:
+    """ The name an attachment is stored under: the hex SHA-256 of its bytes. """
+    return hashlib.sha256(data).hexdigest()
+
+def digest_attachment(message: Message) -> Tuple[str, bytes]:
+    """ The digest and decoded bytes of a message's attachment, in one call for the worker pool. """
+    data = message.attachment
+    return blob_digest(data), data
+
+def is_digest(value) -> bool:
+    """ Whether `value` could name a blob, which keeps peer-supplied digests from naming other paths. """
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
+
+def write_blob(path: str, data: bytes):
+    """ Write a blob under a temporary name and move it into place, so readers never see part of one. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+def move_blob(path: str, source: str):
+    """ Move a finished upload from `source` into place as a blob. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(source, path)
+
+class Upload:
+    """ A chunked transfer being written to a temporary file as it arrives, to be stored under the
+        digest of its bytes once complete. The methods touch only the disk, so they can run off the loop. """
+
+    def __init__(self, begin: Message, directory: str):
+        self.begin = begin
+        descriptor, self.path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        self.file = os.fdopen(descriptor, 'w+b')
+        self.size = 0
+
+    def write(self, data: bytes, offset: int):
+        os.pwrite(self.file.fileno(), data, offset)
+        self.size = max(self.size, offset + len(data))
+
+    def finish(self) -> str:
+        """ Close the file and return the digest of what was written. """
+        digest = hashlib.sha256()
+        self.file.seek(0)
+        while (block := self.file.read(1024 * 1024)):
+            digest.update(block)
+        self.file.close()
+        return digest.hexdigest()
+
+    def discard(self):
+        """ Close and remove the file, unless it was moved into the store. """
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class BlobStore:
+    """ Attachments on local disk, named by the digest of their bytes, so a file sent any number of
+        times is kept (and counted against the quota) once.
+
+        A blob is referenced by every history entry that carries its digest. Unreferenced blobs stay
+        until room is needed for new ones within `quota_bytes`, then go least recently used first;
+        referenced ones are never evicted, so a store full of them refuses new blobs instead. """
+
+    def __init__(self, directory: str, quota_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.sizes: Dict[str, int] = {}
+        self.refs: Dict[str, int] = {}
+        self.unreferenced: 'OrderedDict[str, None]' = OrderedDict()    # Least recently used first.
+        self.size_bytes = 0
+        self.unreferenced_bytes = 0
+        self.uploads = os.path.join(directory, 'uploads')  # Chunked transfers still arriving; cleared on start.
+        os.makedirs(self.uploads, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """ Index the blobs already on disk, oldest first, and clear out writes that never finished. """
+        found = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                elif is_digest(entry.name):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, digest, size in sorted(found):
+            self._index(digest, size)
+
+    def _index(self, digest: str, size: int):
+        self.sizes[digest] = size
+        self.size_bytes += size
+        self.unreferenced[digest] = None
+        self.unreferenced_bytes += size
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self.sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def reserve(self, size: int) -> bool:
+        """ Evict unreferenced blobs until `size` more bytes fit within the quota. False if they cannot. """
+        if self.size_bytes - self.unreferenced_bytes + size > self.quota_bytes:
+            return False
+        while self.size_bytes + size > self.quota_bytes:
+            digest, _ = self.unreferenced.popitem(last=False)
+            size_evicted = self.sizes.pop(digest)
+            self.size_bytes -= size_evicted
+            self.unreferenced_bytes -= size_evicted
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def add(self, digest: str, size: int):
+        """ Index a blob about to be written, holding one reference to it for the caller to release. """
+        self._index(digest, size)
+        self.retain(digest)
+
+    def retain(self, digest: str):
+        if digest not in self.sizes:
+            return          # Evicted, or stored by another server; nothing to account for.
+        count = self.refs.get(digest, 0)
+        if not count:
+            self.unreferenced.pop(digest)
+            self.unreferenced_bytes -= self.sizes[digest]
+        self.refs[digest] = count + 1
+
+    def release(self, digest: str):
+        if (count := self.refs.get(digest)) is None:
+            return
+        if count > 1:
+            self.refs[digest] = count - 1
+            return
+        del self.refs[digest]
+        self.unreferenced[digest] = None
+        self.unreferenced_bytes += self.sizes[digest]
+
+    def discard(self, digest: str):
+        """ Forget a blob that could not be written, along with any references to it. """
+        if (size := self.sizes.pop(digest, None)) is None:
+            return
+        self.size_bytes -= size
+        if self.refs.pop(digest, None) is None:
+            self.unreferenced.pop(digest)
+            self.unreferenced_bytes -= size
+
+    def touch(self, digest: str):
+        """ Mark an unreferenced blob as just used, putting it last in line for eviction. """
+        if digest in self.unreferenced:
+            self.unreferenced.move_to_end(digest)
+
+    def read(self, digest: str) -> Optional[bytes]:
+        """ The blob's bytes, or None if it is not stored. Touches only the disk, so it can run off the loop. """
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,185 @@
+from message import Message
+from framing import HEADER, encode_binary, decode_binary
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+import asyncio
+import collections
+import enum
+import logging
+import struct
+
+# Kind (B), Origin Worker (H), Payload Length (I).
+BUS_HEADER = struct.Struct('!BHI')
+# Bus writers only wait for the peer past this much buffered data, so a worker that is briefly
+# descheduled does not stall the hub (and through it every other worker).
+WRITE_BUFFER_HIGH = 8 * 1024 * 1024
+
+class BusKind(enum.IntEnum):
+    HELLO   = 0     # Worker -> hub: registers the worker id. Hub -> workers: every worker is up, start serving.
+    PUBLISH = 1     # A message every worker applies, in the order the hub received them.
+    MEMBER  = 2     # A room join/leave on one worker, forwarded to the others.
+    CLAIM   = 3     # Worker -> hub: reserve a username. Hub -> worker: empty payload, or the reject reason.
+    RELEASE = 4     # A username was released; forwarded to the other workers.
+
+def pack(kind: BusKind, origin: int, payload: bytes) -> bytes:
+    return BUS_HEADER.pack(kind, origin, len(payload)) + payload
+
+def unpack_message(payload: bytes) -> Message:
+    return decode_binary(HEADER.unpack_from(payload), payload[HEADER.size:])
+
+class BusHub:
+    """ The ordering point between worker processes. Every published message goes through this single
+        loop, so all workers apply them in the same order; it also owns the global username table. """
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.workers: Dict[int, asyncio.StreamWriter] = {}
+        self.usernames: Dict[str, int] = {}     # Case-folded username to the worker its user is on.
+        self.registered = asyncio.Condition()
+        self.connections: Set[asyncio.Task] = set()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.serve, path=self.path)
+
+    async def wait_for(self, count: int):
+        """ Wait until `count` workers have said hello. """
+        async with self.registered:
+            await self.registered.wait_for(lambda: len(self.workers) >= count)
+
+    async def close(self):
+        """ Stop listening and wait for every worker connection to wind down. """
+        self.server.close()
+        for writer in self.workers.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    def forward(self, data: bytes, skip: Optional[int] = None):
+        for worker, writer in self.workers.items():
+            if worker != skip and not writer.is_closing():
+                writer.write(data)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                kind, origin, length = BUS_HEADER.unpack(await reader.readexactly(BUS_HEADER.size))
+                payload = await reader.readexactly(length)
+                if kind == BusKind.HELLO:
+                    worker = origin
+                    writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+                    async with self.registered:
+                        self.workers[worker] = writer
+                        self.registered.notify_all()
+                    self.logger.info(f'Worker {worker} Joined The Bus.')
+                elif kind == BusKind.PUBLISH:
+                    self.forward(BUS_HEADER.pack(kind, origin, length) + payload)
+                elif kind == BusKind.MEMBER:
+                    self.forward(BUS_HEADER.pack(kind, origin, length) + payload, skip=origin)
+                elif kind == BusKind.CLAIM:
+                    writer.write(pack(BusKind.CLAIM, 0, self.claim(payload.decode('utf-8'), origin).encode('utf-8')))
+                elif kind == BusKind.RELEASE:
+                    if self.usernames.get(key := payload.decode('utf-8')) == origin:
+                        del self.usernames[key]
+                    self.forward(BUS_HEADER.pack(kind, origin, length) + payload, skip=origin)
+                # Hold the reader back while any worker is slow to take what was forwarded to it.
+                for other in list(self.workers.values()):
+                    await other.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                self.logger.warning(f'Worker {worker} Left The Bus.')
+                del self.workers[worker]
+                for key in [key for key, owner in self.usernames.items() if owner == worker]:
+                    del self.usernames[key]
+                    self.forward(pack(BusKind.RELEASE, worker, key.encode('utf-8')))
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    def claim(self, key: str, worker: int) -> str:
+        if key in self.usernames:
+            return 'username_taken'
+        if len(self.usernames) >= self.capacity:
+            return 'capacity'
+        self.usernames[key] = worker
+        return ''
+
+class BusClient:
+    """ One worker's connection to the hub.
+
+        At most `window` of this worker's publishes may be on their way round the bus at once. Clients'
+        messages are read no faster than the bus hands them back, just as a single process reads no
+        faster than it delivers, instead of this worker flooding the others. """
+
+    def __init__(
+        self,
+        worker: int,
+        on_publish: Callable[[Message], Awaitable[None]],
+        on_member: Callable[[Message], None],
+        on_release: Callable[[str], None],
+        window: int = 256
+    ):
+        self.worker = worker
+        self.window = window
+        self.in_flight = 0
+        self.credit = asyncio.Event()
+        self.on_publish = on_publish
+        self.on_member = on_member
+        self.on_release = on_release
+        self.claims: Deque[asyncio.Future] = collections.deque()
+        self.ready = asyncio.Event()
+
+    async def connect(self, path: str):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.writer.write(pack(BusKind.HELLO, self.worker, b''))
+        self.task = asyncio.create_task(self.receive(), name='Bus')
+
+    async def close(self):
+        self.task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def publish(self, message: Message):
+        while self.in_flight >= self.window:
+            self.credit.clear()
+            await self.credit.wait()
+        self.in_flight += 1
+        self.writer.write(pack(BusKind.PUBLISH, self.worker, encode_binary(message)))
+        await self.writer.drain()
+
+    def member(self, message: Message):
+        self.writer.write(pack(BusKind.MEMBER, self.worker, encode_binary(message)))
+
+    async def claim(self, key: str) -> str:
+        """ Reserve the case-folded username `key` across all workers. Returns '' or the reject reason. """
+        future = asyncio.get_running_loop().create_future()
+        self.claims.append(future)
+        self.writer.write(pack(BusKind.CLAIM, self.worker, key.encode('utf-8')))
+        return await future
+
+    def release(self, key: str):
+        self.writer.write(pack(BusKind.RELEASE, self.worker, key.encode('utf-8')))
+
+    async def receive(self):
+        while True:
+            kind, origin, length = BUS_HEADER.unpack(await self.reader.readexactly(BUS_HEADER.size))
+            payload = await self.reader.readexactly(length)
+            if kind == BusKind.HELLO:
+                self.ready.set()
+            elif kind == BusKind.PUBLISH:
+                await self.on_publish(unpack_message(payload))
+                if origin == self.worker:
+                    self.in_flight -= 1
+                    self.credit.set()
+            elif kind == BusKind.MEMBER:
+                self.on_member(unpack_message(payload))
+            elif kind == BusKind.CLAIM:
+                self.claims.popleft().set_result(payload.decode('utf-8'))
+            elif kind == BusKind.RELEASE:
+                self.on_release(payload.decode('utf-8'))
@@ -0,0 +1,53 @@
+from typing import Iterator, Tuple
+import itertools
+import struct
+import time
+
+MAGIC = b'CHATCAP1'
+# Connection Id (I), time.monotonic_ns() When Read (Q), Data Length (I). A record with no data marks
+# the end of the connection.
+RECORD = struct.Struct('!IQI')
+
+class Recorder:
+    """ Writes what the server reads from its clients to a capture file, for bench/capture_replay.py to
+        drive a fresh server with. Records are appended through a large buffer, so recording a frame is
+        a copy rather than a write, and the file is complete once the recorder is closed.
+
+        The time is the monotonic clock, which every process on the host shares, so the captures of
+        several workers can be merged into one timeline. """
+
+    def __init__(self, path: str, buffer_size: int = 1024 * 1024):
+        self.path = path
+        self._file = open(path, 'wb', buffering=buffer_size)
+        self._file.write(MAGIC)
+        self._ids = itertools.count(1)
+        self.records = 0
+
+    def open(self) -> int:
+        """ An id for a new connection's records. """
+        return next(self._ids)
+
+    def record(self, connection_id: int, data: bytes):
+        """ Record `data` as read from the connection `connection_id` just now. """
+        self._file.write(RECORD.pack(connection_id, time.monotonic_ns(), len(data)))
+        self._file.write(data)
+        self.records += 1
+
+    def end(self, connection_id: int):
+        """ Record that the server has stopped reading the connection `connection_id`. """
+        self._file.write(RECORD.pack(connection_id, time.monotonic_ns(), 0))
+
+    def close(self):
+        self._file.close()
+
+def read_capture(path: str) -> Iterator[Tuple[int, int, bytes]]:
+    """ Yield (connection id, time in ns, data) for each record of a capture file, with empty data
+        for the end of a connection. A record cut short at the end of the file is ignored. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} Is Not A Capture File.')
+        while len(header := f.read(RECORD.size)) == RECORD.size:
+            connection_id, time_ns, length = RECORD.unpack(header)
+            if len(data := f.read(length)) < length:
+                return
+            yield connection_id, time_ns, data
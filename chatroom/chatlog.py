@@ -0,0 +1,250 @@
+from array import array
+from concurrent.futures import Executor, Future
+from typing import BinaryIO, Iterator, List, Optional
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# Sequence (Q), Payload Length (I), CRC32 of Payload (I). The payload is the message's JSON frame.
+RECORD = struct.Struct('!QII')
+# Sequence (Q), Position Within The Segment (Q).
+INDEX_ENTRY = struct.Struct('!QQ')
+
+def fsync_descriptor(fd: int):
+    """ Make everything written through `fd` durable, then close it. """
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Segment:
+    """ One file of the chat log, holding records from `base` onwards, plus its sparse offset index. """
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.index_path = os.path.join(directory, f'{base:020d}.index')
+        self.sequences = array('Q')
+        self.positions = array('Q')
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.last_sequence = base - 1
+        self._map: Optional[mmap.mmap] = None
+
+    def load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            for sequence, position in INDEX_ENTRY.iter_unpack(data):
+                if position >= self.size:
+                    break
+                self.sequences.append(sequence)
+                self.positions.append(position)
+
+    def view(self, end: int) -> memoryview:
+        """ A read-only view of the segment that covers at least the first `end` bytes. """
+        if self._map is None or len(self._map) < end:
+            with open(self.path, 'rb') as f:
+                # Any previous map is left to be closed once views handed out from it are released.
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def seek(self, sequence: int) -> int:
+        """ The position of the last indexed record at or before `sequence`. """
+        i = bisect.bisect_right(self.sequences, sequence) - 1
+        return self.positions[i] if i >= 0 else 0
+
+    def scan(self, position: int, end: int) -> Iterator[tuple]:
+        """ Walk record headers from `position`, yielding (sequence, payload start, payload length, crc).
+            Stops at the first record that runs past `end`. """
+        if end <= position:
+            return
+        view = self.view(end)
+        while position + RECORD.size <= end:
+            sequence, length, crc = RECORD.unpack_from(view, position)
+            start = position + RECORD.size
+            if start + length > end:
+                return
+            yield sequence, start, length, crc
+            position = start + length
+
+class ChatLog:
+    """ An append-only, segmented on-disk log of broadcast frames.
+
+        Appends are buffered and fsynced in batches. Each segment keeps a sparse index of sequence
+        numbers to file positions, so recovery only memory-maps segments and loads their indexes;
+        nothing is decoded into Message objects. Ranges are served as views into the mapped files.
+        A `read_only` log never modifies the files, even to cut off a torn tail; it ignores the tail instead.
+        Given an `executor`, batches are fsynced there rather than by the appending thread. """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 256 * 1024 * 1024,
+        index_interval: int = 64 * 1024,
+        fsync_interval: float = 0.05,
+        fsync_batch: int = 256,
+        read_only: bool = False,
+        executor: Optional[Executor] = None
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.read_only = read_only
+        self.executor = executor
+        self._fsync: Optional[Future] = None    # The last fsync handed to the executor.
+        self.segments: List[Segment] = []
+        self._bases: List[int] = []
+        self._file: Optional[BinaryIO] = None
+        self._index_file: Optional[BinaryIO] = None
+        self._last_indexed = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    @property
+    def first_sequence(self) -> int:
+        return self.segments[0].base if self.segments else 1
+
+    @property
+    def last_sequence(self) -> int:
+        """ The newest sequence number in the log, or 0 if it is empty. """
+        return self.segments[-1].last_sequence if self.segments else 0
+
+    def _recover(self):
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        for base in bases:
+            segment = Segment(self.directory, base)
+            segment.load_index()
+            self.segments.append(segment)
+            self._bases.append(base)
+        for i, segment in enumerate(self.segments):
+            if i + 1 < len(self.segments):
+                segment.last_sequence = self.segments[i + 1].base - 1
+        if self.segments:
+            self._recover_tail(self.segments[-1])
+            if not self.read_only:
+                self._open_active(self.segments[-1])
+
+    def _recover_tail(self, segment: Segment):
+        """ Validate the records after the last index entry of the newest segment and cut off a torn tail. """
+        dropped_index = False
+        while True:
+            position = segment.positions[-1] if segment.positions else 0
+            valid_end = position
+            if segment.size > position:
+                view = segment.view(segment.size)
+                for sequence, start, length, crc in segment.scan(position, segment.size):
+                    if zlib.crc32(view[start:start + length]) != crc:
+                        break
+                    segment.last_sequence = sequence
+                    valid_end = start + length
+                del view
+            if valid_end > position or not segment.positions:
+                break
+            # The indexed record itself is torn; fall back to the previous index entry.
+            segment.sequences.pop()
+            segment.positions.pop()
+            dropped_index = True
+        if self.read_only:
+            segment.size = valid_end
+            return
+        if valid_end < segment.size:
+            if segment._map is not None:
+                segment._map.close()
+                segment._map = None
+            with open(segment.path, 'r+b') as f:
+                f.truncate(valid_end)
+            segment.size = valid_end
+        if dropped_index:
+            with open(segment.index_path, 'wb') as f:
+                for sequence, position in zip(segment.sequences, segment.positions):
+                    f.write(INDEX_ENTRY.pack(sequence, position))
+
+    def _open_active(self, segment: Segment):
+        if self._file is not None:
+            self._sync_files()
+            self._file.close()
+            self._index_file.close()
+        self._file = open(segment.path, 'ab')
+        self._index_file = open(segment.index_path, 'ab')
+        self._last_indexed = segment.positions[-1] if segment.positions else -self.index_interval
+
+    def append(self, sequence: int, payload: bytes):
+        """ Append one record. It becomes durable at the next batched fsync. """
+        if not self.segments or self.segments[-1].size >= self.segment_bytes:
+            segment = Segment(self.directory, sequence)
+            self.segments.append(segment)
+            self._bases.append(sequence)
+            self._open_active(segment)
+        segment = self.segments[-1]
+        position = segment.size
+        if position - self._last_indexed >= self.index_interval:
+            segment.sequences.append(sequence)
+            segment.positions.append(position)
+            self._index_file.write(INDEX_ENTRY.pack(sequence, position))
+            self._last_indexed = position
+        self._file.write(RECORD.pack(sequence, len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        segment.size += RECORD.size + len(payload)
+        segment.last_sequence = sequence
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def _sync_files(self):
+        self._file.flush()
+        self._index_file.flush()
+        os.fsync(self._file.fileno())
+
+    def sync(self):
+        """ Flush everything appended so far and fsync it, in the executor if there is one. The descriptor
+            handed over is a duplicate, so rolling over to a new segment does not close it mid-sync. """
+        if self._fsync is not None and self._fsync.done():
+            self._fsync, previous = None, self._fsync
+            previous.result()   # Raises what it failed with, as an inline fsync would have.
+        if self._file is not None and self._unsynced:
+            if self.executor is None:
+                self._sync_files()
+            else:
+                self._file.flush()
+                self._index_file.flush()
+                self._fsync = self.executor.submit(fsync_descriptor, os.dup(self._file.fileno()))
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def read(self, first: int, limit: Optional[int] = None) -> Iterator[memoryview]:
+        """ Yield the stored frames of records with sequence >= `first`, oldest first, as views into the mapped segments. """
+        if self._file is not None:
+            self._file.flush()
+        first = max(first, self.first_sequence)
+        remaining = limit if limit is not None else -1
+        i = max(0, bisect.bisect_right(self._bases, first) - 1)
+        for segment in self.segments[i:]:
+            if segment.last_sequence < first or segment.size == 0:
+                continue
+            view = segment.view(segment.size)
+            for sequence, start, length, crc in segment.scan(segment.seek(first), segment.size):
+                if sequence < first:
+                    continue
+                if remaining == 0:
+                    return
+                remaining -= 1
+                yield view[start:start + length]
+
+    def tail(self, count: int) -> Iterator[memoryview]:
+        """ The newest `count` stored frames. """
+        return self.read(max(self.first_sequence, self.last_sequence - count + 1), count)
+
+    def close(self):
+        if self._file is not None:
+            self._sync_files()
+            self._file.close()
+            self._index_file.close()
+            self._file = self._index_file = None
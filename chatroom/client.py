@@ -1,20 +1,76 @@
 from server_address import ServerAddress
-from message import Message, MessageDecoder
+from message import Message
+from framing import Framing
+from loops import LoopBackend
+from compressor import Codec
+from pool import PoolKind, WorkerPool
+from sdk import ChatClient, JoinRejected, room_key
+from typing import BinaryIO, Coroutine, Dict, List, Optional, Set
+import argparse
 import threading
 import asyncio
-import json
+import compressor
+import loops
 import os
-import base64
+import shutil
+
+BLOB_CACHE = 'downloads/.blobs'   # Fetched attachments by digest, so a file sent again is not fetched again.
+
+def save(path: str, data: bytes):
+    with open(path, 'wb+') as f:
+        f.write(data)
+
+def place(cached: str, path: str):
+    """ Put a cached attachment at `path`, linked rather than copied where the filesystem allows. """
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        os.link(cached, path)
+    except OSError:
+        shutil.copyfile(cached, path)
 
 class ChatroomClient:
+    """ The interactive client: a terminal over a ChatClient, which does all the talking to the server. """
+
+    def __init__(
+        self,
+        server_address: ServerAddress = ServerAddress(),
+        framing: Framing = Framing.JSON,
+        compression: List[Codec] = ()
+    ):
+        # Attachment encoding and decoding and file I/O run here, so a big file does not stall the connection.
+        self.pool = WorkerPool(PoolKind.THREAD)
+        self.client = ChatClient(server_address, framing, compression, pool=self.pool)
+        self.room = None        # The room new messages are sent to; None is the default room.
+        self.downloads: Dict[str, BinaryIO] = {}
+        self.input_thread: Optional[threading.Thread] = None
+        self.quitting = False
+        self.fetching: Dict[str, List[str]] = {}   # Filenames waiting on each blob requested, by digest.
+        self.fetches: Set[asyncio.Task] = set()     # Held until done, since the loop keeps only weak references to tasks.
+        self.attachments: Dict[str, str] = {}       # Digest of the newest attachment seen with each filename.
+        self.last_search: Optional[Message] = None  # Repeated with the result's cursor by `:more`.
+        self.client.on('join_accept', self.accepted)
+        self.client.on('join_reject', self.display)
+        self.client.on('join_announce', self.display)
+        self.client.on('chat', self.display)
+        self.client.on('direct', self.display)
+        self.client.on('quit_accept', lambda message: print(message.content))
+        for kind in ('transfer_begin', 'transfer_chunk', 'transfer_end'):
+            self.client.on(kind, self.receive_transfer)
+        self.client.on('search_result', self.show_search)
+        self.client.on('history_end', self.show_history_end)
+        self.client.on('room_join', self.show_room)
+        self.client.on('room_leave', self.show_room)
+        self.client.on('room_list', lambda message: print(message.content, end=''))
+        self.client.on('reconnecting', lambda delay: print(f'---- Connection Lost. Reconnecting In {delay:.1f}s ----'))
+
+    @property
+    def username(self) -> Optional[str]:
+        return self.client.username
 
-    def __init__(self, server_address: ServerAddress = ServerAddress()):
-        self.server_addr: ServerAddress = server_address
-        self.isConnected: bool = False
-        self.reader: asyncio.StreamReader = None
-        self.writer: asyncio.StreamWriter = None
-        self.username = None
-        self.loop = asyncio.get_event_loop()
+    @property
+    def isConnected(self) -> bool:
+        return self.client.joined
 
     async def run(self):
         while not self.isConnected:
@@ -33,101 +89,219 @@ class ChatroomClient:
                 self.displayMenu()
             elif selection == 3: exit(0)
             elif selection == 1:
-                initial_message = Message()
-                initial_message.is_status_request = True
-                await self.connect(initial_message)
+                await self.show_status()
             elif selection == 2:
                 username = input("Please enter your desired username: ")
                 if len(username) <= 0: print("A username is required to join the chatroom.");
-                initial_message = Message()
-                initial_message.is_join_request = True
-                initial_message.username = username.strip()
-                await self.connect(initial_message)
+                await self.connect(username.strip())
         except KeyboardInterrupt:
             print("\nForce Exitting!"); exit(1)
-    
-    async def connect(self, initial_message: Message):
-        self.reader, self.writer = await asyncio.open_connection(
-            host=self.server_addr.host,
-            port=self.server_addr.port
-        )
-        self.writer.write(initial_message.serialize())
-        await self.writer.drain()
-        await self.listener()
-
-    async def disconnect(self):
-        print('Goodbye :)')
-        self.writer.close()
-        await self.writer.wait_closed()
-        self.writer = None
-        self.reader = None
-        self.username = None
-        self.isConnected = False
-        exit(0);
-    
-    async def listener(self):
-        while True:
-            data = (await self.reader.readline()).decode('utf-8')
-            if not (data): return
-            message = json.loads(data, cls=MessageDecoder)
-            await self.process(message)
-    
+
+    async def show_status(self):
+        try:
+            message = await self.client.status()
+        except OSError as error:
+            print(f'Could Not Reach The Server: {error}')
+            return
+        print(f'There Is {message.user_count} Active User(s) in the Chat Room.')
+        print(message.content)
+        if (stats := message.stats):
+            fanout = stats['fanout_seconds']
+            print(f'{stats["messages_received"]} Messages Received, {stats["frames_sent"]} Frames Sent, '
+                  f'{stats["frames_dropped"]} Dropped. Broadcast Fan-Out p50 {fanout["p50"] * 1e3:.2f} ms, '
+                  f'p99 {fanout["p99"] * 1e3:.2f} ms. {stats["history_messages"]} Messages In History.')
+
+    async def connect(self, username: str):
+        """ Join as `username` and stay until the user quits, or the client gives up on a dropped connection. """
+        try:
+            await self.client.join(username)
+        except JoinRejected:
+            return          # Shown by `display`.
+        except OSError as error:
+            print(f'Could Not Reach The Server: {error}')
+            return
+        await self.client.wait_closed()
+        if self.quitting:
+            print('Goodbye :)')
+            exit(0)
+
+    async def accepted(self, message: Message):
+        await self.display(message)
+        if self.input_thread is not None:
+            print('---- Reconnected ----')
+            return
+        self.input_thread = threading.Thread(target=self.user_input)
+        self.input_thread.daemon = True
+        self.input_thread.start()
+
+    def submit(self, coroutine: Coroutine):
+        """ Run `coroutine` on the client's loop, from the input thread. """
+        asyncio.run_coroutine_threadsafe(coroutine, self.client.loop)
+
     def user_input(self):
         while True:
             try:
                 content = input('')
-                message = Message(username = self.username)
+                message = Message(username = self.username, room = self.room)
+                command = content.strip().lower().split(' ')[0]
                 if content.strip().lower() == ':q':
-                    message.is_quit_request = True
+                    self.quitting = True
+                    self.submit(self.client.quit())
+                    continue
+                elif command in (':j', ':l') and (room := content.strip()[2:].strip()):
+                    message.room = room
+                    message.is_room_join = command == ':j'
+                    message.is_room_leave = command == ':l'
+                elif command == ':rooms':
+                    message.is_room_list = True
+                elif content.strip().lower().split(' ')[0] == ':h':
+                    count = content.strip()[2:].strip()
+                    self.submit(self.client.history(self.room, int(count) if count.isdigit() else None))
+                    continue
+                elif command == ':dm':
+                    # `:dm user[,user...] text` sends to those users alone; `:dm` on its own replays them.
+                    if len(words := content.strip()[3:].split(None, 1)) < 2:
+                        self.submit(self.client.direct_history())
+                        continue
+                    message.room = None
+                    message.recipients = [name.lstrip('@') for name in words[0].split(',') if name.lstrip('@')]
+                    message.content = words[1]
+                elif command == ':s' and (words := content.strip()[2:].split()):
+                    # `:s [@user] words...` searches the current room, newest first.
+                    message.is_search_request = True
+                    if words[0].startswith('@'):
+                        message.author = words.pop(0)[1:]
+                    message.content = ' '.join(words)
+                    self.last_search = message
+                elif command == ':more':
+                    if self.last_search is None or self.last_search.cursor is None:
+                        continue
+                    message = self.last_search
+                elif command == ':get' and (digest := self.attachments.get(content.strip()[4:].strip())):
+                    self.submit(self.fetch(digest, content.strip()[4:].strip()))
+                    continue
                 elif content.strip().lower().startswith(':a '):
                     if (filename := content.strip()[3:]) and os.path.exists(filename):
-                        with open(filename, 'rb') as f:
-                            message.content = base64.b64encode(f.read()).decode()
-                            message.filename = os.path.basename(filename)
+                        self.submit(self.client.send_file(filename))
+                        continue
                     else:
                         message.content = content
                 else:
                     message.content = content.strip()
-                self.writer.write(message.serialize())
-                asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop)
+                self.client.send_threadsafe(message)
             except KeyboardInterrupt:
                 pass
 
-    async def process(self, message: Message):
-        if message.is_status_response:
-            print(f'There Is {message.user_count} Active User(s) in the Chat Room.')
-            print(message.content)
-        elif message.is_join_accept:
-            self.username = message.username
-            self.isConnected = True
-            await self.display(message)
-            input_thread = threading.Thread(target=self.user_input)
-            input_thread.daemon = True
-            input_thread.start()
-        elif message.is_join_reject:
-            await self.display(message)
-        elif message.is_quit_accept:
-            print(message.content)
-            if message.username == self.username: await self.disconnect()
-        else:
-            await self.display(message)
+    async def receive_transfer(self, message: Message):
+        """ Write an incoming chunked transfer to `downloads/` as it arrives. """
+        if message.is_transfer_begin:
+            print(f'[{message.timestamp}] @{message.username}: * is sending an attachment: `{message.filename}` ({message.total_size} bytes) *')
+            if message.username == self.username:
+                return
+            os.makedirs('downloads', exist_ok=True)
+            path = f'downloads/{os.path.basename(message.filename)}'
+            resume = bool(message.offset) and os.path.exists(path)
+            self.downloads[message.transfer_id] = await self.pool.io(open, path, 'r+b' if resume else 'wb')
+        elif (f := self.downloads.get(message.transfer_id)) is None:
+            return
+        elif message.is_transfer_chunk:
+            data = await self.client.attachment(message)
+            # Not waited for: the I/O thread writes chunks in order while the next ones are read.
+            await self.pool.queue_io(os.pwrite, f.fileno(), data, message.offset)
+        elif message.is_transfer_end:
+            self.downloads.pop(message.transfer_id)
+            await self.pool.io(f.close)
+            print(f'----\nAttachment Saved To `{f.name}`\n----')
+
+    async def fetch(self, digest: str, filename: str):
+        """ Save the stored attachment `digest` to `downloads/filename`, asking the server for it unless it is cached. """
+        cached = os.path.join(BLOB_CACHE, digest)
+        if os.path.exists(cached):
+            await self.pool.io(place, cached, f'downloads/{os.path.basename(filename)}')
+            print(f'----\nAttachment Saved To `downloads/{os.path.basename(filename)}` (Cached)\n----')
+            return
+        waiting = self.fetching.setdefault(digest, [])
+        waiting.append(filename)
+        if len(waiting) > 1:
+            return
+        try:
+            data = await self.client.fetch(digest)
+            problem = 'Is No Longer On The Server' if data is None else None
+        except ValueError:
+            problem = 'Arrived Corrupted'
+        except OSError:
+            problem = 'Was Not Received Before The Connection Dropped'
+        filenames = self.fetching.pop(digest, [])
+        if problem is not None:
+            print(f'----\nAttachment {", ".join(f"`{name}`" for name in filenames)} {problem}\n----')
+            return
+        os.makedirs(BLOB_CACHE, exist_ok=True)
+        await self.pool.io(save, cached, data)
+        for filename in filenames:
+            await self.pool.io(place, cached, f'downloads/{os.path.basename(filename)}')
+            print(f'----\nAttachment Saved To `downloads/{os.path.basename(filename)}`\n----')
+        print(f'----\nFile Contents\n----\n{data.decode(errors="replace")}')
+
+    def show_search(self, message: Message):
+        print(message.content or '---- No Matches ----\n', end='')
+        if self.last_search is not None:
+            self.last_search.cursor = message.cursor
+        if message.cursor is not None:
+            print('---- `:more` For Older Matches ----')
+
+    def show_history_end(self, message: Message):
+        if message.content:
+            print(message.content, end='')  # The join history, when it follows a compressed join accept.
+        print('---- End Of History ----')
+
+    def show_room(self, message: Message):
+        if message.username == self.username:
+            self.room = message.room if message.is_room_join else None
+            print(f'---- Now Chatting In #{self.room or "lobby"} ----')
+        print(message.content, end='' if message.content.endswith('\n') else '\n')
 
     async def display(self, message: Message):
         if message.is_join_accept:
-            self.username = message.username
-            print(message.content) # Print Server's Pre-Formatted Chat History.
+            if message.content is not None:
+                print(message.content) # Print Server's Pre-Formatted Chat History.
+        elif message.digest is not None:
+            # Only a reference: the file is fetched when it is new, and not while replaying history.
+            print(f'[{message.timestamp}] @{message.username}: * sent an attachment: `{message.filename}` ({message.total_size} bytes) *')
+            self.attachments[message.filename] = message.digest
+            if room_key(message.room) in self.client.replaying:
+                print(f'---- `:get {message.filename}` To Download ----')
+            elif message.username != self.username:
+                os.makedirs('downloads', exist_ok=True)
+                # A task of its own: the reply it waits for comes through the handler calling this one.
+                task = asyncio.create_task(self.fetch(message.digest, message.filename))
+                self.fetches.add(task)
+                task.add_done_callback(self.fetches.discard)
         elif message.filename is not None:
-            file_contents = base64.b64decode(message.content)
+            file_contents = await self.client.attachment(message)
             print(f'[{message.timestamp}] @{message.username}: * sent an attachment: `{message.filename}` *')
             if message.username != self.username:
-                with open(f'downloads/{message.filename}', 'wb+') as f:
-                    f.write(file_contents)
-                    print(f'----\nAttachment Saved To `downloads/{message.filename}`\n----')
+                os.makedirs('downloads', exist_ok=True)
+                await self.pool.io(save, f'downloads/{message.filename}', file_contents)
+                print(f'----\nAttachment Saved To `downloads/{message.filename}`\n----')
             print(f'----\nFile Contents\n----\n{file_contents.decode()}')
+        elif message.recipients is not None:
+            recipients = ', '.join(f'@{name}' for name in message.recipients)
+            print(f'[{message.timestamp}] @{message.username} -> {recipients}: {message.content}')
         else:
             # Format The Message Ourself.
-            print(f'[{message.timestamp}] @{message.username}: {message.content}')
+            room = f'#{message.room} ' if message.room else ''
+            print(f'{room}[{message.timestamp}] @{message.username}: {message.content}')
 
 if __name__ == '__main__':
-    client = ChatroomClient()
-    asyncio.run(client.run())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run the chatroom client.')
+    parser.add_argument('--host', default=ServerAddress().host)
+    parser.add_argument('--port', type=int, default=ServerAddress().port)
+    parser.add_argument('--loop', default=LoopBackend.AUTO.value, choices=[backend.value for backend in LoopBackend],
+                        help='event loop backend; auto picks uvloop when it is installed')
+    parser.add_argument('--compression', default='auto', choices=['auto', 'none'] + [codec.value for codec in Codec],
+                        help='codec to ask the server for; auto offers every available codec')
+    args = parser.parse_args()
+    compression = compressor.available() if args.compression == 'auto' else \
+        [] if args.compression == 'none' else [Codec(args.compression)]
+    client = ChatroomClient(ServerAddress(args.host, args.port), compression=compression)
+    loops.run(client.run(), LoopBackend(args.loop))
\ No newline at end of file
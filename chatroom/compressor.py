@@ -0,0 +1,171 @@
+from typing import Dict, Iterable, List, Optional
+import enum
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class Codec(enum.Enum):
+    """ A compression codec a client can ask for in its join request. """
+    ZLIB    = 'zlib'
+    ZSTD    = 'zstd'        # Needs the zstandard package.
+
+class Envelope(enum.IntEnum):
+    """ The kind of an enveloped frame. Once a connection negotiates compression, everything the server
+        sends on it is enveloped. None of these bytes can start a JSON or a binary frame, so a client can
+        tell from the first byte it receives whether the server agreed. """
+    RAW         = 0xF8      # A frame too small to be worth compressing on its own.
+    ZLIB        = 0xF9      # A frame compressed on its own, once for all of its recipients.
+    ZSTD        = 0xFA
+    ZLIB_STREAM = 0xFB      # Frames compressed with the connection's context, continuing the ones before.
+    ZSTD_STREAM = 0xFC
+
+# Kind (B), Length (I) of what follows.
+ENVELOPE = struct.Struct('!BI')
+
+FRAME_KIND  = {Codec.ZLIB: Envelope.ZLIB, Codec.ZSTD: Envelope.ZSTD}
+STREAM_KIND = {Codec.ZLIB: Envelope.ZLIB_STREAM, Codec.ZSTD: Envelope.ZSTD_STREAM}
+
+# Stream contexts live as long as their connection, so they get a small window and tables: tens of KiB
+# each rather than the hundreds (zlib) or megabytes (zstd) the defaults take.
+STREAM_WBITS    = -12       # Raw deflate, 4 KiB window.
+STREAM_MEMLEVEL = 5
+STREAM_WINDOW_LOG = 14
+
+_ERRORS = (ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+_zstd_compressors: Dict[Optional[int], 'zstandard.ZstdCompressor'] = {}
+
+def available() -> List[Codec]:
+    """ The codecs that can be used in this environment, preferred first. """
+    return ([Codec.ZSTD] if zstandard is not None else []) + [Codec.ZLIB]
+
+def negotiate(offered: Optional[str], allowed: Iterable[Codec]) -> Optional[Codec]:
+    """ The first codec in a join request's comma separated `offered` list that is allowed and available. """
+    usable = set(allowed) & set(available())
+    for name in (offered or '').split(','):
+        try:
+            codec = Codec(name.strip())
+        except ValueError:
+            continue
+        if codec in usable:
+            return codec
+    return None
+
+def envelope(kind: Envelope, data: bytes) -> bytes:
+    return ENVELOPE.pack(kind, len(data)) + data
+
+def compress(codec: Codec, data: bytes, level: Optional[int] = None) -> bytes:
+    """ `data` compressed on its own and enveloped, or enveloped as it is if that is no smaller. """
+    if codec is Codec.ZSTD:
+        if (compressor := _zstd_compressors.get(level)) is None:
+            compressor = _zstd_compressors[level] = zstandard.ZstdCompressor(level=level if level is not None else 3)
+        body = compressor.compress(data)
+    else:
+        body = zlib.compress(data, level if level is not None else 6)
+    if len(body) >= len(data):
+        return envelope(Envelope.RAW, data)
+    return envelope(FRAME_KIND[codec], body)
+
+def seal(codec: Codec, data: bytes, threshold: int, level: Optional[int] = None) -> bytes:
+    """ `data` enveloped for a connection using `codec`: compressed on its own if it reaches `threshold`. """
+    if len(data) < threshold:
+        return envelope(Envelope.RAW, data)
+    return compress(codec, data, level)
+
+class StreamCompressor:
+    """ A connection's compression context. Each call continues the stream, so chat text that repeats
+        across frames (field names, usernames, phrases) compresses against what was sent before. """
+
+    def __init__(self, codec: Codec, level: Optional[int] = None):
+        self.kind = STREAM_KIND[codec]
+        if codec is Codec.ZSTD:
+            parameters = zstandard.ZstdCompressionParameters.from_level(
+                level if level is not None else 3, window_log=STREAM_WINDOW_LOG
+            )
+            self._context = zstandard.ZstdCompressor(compression_params=parameters).compressobj()
+            self._mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._context = zlib.compressobj(
+                level if level is not None else 6, zlib.DEFLATED, STREAM_WBITS, STREAM_MEMLEVEL
+            )
+            self._mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, frames: List[memoryview]) -> bytes:
+        """ One envelope holding `frames`, flushed so the peer can decode them without waiting for more. """
+        body = b''.join([self._context.compress(frame) for frame in frames]) + self._context.flush(self._mode)
+        return envelope(self.kind, body)
+
+class Compression:
+    """ What a connection negotiated. Frames of at least `threshold` bytes are compressed on their own,
+        once for every connection that shares them; with a `stream`, the smaller ones go through it. """
+
+    __slots__ = ('codec', 'threshold', 'level', 'stream')
+
+    def __init__(self, codec: Codec, threshold: int, level: Optional[int] = None, stream: bool = False):
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.stream = StreamCompressor(codec, level) if stream else None
+
+    def pack(self, pending: List[memoryview]) -> List[memoryview]:
+        """ Replace each run of frames still to be stream compressed with a single envelope. """
+        packed: List[memoryview] = []
+        run: List[memoryview] = []
+        for data in pending:
+            if data[0] < Envelope.RAW:
+                run.append(data)
+                continue
+            if run:
+                packed.append(memoryview(self.stream.compress(run)))
+                run = []
+            packed.append(data)
+        if run:
+            packed.append(memoryview(self.stream.compress(run)))
+        return packed
+
+class Inflater:
+    """ The client side: turns what the server sends back into plain frames. Passes everything through
+        unchanged if the first byte received shows the server did not envelope its frames. """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.enveloped: Optional[bool] = None
+        self._streams = {}
+
+    def feed(self, data: bytes) -> bytes:
+        """ The plain frames in the complete envelopes received so far. Raises ValueError on a bad envelope. """
+        if self.enveloped is None and data:
+            self.enveloped = data[0] >= Envelope.RAW
+        if not self.enveloped:
+            return data
+        self.buffer += data
+        plain = []
+        offset = 0
+        while len(self.buffer) - offset >= ENVELOPE.size:
+            kind, length = ENVELOPE.unpack_from(self.buffer, offset)
+            end = offset + ENVELOPE.size + length
+            if end > len(self.buffer):
+                break
+            try:
+                plain.append(self._open(Envelope(kind), bytes(self.buffer[offset + ENVELOPE.size:end])))
+            except _ERRORS as error:
+                raise ValueError(f'Bad Envelope: {error}') from error
+            offset = end
+        del self.buffer[:offset]
+        return b''.join(plain)
+
+    def _open(self, kind: Envelope, body: bytes) -> bytes:
+        if kind is Envelope.RAW:
+            return body
+        if kind is Envelope.ZLIB:
+            return zlib.decompress(body)
+        if kind is Envelope.ZSTD:
+            return zstandard.ZstdDecompressor().decompress(body)
+        if (stream := self._streams.get(kind)) is None:
+            stream = self._streams[kind] = zlib.decompressobj(STREAM_WBITS) if kind is Envelope.ZLIB_STREAM \
+                else zstandard.ZstdDecompressor().decompressobj()
+        return stream.decompress(body)
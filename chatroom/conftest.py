@@ -0,0 +1,47 @@
+from typing import AsyncIterator, Tuple
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+
+# The modules import each other by bare name, as when run from this directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from framing import read_message
+from message import Message
+from server import ChatroomServer
+from server_address import ServerAddress
+from server_config import ServerConfig
+
+@contextlib.asynccontextmanager
+async def running_server(**config) -> AsyncIterator[Tuple[ChatroomServer, int]]:
+    """ A server with ServerConfig(**config) listening on a free local port, stopped on exit. """
+    config.setdefault('log_level', logging.WARNING)
+    server = ChatroomServer(ServerAddress('127.0.0.1', 0), ServerConfig(**config))
+    task = asyncio.create_task(server.serve())
+    while not hasattr(server, 'server'):
+        await asyncio.sleep(0.01)
+    try:
+        yield server, server.server.getsockname()[1]
+    finally:
+        server.stop()
+        await task
+
+async def connect(port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    return await asyncio.open_connection('127.0.0.1', port)
+
+async def join(port: int, username: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """ A connection joined as `username`, read up to its join accept. """
+    reader, writer = await connect(port)
+    writer.write(Message(join_request=True, username=username).serialize())
+    while not (message := await asyncio.wait_for(read_message(reader), 5)).is_join_accept:
+        assert not message.is_join_reject, message.content
+    return reader, writer
+
+async def until(condition, timeout: float = 5.0):
+    """ Wait for `condition()` to hold, failing the test if it does not within `timeout` seconds. """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, 'Timed out'
+        await asyncio.sleep(0.01)
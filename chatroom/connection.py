@@ -1,8 +1,233 @@
-from typing import NamedTuple
+from compressor import Compression
+from framing import Framing
+from frame import Frame
+from metrics import Metrics
+from pool import WorkerPool
+from typing import List, Optional, Set
 import asyncio
+import collections
+import enum
+import time
 
-class Connection(NamedTuple):
-    reader: asyncio.StreamReader
-    writer: asyncio.StreamWriter
-    host:   str
-    port:   int
\ No newline at end of file
+class SlowConsumerPolicy(enum.Enum):
+    """ What a connection does when its outbound queue is full. """
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT  = 'disconnect'
+    BLOCK       = 'block'
+
+class Deferred:
+    """ A queued frame still being encoded in the worker pool. Its length is the frame's estimated size,
+        so the queue's byte accounting holds before it is known. """
+
+    __slots__ = ('future', 'size')
+
+    def __init__(self, future: asyncio.Future, size: int):
+        self.future = future
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+class FrameQueue(asyncio.Queue):
+    """ A connection's outbound queue. Entries go in as (data, droppable) and come out as data, and `evict`
+        takes out the oldest droppable one, so a frame that must arrive is never discarded to make room. """
+
+    def _init(self, maxsize: int):
+        super()._init(maxsize)
+        self._droppable = collections.deque()
+
+    def _put(self, item):
+        data, droppable = item
+        self._queue.append(data)
+        self._droppable.append(droppable)
+
+    def _get(self):
+        self._droppable.popleft()
+        return self._queue.popleft()
+
+    def evict(self):
+        """ Remove and return the oldest droppable entry, or None if every queued entry must be delivered. """
+        for i, droppable in enumerate(self._droppable):
+            if droppable:
+                del self._droppable[i]
+                data = self._queue[i]
+                del self._queue[i]
+                self.task_done()
+                return data
+        return None
+
+class Connection:
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        host:   str,
+        port:   int,
+        max_queue: int = 1024,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST,
+        coalesce_delay: float = 0.0,
+        coalesce_bytes: int = 64 * 1024,
+        metrics: Optional[Metrics] = None,
+        pool: Optional[WorkerPool] = None,
+        offload_bytes: Optional[int] = None
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.port = port
+        self.policy = policy
+        # With a delay, a frame waits up to that long (or until `coalesce_bytes` are queued) for more
+        # frames to write with it, trading that much latency for fewer writes under bursts.
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+        self.queued_bytes = 0
+        self.flush_waiter: Optional[asyncio.Future] = None
+        self.username: Optional[str] = None
+        self.key: Optional[str] = None          # Case-folded username, used for lookups.
+        self.rooms: Set[str] = set()            # Keys of the rooms this connection is a member of.
+        self.session = None                     # The sessions.Session of the user joined on this connection.
+        self.capture_id: Optional[int] = None   # Its records' id in the server's capture file, when capturing.
+        self.framing: Framing = Framing.JSON
+        self.compression: Optional[Compression] = None  # Set once negotiated; everything sent after is enveloped.
+        self.queue = FrameQueue(maxsize=max_queue)
+        self.dropped: int = 0
+        self.is_closing: bool = False
+        self.writer_task: Optional[asyncio.Task] = None
+        # time.monotonic() readings the server's reaper compares against its timeouts.
+        self.last_read = time.monotonic()
+        self.last_ping = 0.0
+        self.draining_since: Optional[float] = None
+        self.metrics = metrics                  # The server's, which counts what every connection writes.
+        self.encode_timings = metrics.encode_seconds if metrics is not None else None
+        self.compress_timings = metrics.compress_seconds if metrics is not None else None
+        # Frames of at least `offload_bytes` that are not encoded yet are encoded in `pool`, off the loop.
+        self.pool = pool
+        self.offload_bytes = offload_bytes
+
+    def start(self):
+        """ Start the task that drains the outbound queue into the socket. """
+        self.writer_task = asyncio.create_task(
+            self._write_loop(), name=f'Writer-{self.host}:{self.port}'
+        )
+
+    async def send(self, frame: Frame, droppable: bool = True):
+        """ Queue `frame` for delivery, applying the slow consumer policy if the queue is full. Frames that
+            are not `droppable` are never evicted; under DROP_OLDEST, one that finds nothing to evict
+            disconnects the consumer, as waiting for it would hold up every other recipient. """
+        if self.is_closing:
+            return
+        if self.pool is not None and (size := frame.size_hint) >= self.offload_bytes and not frame.ready(self.framing, self.compression):
+            data = Deferred(frame.prepare(self.framing, self.compression, self.pool), size)
+            if self.metrics is not None:
+                self.metrics.offloaded.inc()
+        elif (data := frame.encoded(self.framing, self.encode_timings)) is not None and \
+                (compression := self.compression) is not None and (compression.stream is None or len(data) >= compression.threshold):
+            # Smaller frames stay plain in the queue with a stream context, to be compressed when written,
+            # so that dropping one from the queue cannot desynchronise the peer's context.
+            data = frame.enveloped(self.framing, compression, self.compress_timings)
+        if not self.queue.full():
+            self.queue.put_nowait((data, droppable))
+        elif self.policy is SlowConsumerPolicy.BLOCK:
+            await self.queue.put((data, droppable))
+        elif self.policy is SlowConsumerPolicy.DROP_OLDEST and ((evicted := self.queue.evict()) is not None or droppable):
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.frames_dropped.inc()
+            if evicted is None:
+                return          # Everything queued must be delivered, so this frame is the one dropped.
+            self.queued_bytes -= len(evicted)
+            self.queue.put_nowait((data, droppable))
+        else:
+            return self.abort()
+        self.queued_bytes += len(data)
+        if self.queued_bytes >= self.coalesce_bytes:
+            self._flush()
+
+    def _flush(self):
+        """ End the current coalescing wait, if there is one. """
+        if self.flush_waiter is not None and not self.flush_waiter.done():
+            self.flush_waiter.set_result(None)
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                pending: List[memoryview] = [await self.queue.get()]
+                if self.coalesce_delay and self.queued_bytes < self.coalesce_bytes:
+                    self.flush_waiter = loop.create_future()
+                    timer = loop.call_later(self.coalesce_delay, self._flush)
+                    try:
+                        await self.flush_waiter
+                    finally:
+                        timer.cancel()
+                        self.flush_waiter = None
+                while not self.queue.empty():
+                    pending.append(self.queue.get_nowait())
+                self.queued_bytes -= sum(map(len, pending))
+                # Resolved in queue order, so a frame still in the pool holds back the ones behind it. Shielded,
+                # as other connections share the future.
+                writes = [await asyncio.shield(data.future) if isinstance(data, Deferred) else data for data in pending]
+                if self.compression is not None and self.compression.stream is not None:
+                    started = time.perf_counter()
+                    writes = self.compression.pack(writes)
+                    if self.compress_timings is not None:
+                        self.compress_timings.observe(time.perf_counter() - started)
+                try:
+                    if self.writer.is_closing():
+                        # uvloop raises on writes to a closed transport, where asyncio would ignore them.
+                        raise ConnectionResetError('Transport Closed')
+                    if len(writes) == 1:
+                        self.writer.write(writes[0])
+                    else:
+                        self.writer.writelines(writes)
+                    if self.metrics is not None:
+                        self.metrics.frames_sent.inc(len(pending))
+                        self.metrics.bytes_sent.inc(sum(map(len, writes)))
+                        self.metrics.writes.inc()
+                    self.draining_since = time.monotonic()
+                    await self.writer.drain()
+                    self.draining_since = None
+                finally:
+                    for _ in pending:
+                        self.queue.task_done()
+        except (OSError, asyncio.CancelledError):
+            self.is_closing = True
+            self._discard_queue()
+
+    def _discard_queue(self):
+        """ Empty the queue so that blocked senders and `close()` are released. """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+        self.queued_bytes = 0
+
+    async def close(self, timeout: float = 5.0):
+        """ Deliver whatever is still queued, then close the underlying transport. A peer that has
+            not taken it all within `timeout` seconds is cut off. """
+        if self.is_closing and self.writer.is_closing():
+            return
+        self.is_closing = True
+        deadline = asyncio.get_running_loop().time() + timeout
+        if self.writer_task and not self.writer_task.done():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.writer_task.cancel()
+        self.writer.close()
+        try:
+            # The transport only finishes closing once its buffer is flushed, which a stalled peer never allows.
+            await asyncio.wait_for(self.writer.wait_closed(), max(0, deadline - asyncio.get_running_loop().time()))
+        except asyncio.TimeoutError:
+            self.writer.transport.abort()
+        except OSError:
+            pass
+
+    def abort(self):
+        """ Drop the connection immediately, discarding anything still queued. """
+        self.is_closing = True
+        if self.writer_task:
+            self.writer_task.cancel()
+        self._discard_queue()
+        self.writer.transport.abort()
@@ -0,0 +1,107 @@
+from compressor import Compression, seal
+from framing import Framing, encode
+from message import Message
+from metrics import Histogram
+from pool import PoolKind, WorkerPool
+from typing import Dict, Optional
+import asyncio
+import time
+
+# Rough size of a frame's fields besides its content, for estimating how big it encodes.
+FRAME_OVERHEAD = 512
+
+class Frame:
+    """ An immutable, pre-encoded message whose bytes are shared by every recipient. """
+
+    __slots__ = ('_message', '_encoded', '_pending')
+
+    def __init__(self, message: Message):
+        self._message = message
+        self._encoded = {}
+        self._pending: Dict[object, asyncio.Future] = {}
+
+    @classmethod
+    def from_message(cls, message: Message) -> 'Frame':
+        """ Wrap `message` so it is encoded at most once per framing, however many connections it is queued on. """
+        return cls(message)
+
+    @classmethod
+    def from_encoded(cls, data: memoryview, framing: Framing = Framing.JSON) -> 'Frame':
+        """ Wrap bytes that are already encoded for `framing`; the message is only decoded if another framing needs it. """
+        frame = cls(None)
+        frame._encoded[framing] = memoryview(data)
+        return frame
+
+    @property
+    def message(self) -> Message:
+        if self._message is None:
+            self._message = Message.deserialize(self._encoded[Framing.JSON])
+        return self._message
+
+    def encoded(self, framing: Framing = Framing.JSON, timings: Optional[Histogram] = None) -> memoryview:
+        """ A zero-copy view of this frame encoded for `framing`, suitable for `write`/`writelines`.
+            When it has to be encoded here, the time taken is observed in `timings`. """
+        if (view := self._encoded.get(framing)) is None:
+            started = time.perf_counter()
+            view = self._encoded[framing] = memoryview(encode(self.message, framing))
+            if timings is not None:
+                timings.observe(time.perf_counter() - started)
+        return view
+
+    def enveloped(self, framing: Framing, compression: Compression, timings: Optional[Histogram] = None) -> memoryview:
+        """ This frame for a connection that negotiated `compression`: compressed if it reaches the threshold,
+            once however many connections share the codec. When compressed here, the time is observed in `timings`. """
+        key = (framing, compression.codec)
+        if (view := self._encoded.get(key)) is None:
+            data = self.encoded(framing)
+            started = time.perf_counter()
+            view = self._encoded[key] = memoryview(seal(compression.codec, data, compression.threshold, compression.level))
+            if timings is not None and len(data) >= compression.threshold:
+                timings.observe(time.perf_counter() - started)
+        return view
+
+    @property
+    def size_hint(self) -> int:
+        """ About how many bytes this frame encodes to, without encoding it. """
+        if self._encoded:
+            return len(next(iter(self._encoded.values())))
+        return FRAME_OVERHEAD + self._message.content_length
+
+    def ready(self, framing: Framing, compression: Optional[Compression] = None) -> bool:
+        """ Whether this frame is already encoded (and enveloped) as a connection with these settings needs it. """
+        return (framing if compression is None else (framing, compression.codec)) in self._encoded
+
+    def prepare(self, framing: Framing, compression: Optional[Compression], pool: WorkerPool) -> asyncio.Future:
+        """ A future for this frame encoded for `framing`, and enveloped for `compression` if given, with the
+            work done in `pool` rather than on the event loop. Connections sharing the frame share the future. """
+        key = framing if compression is None else (framing, compression.codec)
+        if (future := self._pending.get(key)) is None:
+            future = self._pending[key] = asyncio.ensure_future(self._prepare(key, framing, compression, pool))
+        return future
+
+    async def _prepare(self, key, framing: Framing, compression: Optional[Compression], pool: WorkerPool) -> memoryview:
+        try:
+            if (data := self._encoded.get(framing)) is None:
+                data = self._encoded[framing] = memoryview(await pool.cpu(encode, self.message, framing))
+            if compression is not None and (data := self._encoded.get(key)) is None:
+                plain = self._encoded[framing]
+                if pool.kind is PoolKind.PROCESS:
+                    plain = bytes(plain)    # Views do not pickle.
+                data = self._encoded[key] = memoryview(
+                    await pool.cpu(seal, compression.codec, plain, compression.threshold, compression.level)
+                )
+            return data
+        finally:
+            self._pending.pop(key, None)
+
+    @property
+    def data(self) -> bytes:
+        """ The JSON encoding of this frame, newline terminated. """
+        return self.encoded(Framing.JSON).obj
+
+    @property
+    def view(self) -> memoryview:
+        return self.encoded(Framing.JSON)
+
+    def __len__(self):
+        return len(self.encoded(Framing.JSON))
@@ -0,0 +1,284 @@
+from message import Message, check_extensions
+from typing import List, Optional, Tuple
+import asyncio
+import enum
+import json
+import struct
+
+class Framing(enum.Enum):
+    """ How messages are delimited on the wire. JSON is the default and the fallback. """
+    JSON    = 'json'
+    BINARY  = 'binary'
+
+class PayloadKind(enum.IntEnum):
+    NONE    = 0
+    TEXT    = 1
+    BYTES   = 2
+
+# Kind (B), Flags (I), User Count (i), Username Length (H), Filename Length (H), Extensions Length (H),
+# Epoch (q), Payload Length (Q), Sequence (Q), Time in ns (q). The extensions are a compact JSON object of
+# the other optional message fields. Sequence and time are set on every broadcast, so they get fixed slots
+# (0 when unset) rather than a JSON object on every chat message.
+HEADER = struct.Struct('!BIiHHHqQQq')
+
+# The most read at once while skipping the body of a binary frame over the limit.
+SKIP_CHUNK = 64 * 1024
+
+_decode = json.JSONDecoder().decode
+
+class FrameTooLarge(ValueError):
+    """ A frame longer than the limit for its framing, skipped so the connection can carry on past it.
+        `complete` is False while the rest of it has yet to arrive: up to its newline for JSON, or the
+        `remaining` bytes a binary header announced. """
+
+    def __init__(self, complete: bool = True, remaining: int = 0):
+        super().__init__('Frame exceeds the stream limit.')
+        self.complete = complete
+        self.remaining = remaining
+
+def encode_binary(message: Message) -> bytes:
+    """ Encode `message` as a fixed header followed by the username, filename and raw payload. """
+    username = message.username.encode('utf-8') if message.username else b''
+    filename = message.filename.encode('utf-8') if message.filename else b''
+    extensions = message.extensions()
+    extensions.pop('sequence', None)
+    extensions.pop('time_ns', None)
+    extensions = json.dumps(extensions, separators=(',', ':')).encode('utf-8') if extensions else b''
+    content = message.content
+    if content is None:
+        kind, payload = PayloadKind.NONE, b''
+    elif message.carries_bytes:
+        kind, payload = PayloadKind.BYTES, message.attachment
+    elif isinstance(content, (bytes, bytearray)):
+        kind, payload = PayloadKind.BYTES, bytes(content)
+    else:
+        kind, payload = PayloadKind.TEXT, content.encode('utf-8')
+    user_count = message.user_count if message.user_count is not None else -1
+    header = HEADER.pack(
+        kind, message.flags, user_count, len(username), len(filename), len(extensions), message.epoch, len(payload),
+        message.sequence or 0, message.time_ns or 0
+    )
+    return b''.join((header, username, filename, extensions, payload))
+
+def decode_binary(header: Tuple, body: bytes) -> Message:
+    """ Build a message from an unpacked HEADER and the bytes that followed it. """
+    kind, flags, user_count, username_length, filename_length, extensions_length, epoch, payload_length, sequence, time_ns = header
+    view = memoryview(body)
+    username = str(view[:username_length], 'utf-8') if username_length else None
+    filename = str(view[username_length:username_length + filename_length], 'utf-8') if filename_length else None
+    offset = username_length + filename_length
+    extensions = check_extensions(json.loads(str(view[offset:offset + extensions_length], 'utf-8'))) if extensions_length else {}
+    # These have header slots of their own.
+    extensions.pop('sequence', None)
+    extensions.pop('time_ns', None)
+    payload = view[offset + extensions_length:]
+    if kind == PayloadKind.TEXT:
+        content = str(payload, 'utf-8')
+    elif kind == PayloadKind.BYTES:
+        content = bytes(payload)
+    else:
+        content = None
+    return Message(
+        flags       = flags,
+        user_count  = user_count,
+        username    = username,
+        filename    = filename,
+        content     = content,
+        epoch       = epoch,
+        sequence    = sequence or None,
+        time_ns     = time_ns or None,
+        **extensions
+    )
+
+def encode(message: Message, framing: Framing = Framing.JSON) -> bytes:
+    if framing is Framing.BINARY:
+        return encode_binary(message)
+    return message.serialize()
+
+async def read_frame(
+    reader: asyncio.StreamReader, framing: Framing = Framing.JSON, max_frame_bytes: Optional[int] = None
+) -> Optional[Tuple[Optional[Tuple], bytes]]:
+    """ Read one frame from `reader` without decoding it: the unpacked binary header (None for JSON)
+        and the bytes that followed it. Returns None once the peer has closed the stream, and raises
+        FrameTooLarge, having skipped it, for a JSON frame longer than the reader's limit or a binary
+        frame announcing more than `max_frame_bytes` after its header. The skipped bytes are never buffered. """
+    if framing is Framing.BINARY:
+        try:
+            header = HEADER.unpack(await reader.readexactly(HEADER.size))
+            size = header[3] + header[4] + header[5] + header[7]
+            if max_frame_bytes is None or size <= max_frame_bytes:
+                return header, await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+        while size:
+            if not (skipped := await reader.read(min(size, SKIP_CHUNK))):
+                return None
+            size -= len(skipped)
+        raise FrameTooLarge()
+    try:
+        data = await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as error:
+        data = error.partial
+    except asyncio.LimitOverrunError as error:
+        # Drop the line up to its newline, in pieces while the newline has yet to arrive.
+        try:
+            while True:
+                await reader.readexactly(error.consumed)
+                try:
+                    await reader.readuntil(b'\n')
+                    break
+                except asyncio.LimitOverrunError as overrun:
+                    error = overrun
+        except asyncio.IncompleteReadError:
+            return None
+        raise FrameTooLarge()
+    return (None, data) if data else None
+
+def decode_frame(header: Optional[Tuple], data: bytes) -> Message:
+    """ Decode a frame returned by `read_frame`. """
+    if header is not None:
+        return decode_binary(header, data)
+    return Message.deserialize(data)
+
+def frame_size(header: Optional[Tuple], data: bytes) -> int:
+    """ The bytes a frame returned by `read_frame` took on the wire. """
+    return len(data) + (HEADER.size if header is not None else 0)
+
+def frame_bytes(header: Optional[Tuple], data: bytes) -> bytes:
+    """ The bytes a frame returned by `read_frame` was read from. """
+    return HEADER.pack(*header) + data if header is not None else data
+
+async def read_message(reader: asyncio.StreamReader, framing: Framing = Framing.JSON) -> Optional[Message]:
+    """ Read one message from `reader`, returning None once the peer has closed the stream. """
+    if (frame := await read_frame(reader, framing)) is None:
+        return None
+    return decode_frame(*frame)
+
+def scan_frames(
+    buffer: bytearray, framing: Framing, limit: int, skip_oversized: bool = False, defer_bytes: Optional[int] = None
+) -> Tuple[List[Optional[Message]], int]:
+    """ Decode every complete frame at the start of `buffer`, for readers that receive many frames at once.
+        Frames after one that negotiates the framing (one with `framing` set) are left in the buffer, as
+        they may use the other framing. With `skip_oversized`, a JSON frame longer than `limit` yields a
+        FrameTooLarge in its place rather than ending the scan like an undecodable one, as does a binary
+        frame announcing more than `limit` bytes after its header. Frames of at least `defer_bytes` are
+        left undecoded, as the (header, data) pair `read_frame` returns, for the caller to decode elsewhere;
+        so whether they negotiate the framing is not known. """
+    if framing is Framing.BINARY:
+        return scan_binary(buffer, limit, skip_oversized, defer_bytes)
+    return scan_json(buffer, limit, skip_oversized, defer_bytes)
+
+def split_frames(data: bytes, framing: Framing, limit: int) -> List[bytes]:
+    """ The frames in `data`, bytes `scan_frames` used, as `read_frame` would have read them one by one.
+        Frames over `limit`, which `read_frame` skips, and a partial frame at the end are left out. """
+    frames = []
+    offset = 0
+    if framing is Framing.BINARY:
+        while len(data) - offset >= HEADER.size:
+            header = HEADER.unpack_from(data, offset)
+            size = header[3] + header[4] + header[5] + header[7]
+            end = offset + HEADER.size + size
+            if size <= limit and end <= len(data):
+                frames.append(bytes(data[offset:end]))
+            offset = end
+        return frames
+    while (end := data.find(b'\n', offset) + 1) > 0:
+        if end - offset - 1 <= limit:
+            frames.append(bytes(data[offset:end]))
+        offset = end
+    return frames
+
+def scan_json(
+    buffer: bytearray, limit: int, skip_oversized: bool = False, defer_bytes: Optional[int] = None
+) -> Tuple[List[Optional[Message]], int]:
+    """ Decode the complete newline-delimited frames at the start of `buffer`, returning them and the
+        number of bytes they used. A None entry marks a frame that could not be decoded, or a line longer
+        than `limit`; decoding also stops after a frame that negotiates the framing. """
+    end = buffer.rfind(b'\n') + 1
+    if not end:
+        if len(buffer) <= limit:
+            return [], 0
+        return [FrameTooLarge(complete=False) if skip_oversized else None], len(buffer)
+    try:
+        lines = buffer[:end].decode('utf-8').split('\n')
+        del lines[-1]
+        if end > limit and max(map(len, lines)) > limit:
+            raise ValueError('Frame exceeds the stream limit.')
+        if defer_bytes is not None and end > defer_bytes and max(map(len, lines)) >= defer_bytes:
+            raise ValueError('Frame is to be decoded elsewhere.')
+        # One parse for the whole run, which also shares the key strings between frames. Lines that
+        # only make valid JSON once joined do not yield one object each and take the per-line path.
+        objects = _decode('[' + ','.join(lines) + ']')
+        if len(objects) != len(lines):
+            raise ValueError('Frames do not line up.')
+        messages: List[Optional[Message]] = list(map(Message.from_dict, objects))
+    except (ValueError, TypeError, AttributeError):
+        return scan_json_lines(buffer, end, limit, skip_oversized, defer_bytes)
+    for i, message in enumerate(messages):
+        if message.framing is not None:
+            return messages[:i + 1], len('\n'.join(lines[:i + 1]).encode('utf-8')) + 1
+    return messages, end
+
+def scan_json_lines(
+    buffer: bytearray, end: int, limit: int, skip_oversized: bool = False, defer_bytes: Optional[int] = None
+) -> Tuple[List[Optional[Message]], int]:
+    """ `scan_json` one frame at a time, to find exactly where a bad frame is. """
+    messages: List[Optional[Message]] = []
+    used = 0
+    for line in buffer[:end].split(b'\n')[:-1]:
+        used += len(line) + 1
+        if skip_oversized and len(line) > limit:
+            messages.append(FrameTooLarge())
+            continue
+        if defer_bytes is not None and defer_bytes <= len(line) <= limit:
+            messages.append((None, bytes(line)))
+            continue
+        try:
+            if len(line) > limit:
+                raise ValueError('Frame exceeds the stream limit.')
+            message = Message.deserialize(line.decode('utf-8'))
+        except (ValueError, TypeError, AttributeError):
+            messages.append(None)
+            break
+        messages.append(message)
+        if message.framing is not None:
+            break
+    return messages, used
+
+def scan_binary(
+    buffer: bytearray, max_frame_bytes: Optional[int] = None, skip_oversized: bool = False, defer_bytes: Optional[int] = None
+) -> Tuple[List[Optional[Message]], int]:
+    """ Decode the complete length-prefixed frames at the start of `buffer`, returning them and the
+        number of bytes they used. A None entry marks a frame that could not be decoded, or one that
+        announces more than `max_frame_bytes` after its header, which is not waited for. With
+        `skip_oversized`, such a frame yields a FrameTooLarge instead, whose `remaining` bytes are
+        those of it not yet in the buffer. """
+    messages: List[Optional[Message]] = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        header = HEADER.unpack_from(buffer, offset)
+        size = header[3] + header[4] + header[5] + header[7]
+        end = offset + HEADER.size + size
+        if max_frame_bytes is not None and size > max_frame_bytes:
+            if not skip_oversized:
+                messages.append(None)
+                return messages, len(buffer)
+            if end > len(buffer):
+                messages.append(FrameTooLarge(complete=False, remaining=end - len(buffer)))
+                return messages, len(buffer)
+            messages.append(FrameTooLarge())
+            offset = end
+            continue
+        if end > len(buffer):
+            break
+        if defer_bytes is not None and end - offset >= defer_bytes:
+            messages.append((header, bytes(buffer[offset + HEADER.size:end])))
+            offset = end
+            continue
+        try:
+            messages.append(decode_binary(header, buffer[offset + HEADER.size:end]))
+        except ValueError:
+            messages.append(None)
+            return messages, end
+        offset = end
+    return messages, offset
@@ -0,0 +1,223 @@
+from blobs import BlobStore
+from message import Message
+from typing import Deque, Dict, Iterable, Iterator, List, Optional
+import bisect
+import collections
+import itertools
+import time
+
+# Rough per-entry cost of the Message object and bookkeeping, on top of its text.
+ENTRY_OVERHEAD = 256
+
+def render(message: Message) -> str:
+    """ Format one message the way it appears in the history sent on join. Attachments are referenced, not inlined. """
+    if message.filename is not None:
+        size = f' ({message.total_size} bytes)' if message.total_size is not None else ''
+        return f'[{message.timestamp}] @{message.username}: * sent an attachment: `{message.filename}`{size}\n'
+    return f'[{message.timestamp}] @{message.username}: {(message.content or "").strip()}\n'
+
+def reference(message: Message) -> Message:
+    """ A copy of an attachment message that keeps its metadata but not its body. """
+    return Message(
+        username=message.username,
+        filename=message.filename,
+        total_size=message.total_size if message.total_size is not None else len(message.attachment),
+        transfer_id=message.transfer_id,
+        digest=message.digest,
+        recipients=message.recipients,
+        sequence=message.sequence,
+        time_ns=message.time_ns,
+        epoch=message.epoch
+    )
+
+class HistoryEntry:
+
+    __slots__ = ('sequence', 'message', 'received', 'size', '_rendered')
+
+    def __init__(self, sequence: int, message: Message):
+        self.sequence = sequence
+        self.message = message
+        self.received: int = message.time_ns
+        self.size = ENTRY_OVERHEAD + (len(message.content) if isinstance(message.content, str) else 0)
+        self._rendered: Optional[str] = None
+
+    @property
+    def rendered(self) -> str:
+        """ The display form of this entry, rendered on first use and cached afterwards. """
+        if self._rendered is None:
+            self._rendered = render(self.message)
+        return self._rendered
+
+class ChatHistory:
+    """ A bounded, sequence-indexed record of broadcast messages.
+
+        Entries live in a ring buffer, so appending, evicting and looking up a sequence number are O(1),
+        and the oldest entries are evicted once either `max_messages` or `max_bytes` is exceeded.
+        Entries referencing a stored attachment hold a reference to it in `blobs` while they are kept. """
+
+    def __init__(self, max_messages: int = 10_000, max_bytes: int = 64 * 1024 * 1024, blobs: Optional[BlobStore] = None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.blobs = blobs
+        self._ring: List[Optional[HistoryEntry]] = [None] * max_messages
+        self._head = 0          # Ring index of the oldest entry.
+        self._count = 0
+        self._bytes = 0
+        self.next_sequence = 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self) -> Iterator[HistoryEntry]:
+        for i in range(self._count):
+            yield self._ring[(self._head + i) % self.max_messages]
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def first_sequence(self) -> int:
+        """ The sequence number of the oldest retained entry. """
+        return self.next_sequence - self._count
+
+    @property
+    def last_sequence(self) -> int:
+        """ The sequence number of the newest entry, or 0 if nothing has been recorded yet. """
+        return self.next_sequence - 1
+
+    def append(self, message: Message) -> int:
+        """ Record `message`, assigning and returning its sequence number. Its `time_ns` (the time the server
+            received it, or now if unset) is moved past the newest entry's, so no two entries share a time. """
+        message.sequence = self.next_sequence
+        self.next_sequence += 1
+        received = message.time_ns if message.time_ns is not None else time.time_ns()
+        if self._count and received <= (newest := self._ring[(self._head + self._count - 1) % self.max_messages].received):
+            received = newest + 1
+        message.time_ns = received
+        message.epoch = received // 1_000_000_000
+        if message.filename is not None and message.content is not None:
+            message = reference(message)
+        entry = HistoryEntry(message.sequence, message)
+        if self.blobs is not None and message.digest is not None:
+            self.blobs.retain(message.digest)
+        if self._count == self.max_messages:
+            self._evict()
+        self._ring[(self._head + self._count) % self.max_messages] = entry
+        self._count += 1
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and self._count > 1:
+            self._evict()
+        return entry.sequence
+
+    def restore(self, message: Message) -> int:
+        """ Record a message that already has a sequence number, e.g. one replayed from the chat log. """
+        self.next_sequence = message.sequence
+        if message.time_ns is None:
+            # Logged before receive times were kept.
+            message.time_ns = message.epoch * 1_000_000_000
+        return self.append(message)
+
+    def get(self, sequence: int) -> Optional[HistoryEntry]:
+        """ The entry with `sequence`, if it is still retained. """
+        position = sequence - self.first_sequence
+        if 0 <= position < self._count:
+            return self._ring[(self._head + position) % self.max_messages]
+        return None
+
+    @property
+    def newest(self) -> Optional[HistoryEntry]:
+        return self._ring[(self._head + self._count - 1) % self.max_messages] if self._count else None
+
+    def _evict(self):
+        entry = self._ring[self._head]
+        self._ring[self._head] = None
+        self._head = (self._head + 1) % self.max_messages
+        self._count -= 1
+        self._bytes -= entry.size
+        if self.blobs is not None and entry.message.digest is not None:
+            self.blobs.release(entry.message.digest)
+
+    def clear(self):
+        """ Drop every entry. Sequence numbers keep counting up from where they were. """
+        if self.blobs is not None:
+            for entry in self:
+                if entry.message.digest is not None:
+                    self.blobs.release(entry.message.digest)
+        self._ring = [None] * self.max_messages
+        self._head = self._count = self._bytes = 0
+
+    def _slice(self, start: int) -> List[HistoryEntry]:
+        """ Entries from position `start` (0 being the oldest retained) to the newest. """
+        start = max(0, start)
+        return [self._ring[(self._head + i) % self.max_messages] for i in range(start, self._count)]
+
+    def recent(self, limit: int) -> List[HistoryEntry]:
+        """ The newest `limit` entries, oldest first. """
+        return self.select(limit=limit)
+
+    def since(self, cursor: int) -> List[HistoryEntry]:
+        """ Entries with a sequence number greater than `cursor`. """
+        return self.select(cursor=cursor)
+
+    def since_epoch(self, epoch: int) -> List[HistoryEntry]:
+        """ Entries received at or after `epoch`, in seconds. """
+        return self.select(since_epoch=epoch)
+
+    def select(
+        self,
+        limit: Optional[int] = None,
+        cursor: Optional[int] = None,
+        since_epoch: Optional[int] = None
+    ) -> List[HistoryEntry]:
+        """ The entries a joining client asked for: after `cursor` or `since_epoch` if given, capped to the newest `limit`.
+            Receive times never decrease, so `since_epoch` is a binary search; the cost is O(entries returned). """
+        if cursor is not None:
+            start = cursor + 1 - self.first_sequence
+        elif since_epoch is not None:
+            key = lambda i: self._ring[(self._head + i) % self.max_messages].received
+            start = bisect.bisect_left(range(self._count), since_epoch * 1_000_000_000, key=key)
+        else:
+            start = 0
+        if limit is not None:
+            start = max(start, self._count - limit)
+        return self._slice(start)
+
+    @staticmethod
+    def render(entries: List[HistoryEntry]) -> str:
+        return ''.join(entry.rendered for entry in entries)
+
+class DirectHistory:
+    """ Direct messages, kept apart from every room's history: one sequence-numbered record of them all,
+        and for each user the sequence numbers of those it sent or received, so replaying one user's
+        direct messages reads only theirs. A user's list goes when its name is released, so whoever
+        takes the name next does not see them. """
+
+    def __init__(self, max_messages: int = 10_000, max_bytes: int = 64 * 1024 * 1024, per_user: int = 1000):
+        self.history = ChatHistory(max_messages, max_bytes)
+        self.per_user = per_user
+        self.mailboxes: Dict[str, Deque[int]] = {}
+
+    def __len__(self):
+        return len(self.history)
+
+    def append(self, message: Message, keys: Iterable[str]) -> int:
+        """ Record `message` for the users with case-folded names `keys`, returning its sequence number. """
+        sequence = self.history.append(message)
+        for key in keys:
+            if (mailbox := self.mailboxes.get(key)) is None:
+                mailbox = self.mailboxes[key] = collections.deque(maxlen=self.per_user)
+            mailbox.append(sequence)
+        return sequence
+
+    def select(self, key: str, limit: Optional[int] = None, cursor: Optional[int] = None) -> List[HistoryEntry]:
+        """ The direct messages of user `key` still kept, after `cursor` if given, capped to the newest `limit`. """
+        mailbox = self.mailboxes.get(key, ())
+        start = max(bisect.bisect_right(mailbox, cursor) if cursor is not None else 0,
+                    bisect.bisect_left(mailbox, self.history.first_sequence))
+        if limit is not None:
+            start = max(start, len(mailbox) - limit)
+        return [self.history.get(sequence) for sequence in itertools.islice(mailbox, start, None)]
+
+    def forget(self, key: str):
+        self.mailboxes.pop(key, None)
@@ -0,0 +1,33 @@
+from enum import Enum
+from typing import Any, Callable, Coroutine, List
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+class LoopBackend(Enum):
+    """ The event loop implementation the server or client runs on. """
+    AUTO    = 'auto'        # uvloop when it is installed, otherwise the stock asyncio loop.
+    ASYNCIO = 'asyncio'
+    UVLOOP  = 'uvloop'
+
+def available() -> List[LoopBackend]:
+    """ The concrete backends that can run in this environment. """
+    return [LoopBackend.ASYNCIO] + ([LoopBackend.UVLOOP] if uvloop is not None else [])
+
+def resolve(backend: LoopBackend) -> LoopBackend:
+    if backend is LoopBackend.AUTO:
+        return LoopBackend.UVLOOP if uvloop is not None else LoopBackend.ASYNCIO
+    if backend is LoopBackend.UVLOOP and uvloop is None:
+        raise RuntimeError('The uvloop loop backend was requested but uvloop is not installed.')
+    return backend
+
+def loop_factory(backend: LoopBackend) -> Callable[[], asyncio.AbstractEventLoop]:
+    return uvloop.new_event_loop if resolve(backend) is LoopBackend.UVLOOP else asyncio.new_event_loop
+
+def run(main: Coroutine[Any, Any, Any], backend: LoopBackend = LoopBackend.AUTO) -> Any:
+    """ Run `main` to completion on a new loop of the given backend, like `asyncio.run`. """
+    with asyncio.Runner(loop_factory=loop_factory(backend)) as runner:
+        return runner.run(main)
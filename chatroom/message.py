@@ -1,202 +1,370 @@
 from datetime import datetime
+from functools import lru_cache
+from typing import Union
+import base64
+import enum
 import json
+import time
 
-def timestamp() -> str:
-    return datetime.datetime.now().strftime('%m-%d-%Y, %I:%M:%S %p')
+TIMESTAMP_FORMAT = '%m-%d-%Y, %I:%M:%S %p'
+
+@lru_cache(maxsize=1024)
+def format_timestamp(epoch: int) -> str:
+    """ Render an epoch timestamp the way it is shown to users. Cached, since messages cluster in time. """
+    return datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
+
+class MessageFlag(enum.IntFlag):
+    """ The boolean `is_*` fields of a Message, packed into a single integer. """
+    STATUS_REQUEST  = 1 << 0
+    STATUS_RESPONSE = 1 << 1
+    JOIN_REQUEST    = 1 << 2
+    JOIN_ACCEPT     = 1 << 3
+    JOIN_REJECT     = 1 << 4
+    JOIN_ANNOUNCE   = 1 << 5
+    QUIT_REQUEST    = 1 << 6
+    QUIT_ACCEPT     = 1 << 7
+    TRANSFER_BEGIN  = 1 << 8
+    TRANSFER_CHUNK  = 1 << 9
+    TRANSFER_END    = 1 << 10
+    HISTORY_REQUEST = 1 << 11
+    HISTORY_END     = 1 << 12
+    ROOM_JOIN       = 1 << 13
+    ROOM_LEAVE      = 1 << 14
+    ROOM_LIST       = 1 << 15
+    BLOB_REQUEST    = 1 << 16
+    BLOB_RESPONSE   = 1 << 17
+    SEARCH_REQUEST  = 1 << 18
+    SEARCH_RESULT   = 1 << 19
+
+# JSON Key          Flag Bit
+FLAG_KEYS = (
+    ('status_request',  int(MessageFlag.STATUS_REQUEST)),
+    ('status_response', int(MessageFlag.STATUS_RESPONSE)),
+    ('join_request',    int(MessageFlag.JOIN_REQUEST)),
+    ('join_accept',     int(MessageFlag.JOIN_ACCEPT)),
+    ('join_reject',     int(MessageFlag.JOIN_REJECT)),
+    ('join_announce',   int(MessageFlag.JOIN_ANNOUNCE)),
+    ('quit_request',    int(MessageFlag.QUIT_REQUEST)),
+    ('quit_accept',     int(MessageFlag.QUIT_ACCEPT)),
+    ('transfer_begin',  int(MessageFlag.TRANSFER_BEGIN)),
+    ('transfer_chunk',  int(MessageFlag.TRANSFER_CHUNK)),
+    ('transfer_end',    int(MessageFlag.TRANSFER_END)),
+    ('history_request', int(MessageFlag.HISTORY_REQUEST)),
+    ('history_end',     int(MessageFlag.HISTORY_END)),
+    ('room_join',       int(MessageFlag.ROOM_JOIN)),
+    ('room_leave',      int(MessageFlag.ROOM_LEAVE)),
+    ('room_list',       int(MessageFlag.ROOM_LIST)),
+    ('blob_request',    int(MessageFlag.BLOB_REQUEST)),
+    ('blob_response',   int(MessageFlag.BLOB_RESPONSE)),
+    ('search_request',  int(MessageFlag.SEARCH_REQUEST)),
+    ('search_result',   int(MessageFlag.SEARCH_RESULT)),
+)
+
+# Optional fields, only put on the wire when set.
+EXTENSION_FIELDS = (
+    'framing',          # Requested/accepted framing during the join handshake.
+    'compression',      # Join request: the compressor.Codec values accepted, comma separated, preferred first. Join accept: the one chosen.
+    'transfer_id',      # Identifies the chunked transfer a begin/chunk/end message belongs to.
+    'offset',           # Byte offset of a chunk, or the offset a transfer (re)starts from.
+    'total_size',       # Size in bytes of the file being transferred.
+    'digest',           # Hex SHA-256 of an attachment kept in the server's blob store, sent in place of its content.
+    'sequence',         # Server-assigned position of a broadcast in its room's history.
+    'time_ns',          # Server-assigned receive time of a broadcast in nanoseconds since the epoch, increasing with `sequence`.
+    'cursor',           # Join/history request: replay after this sequence. Join accept/history end: the newest sequence.
+                        # Search request: match only before this sequence. Search result: the cursor for the next page, if any.
+    'since_epoch',      # Join: replay history received at or after this epoch. Search request: match only from this epoch.
+    'until_epoch',      # Search request: match only before this epoch.
+    'history_limit',    # Join/history request: replay at most this many of the newest messages. Search request: the page size.
+    'author',           # Search request: match only messages by this user.
+    'results',          # Search result: the sequence numbers of the matches, newest first.
+    'room',             # The room a message is scoped to; unset means the default room.
+    'recipients',       # Direct message: the usernames it is for, besides its sender. History request/end: set (empty) for direct messages.
+    'reason',           # Join reject: why the join was refused, one of admission.RejectReason.
+    'stats',            # Status response: the server's metrics, as collected by metrics.Metrics.snapshot().
+    'ping',             # Heartbeat: a token the peer echoes back as `pong`.
+    'pong',             # Heartbeat reply: the token of the ping it answers.
+    'session',          # Join accept: a token to resume with. Join request: the token of the session to resume.
+)
+
+# The optional fields set on most broadcasts, or read while routing every message, which get slots of their own.
+# The rest live in one dict, created only for a message that sets one of them.
+SLOT_FIELDS = ('room', 'recipients', 'sequence', 'time_ns')
+_EXTENSION_NAMES = frozenset(EXTENSION_FIELDS)
+_DICT_FIELDS = _EXTENSION_NAMES - frozenset(SLOT_FIELDS)
+
+# The JSON types each optional field may hold. A frame with any other cannot be decoded.
+EXTENSION_TYPES = {
+    'framing':          str,
+    'compression':      str,
+    'transfer_id':      str,
+    'offset':           int,
+    'total_size':       int,
+    'digest':           str,
+    'sequence':         int,
+    'time_ns':          int,
+    'cursor':           int,
+    'since_epoch':      int,
+    'until_epoch':      int,
+    'history_limit':    int,
+    'author':           str,
+    'results':          list,
+    'room':             str,
+    'recipients':       list,
+    'reason':           str,
+    'stats':            dict,
+    'ping':             int,
+    'pong':             int,
+    'session':          str,
+}
+
+def check_extensions(extensions) -> dict:
+    """ The optional fields in `extensions`, a decoded JSON object, leaving out any this version does not know.
+        Raises ValueError if it is not an object or a field has the wrong type. """
+    if not isinstance(extensions, dict):
+        raise ValueError('Extensions Must Be A JSON Object.')
+    checked = {}
+    for field, types in EXTENSION_TYPES.items():
+        if (value := extensions.get(field)) is not None:
+            if not isinstance(value, types):
+                raise ValueError(f'Field `{field}` Cannot Be {type(value).__name__}.')
+            checked[field] = value
+    return checked
+
+_FLAG_NAMES = frozenset(key for key, _ in FLAG_KEYS)
+_TEXT = (str, type(None))
+_TRANSFER_FLAGS = int(MessageFlag.TRANSFER_BEGIN | MessageFlag.TRANSFER_CHUNK | MessageFlag.TRANSFER_END)
+
+def _flag_property(flag: MessageFlag, doc: str) -> property:
+    bit = int(flag)
+
+    def getter(self) -> bool:
+        return bool(self.flags & bit)
+
+    def setter(self, value: bool):
+        self.flags = (self.flags | bit) if value else (self.flags & ~bit)
+
+    return property(getter, setter, doc=doc)
+
+def _extension_property(field: str) -> property:
+    """ An optional field kept in the message's `_extensions` dict, None when unset. """
+
+    def getter(self):
+        extensions = self._extensions
+        return extensions.get(field) if extensions is not None else None
+
+    def setter(self, value):
+        if value is not None:
+            if self._extensions is None:
+                self._extensions = {}
+            self._extensions[field] = value
+        elif self._extensions is not None:
+            self._extensions.pop(field, None)
+
+    return property(getter, setter)
 
 class Message:
-    
+
+    __slots__ = ('flags', 'user_count', 'username', 'filename', '_content', 'epoch', '_extensions') + SLOT_FIELDS
+
     def __init__(self, **kwargs):
 
-        
+        flags = kwargs.get('flags', 0)
+        if not _FLAG_NAMES.isdisjoint(kwargs):
+            for key, bit in FLAG_KEYS:
+                if kwargs.get(key):
+                    flags |= bit
+
         # Internal Property     =               JSON Key        Default
-        self._status_request    = kwargs.get('status_request',  False)
-        self._status_response   = kwargs.get('status_response', False)
-        self._user_count        = kwargs.get('user_count',         -1)
-        self._join_request      = kwargs.get('join_request',    False)
-        self._join_accept       = kwargs.get('join_accept',     False)
-        self._join_reject       = kwargs.get('join_reject',     False)
-        self._join_announce     = kwargs.get('join_announce',   False)
-        self._quit_request      = kwargs.get('quit_request',    False)
-        self._quit_accept       = kwargs.get('quit_accept',     False)
-        self._username          = kwargs.get('username',        'Server')
-        self._filename          = kwargs.get('filename',        None)
+        self.flags              = flags
+        self.user_count         = kwargs.get('user_count',         -1)
+        self.username           = kwargs.get('username',        'Server')
+        self.filename           = kwargs.get('filename',        None)
         self._content           = kwargs.get('content',         None)
-        self._timestamp         = kwargs.get('timestamp',       datetime.now())
-    
-    @property
-    def is_status_request(self):
-        """ Get or set whether this message is a request to obtain the Chatroom Status. """
-        return self._status_request
-    
-    @is_status_request.setter
-    def is_status_request(self, value: bool):
-        self._status_request = value
-    
-    @property
-    def is_status_response(self):
-        """ Get or set whether this message is a response to a Status Request. """
-        return self._status_response
-    
-    @is_status_response.setter
-    def is_status_response(self, value: bool):
-        self._status_response = value
-    
-    @property
-    def user_count(self):
-        return self._user_count
-    
-    @user_count.setter
-    def user_count(self, value: int):
-        self._user_count = value
+        self.room               = kwargs.get('room',            None)
+        self.recipients         = kwargs.get('recipients',      None)
+        self.sequence           = kwargs.get('sequence',        None)
+        self.time_ns            = kwargs.get('time_ns',         None)
+        self._extensions        = None if _DICT_FIELDS.isdisjoint(kwargs) else {
+            field: kwargs[field] for field in _DICT_FIELDS.intersection(kwargs) if kwargs[field] is not None
+        } or None
+
+        if (epoch := kwargs.get('epoch')) is not None:
+            self.epoch = int(epoch)
+        elif isinstance((timestamp := kwargs.get('timestamp')), datetime):
+            self.epoch = int(timestamp.timestamp())
+        else:
+            self.epoch = int(time.time())
+
+    is_status_request   = _flag_property(MessageFlag.STATUS_REQUEST,
+        """ Get or set whether this message is a request to obtain the Chatroom Status. """)
+    is_status_response  = _flag_property(MessageFlag.STATUS_RESPONSE,
+        """ Get or set whether this message is a response to a Status Request. """)
+    is_join_request     = _flag_property(MessageFlag.JOIN_REQUEST,
+        """ Get or set whether this message is a request to join the chatroom. """)
+    is_join_accept      = _flag_property(MessageFlag.JOIN_ACCEPT,
+        """ Get or set whether this message is an acceptance of a join request. """)
+    is_join_reject      = _flag_property(MessageFlag.JOIN_REJECT,
+        """ Get or set whether this message is a rejection of a join request. """)
+    is_join_announce    = _flag_property(MessageFlag.JOIN_ANNOUNCE,
+        """ Get or set whether this message is an announcement of a new user. """)
+    is_quit_request     = _flag_property(MessageFlag.QUIT_REQUEST,
+        """ Get or set whether this message is a request to exit the chatroom. """)
+    is_quit_accept      = _flag_property(MessageFlag.QUIT_ACCEPT,
+        """ Get or set whether this message confirms the exit of a user from the chatroom. """)
+    is_transfer_begin   = _flag_property(MessageFlag.TRANSFER_BEGIN,
+        """ Get or set whether this message starts (or resumes) a chunked file transfer. """)
+    is_transfer_chunk   = _flag_property(MessageFlag.TRANSFER_CHUNK,
+        """ Get or set whether this message carries one chunk of a file transfer. """)
+    is_transfer_end     = _flag_property(MessageFlag.TRANSFER_END,
+        """ Get or set whether this message completes a chunked file transfer. """)
+    is_history_request  = _flag_property(MessageFlag.HISTORY_REQUEST,
+        """ Get or set whether this message asks the server to replay part of the chat history. """)
+    is_history_end      = _flag_property(MessageFlag.HISTORY_END,
+        """ Get or set whether this message marks the end of a history replay. """)
+    is_room_join        = _flag_property(MessageFlag.ROOM_JOIN,
+        """ Get or set whether this message asks to join (or confirms joining) the named room. """)
+    is_room_leave       = _flag_property(MessageFlag.ROOM_LEAVE,
+        """ Get or set whether this message asks to leave (or confirms leaving) the named room. """)
+    is_room_list        = _flag_property(MessageFlag.ROOM_LIST,
+        """ Get or set whether this message asks for (or carries) the list of rooms. """)
+    is_blob_request     = _flag_property(MessageFlag.BLOB_REQUEST,
+        """ Get or set whether this message asks for the stored attachment named by `digest`. """)
+    is_blob_response    = _flag_property(MessageFlag.BLOB_RESPONSE,
+        """ Get or set whether this message carries a stored attachment, or reports it missing if it has no `total_size`. """)
+    is_search_request   = _flag_property(MessageFlag.SEARCH_REQUEST,
+        """ Get or set whether this message asks to search a room's messages for the words in `content`. """)
+    is_search_result    = _flag_property(MessageFlag.SEARCH_RESULT,
+        """ Get or set whether this message carries one page of search results. """)
 
     @property
-    def is_join_request(self):
-        """ Get or set whether this message is a request to join the chatroom. """
-        return self._join_request
-    
-    @is_join_request.setter
-    def is_join_request(self, value: bool):
-        self._join_request = value
-    
-    @property
-    def is_join_accept(self):
-        """ Get or set whether this message is an acceptance of a join request. """
-        return self._join_accept
-    
-    @is_join_accept.setter
-    def is_join_accept(self, value: bool):
-        self._join_accept = value
-    
-    @property
-    def is_join_reject(self):
-        """ Get or set whether this message is a rejection of a join request. """
-        return self._join_reject
-    
-    @is_join_reject.setter
-    def is_join_reject(self, value: bool):
-        self._join_reject = value
-    
-    @property
-    def is_join_announce(self):
-        """ Get or set whether this message is an announcement of a new user. """
-        return self._join_announce
-    
-    @is_join_announce.setter
-    def is_join_announce(self, value: bool):
-        self._join_announce = value
-    
-    @property
-    def is_quit_request(self):
-        """ Get or set whether this message is a request to exit the chatroom. """
-        return self._quit_request
-    
-    @is_quit_request.setter
-    def is_quit_request(self, value: bool):
-        self._quit_request = value
-    
-    @property
-    def is_quit_accept(self):
-        """ Get or set whether this message confirms the exit of a user from the chatroom. """
-        return self._quit_accept
-    
-    @is_quit_accept.setter
-    def is_quit_accept(self, value: bool):
-        self._quit_accept = value
-    
-    @property
-    def username(self):
-        """ Get or set the username of the user sending this message. """
-        return self._username
-    
-    @username.setter
-    def username(self, value: str):
-        self._username = value
-    
+    def is_transfer(self) -> bool:
+        """ Whether this message is any part of a chunked file transfer. """
+        return bool(self.flags & _TRANSFER_FLAGS)
+
     @property
-    def filename(self):
-        """ Get or set the filename of the attachment associated with this message. """
-        return self._filename
-    
-    @filename.setter
-    def filename(self, value: str):
-        self._filename = value
-    
+    def carries_bytes(self) -> bool:
+        """ Whether `content` is binary data (base64 encoded on the JSON wire) rather than text. """
+        return self.filename is not None or bool(self.flags & (MessageFlag.TRANSFER_CHUNK | MessageFlag.BLOB_RESPONSE))
+
     @property
     def content(self):
         """ Get or set the contents of this message. """
         return self._content
-    
+
     @content.setter
     def content(self, value: str):
         self._content = value if value else ""
-    
+
+    @property
+    def attachment(self) -> bytes:
+        """ The raw bytes of this message's attachment, whether `content` holds them raw or base64 encoded. """
+        if isinstance(self._content, (bytes, bytearray)):
+            return bytes(self._content)
+        return base64.b64decode(self._content) if self._content else b''
+
     @property
     def content_length(self):
         """ Returns the length of the content of this message. """
         return len(self._content) if self._content else 0
-    
+
     @property
     def timestamp(self):
-        return self._timestamp.strftime('%m-%d-%Y, %I:%M:%S %p')
-    
-    @timestamp.setter
+        """ The time this message was created, or received by the server if it was broadcast, formatted for display. """
+        return format_timestamp(self.time_ns // 1_000_000_000 if self.time_ns is not None else self.epoch)
+
+    @property
+    def formatted_timestamp(self):
+        return self.timestamp
+
+    @formatted_timestamp.setter
     def formatted_timestamp(self, date_str: str):
-        self._timestamp = datetime.strptime(date_str, '%m-%d-%Y, %I:%M:%S %p')
+        self.epoch = int(datetime.strptime(date_str, TIMESTAMP_FORMAT).timestamp())
+
+    def to_dict(self) -> dict:
+        """ The JSON wire representation of this message. Times go over as integers and are only formatted for display.
+            Only the flags that are set are written; a missing flag reads as unset. """
+        flags = self.flags
+        d = {key: True for key, bit in FLAG_KEYS if flags & bit}
+        d['user_count']     = self.user_count
+        d['username']       = self.username
+        d['filename']       = self.filename
+        d['content']        = self._content if not isinstance(self._content, (bytes, bytearray)) \
+                                else base64.b64encode(self._content).decode('ascii')
+        d['content_length'] = len(self._content) if self._content else 0
+        d['epoch']          = self.epoch
+        d.update(self.extensions())
+        return d
+
+    def extensions(self) -> dict:
+        """ The optional fields of this message that are set. """
+        extensions = dict(self._extensions) if self._extensions else {}
+        for field in SLOT_FIELDS:
+            if (value := getattr(self, field)) is not None:
+                extensions[field] = value
+        return extensions
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'Message':
+        """ Build a message from its wire representation. Peers that predate `epoch` only sent the display timestamp.
+            Raises ValueError if `d` is not an object or one of its fields has the wrong type. """
+        if not isinstance(d, dict):
+            raise ValueError('A Message Must Be A JSON Object.')
+        message = cls.__new__(cls)
+        flags = 0
+        if not _FLAG_NAMES.isdisjoint(d):
+            for key, bit in FLAG_KEYS:
+                if d.get(key):
+                    flags |= bit
+        message.flags = flags
+        user_count, username = d.get('user_count', -1), d.get('username', 'Server')
+        filename, content = d.get('filename'), d.get('content')
+        if not isinstance(user_count, int) or not isinstance(username, _TEXT) \
+                or not isinstance(filename, _TEXT) or not isinstance(content, _TEXT):
+            raise ValueError('A Message Field Has The Wrong Type.')
+        message.user_count = user_count
+        message.username = username
+        message.filename = filename
+        message._content = content
+        extensions = {} if _EXTENSION_NAMES.isdisjoint(d) else check_extensions(d)
+        message.room = extensions.pop('room', None)
+        message.recipients = extensions.pop('recipients', None)
+        message.sequence = extensions.pop('sequence', None)
+        message.time_ns = extensions.pop('time_ns', None)
+        message._extensions = extensions or None
+        if (epoch := d.get('epoch')) is not None:
+            if not isinstance(epoch, (int, float)):
+                raise ValueError('Field `epoch` Must Be A Number.')
+            message.epoch = int(epoch)
+        elif (timestamp := d.get('timestamp')):
+            if not isinstance(timestamp, str):
+                raise ValueError('Field `timestamp` Must Be A String.')
+            message.epoch = int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp())
+        else:
+            message.epoch = int(time.time())
+        return message
 
     def to_json(self):
-        return json.dumps(self, cls=MessageEncoder, sort_keys=True) + "\n"
-    
+        return _encode(self.to_dict()) + "\n"
+
     def serialize(self):
         return self.to_json().encode('utf-8')
 
+    @classmethod
+    def deserialize(cls, data: Union[bytes, str]) -> 'Message':
+        """ Decode one newline-delimited JSON frame. """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        return cls.from_dict(_decode(data))
+
+_encode = json.JSONEncoder(ensure_ascii=True).encode
+_decode = json.JSONDecoder().decode
+
+for _field in _DICT_FIELDS:
+    setattr(Message, _field, _extension_property(_field))
+
 class MessageEncoder(json.JSONEncoder):
-    
+
     def default(self, o: Message):
         if not isinstance(o, Message):
             raise TypeError(f'Unexpected Type: {o.__class__.__name__}')
-        return {
-            'status_request': o.is_status_request,
-            'status_response': o.is_status_response,
-            'user_count': o.user_count,
-            'join_request': o.is_join_request,
-            'join_accept': o.is_join_accept,
-            'join_reject': o.is_join_reject,
-            'join_announce': o.is_join_announce,
-            'quit_request': o.is_quit_request,
-            'quit_accept': o.is_quit_accept,
-            'username': o.username,
-            'filename': o.filename,
-            'content': o.content,
-            'content_length': o.content_length,
-            'timestamp': o.timestamp
-        }
-
-class MessageDecoder(json.JSONDecoder):
-
-    def __init__(self, **kwargs):
-        kwargs.setdefault("object_hook", self.object_hook)
-        super().__init__(**kwargs)
-
-    def object_hook(self, d: dict):
-        if (timestamp := d.get('timestamp')):
-            timestamp = datetime.strptime(timestamp, '%m-%d-%Y, %I:%M:%S %p')
-        else:
-            timestamp = datetime.now()
-
-        return Message(
-            status_request      = d.get('status_request'),
-            status_response     = d.get('status_response'),
-            user_count          = d.get('user_count'),
-            join_request        = d.get('join_request'),
-            join_accept         = d.get('join_accept'),
-            join_reject         = d.get('join_reject'),
-            join_announce       = d.get('join_announce'),
-            quit_request        = d.get('quit_request'),
-            quit_accept         = d.get('quit_accept'),
-            username            = d.get('username'),
-            filename            = d.get('filename'),
-            content             = d.get('content'),
-            content_length      = d.get('content_length'),
-            timestamp           = timestamp
-        )
\ No newline at end of file
+        return o.to_dict()
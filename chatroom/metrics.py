@@ -0,0 +1,151 @@
+from typing import Callable, Dict, List, Optional, Sequence, Union
+import asyncio
+import bisect
+import time
+
+# Upper bounds of the timing buckets, in seconds: 1 µs doubling up to about 4 s.
+TIME_BUCKETS = tuple(1e-6 * 2 ** i for i in range(23))
+# Upper bounds of the count buckets, such as recipients per broadcast: powers of two up to 65536.
+COUNT_BUCKETS = tuple(float(2 ** i) for i in range(17))
+
+class Counter:
+    """ A total that only goes up. """
+
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self) -> Union[int, float]:
+        return self.value
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {self.value}']
+
+class Gauge:
+    """ A value read when the metrics are collected, rather than kept up to date. With a `label`,
+        `read` returns a value for each label value, such as the queue depth of each connection. """
+
+    __slots__ = ('name', 'help', 'read', 'label')
+
+    def __init__(self, name: str, help: str, read: Callable[[], Union[float, Dict[str, float]]], label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def snapshot(self) -> Union[float, Dict[str, float]]:
+        return self.read()
+
+    def samples(self) -> List[str]:
+        if self.label is None:
+            return [f'{self.name} {self.read()}']
+        return [f'{self.name}{{{self.label}="{_escape(key)}"}} {value}' for key, value in self.read().items()]
+
+class Histogram:
+    """ Observations counted into fixed buckets, so recording one is a bisect and an increment however
+        many have been seen. Percentiles are interpolated within the bucket they fall in. """
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, help: str, bounds: Sequence[float] = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)      # The last bucket holds everything past the bounds.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float, times: int = 1):
+        """ Record `value`, or `times` observations averaging `value` when timing a batch. """
+        self.counts[bisect.bisect_left(self.bounds, value)] += times
+        self.sum += value * times
+        self.count += times
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else lower * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+async def watch_loop_lag(lag: Histogram, interval: float):
+    """ Sleep for `interval` over and over, observing in `lag` how late the loop wakes each time:
+        how long callbacks that were ready had to wait behind whatever held the loop. """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, time.perf_counter() - started - interval))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+_KINDS = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+class Metrics:
+    """ The instruments one process keeps, collected as a dict for the status response or as
+        Prometheus text for a scraper. Each is also an attribute, by its unprefixed name. """
+
+    def __init__(self, prefix: str = 'chatroom_'):
+        self.prefix = prefix
+        self.instruments: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(name, Counter(self.prefix + name, help))
+
+    def gauge(self, name: str, help: str, read: Callable, label: Optional[str] = None) -> Gauge:
+        return self._add(name, Gauge(self.prefix + name, help, read, label))
+
+    def histogram(self, name: str, help: str, bounds: Sequence[float] = TIME_BUCKETS) -> Histogram:
+        return self._add(name, Histogram(self.prefix + name, help, bounds))
+
+    def _add(self, name: str, instrument):
+        if name in self.instruments:
+            raise ValueError(f'Metric {name} is already registered.')
+        self.instruments[name] = instrument
+        setattr(self, name, instrument)
+        return instrument
+
+    def snapshot(self) -> dict:
+        """ Every metric by its unprefixed name: counters and gauges as values, histograms summarised. """
+        return {name: instrument.snapshot() for name, instrument in self.instruments.items()}
+
+    def render(self) -> str:
+        """ Every metric in the Prometheus text exposition format (version 0.0.4). """
+        lines = []
+        for instrument in self.instruments.values():
+            lines.append(f'# HELP {instrument.name} {instrument.help}')
+            lines.append(f'# TYPE {instrument.name} {_KINDS[type(instrument)]}')
+            lines.extend(instrument.samples())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,54 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+import asyncio
+import enum
+
+class PoolKind(enum.Enum):
+    """ Where CPU-heavy work runs. Threads share the GIL, so they bound how long the loop can be held
+        to a switch interval rather than a whole job; processes take the work off the server's core
+        entirely, for the price of pickling arguments and results. """
+    THREAD  = 'thread'
+    PROCESS = 'process'
+
+class WorkerPool:
+    """ A bounded pool for the work that would otherwise stall every connection: encoding, compressing
+        and decoding big frames, and blocking file I/O. At most `max_pending` jobs are in the pool at once;
+        callers past that wait, so a flood of uploads applies backpressure rather than growing a queue. """
+
+    def __init__(self, kind: PoolKind = PoolKind.THREAD, workers: int = 2, max_pending: int = 64):
+        self.kind = kind
+        self.workers = workers
+        self.cpu_executor: Executor = ProcessPoolExecutor(workers) if kind is PoolKind.PROCESS \
+            else ThreadPoolExecutor(workers, thread_name_prefix='Pool')
+        # One thread, so file writes land in the order they were queued.
+        self.io_executor = ThreadPoolExecutor(1, thread_name_prefix='PoolIO')
+        self.slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+
+    async def submit(self, executor: Executor, fn: Callable, *args) -> asyncio.Future:
+        """ Start `fn(*args)` in `executor` once there is room, without waiting for it to finish. """
+        await self.slots.acquire()
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _: asyncio.Future):
+        self.pending -= 1
+        self.slots.release()
+
+    async def cpu(self, fn: Callable, *args) -> Any:
+        """ Run `fn(*args)` on the CPU pool. With processes, `fn` and its arguments must pickle. """
+        return await (await self.submit(self.cpu_executor, fn, *args))
+
+    async def io(self, fn: Callable, *args) -> Any:
+        """ Run `fn(*args)` on the I/O thread, after whatever was queued before it. """
+        return await (await self.submit(self.io_executor, fn, *args))
+
+    async def queue_io(self, fn: Callable, *args) -> asyncio.Future:
+        """ Queue `fn(*args)` on the I/O thread and return without waiting for it, once there is room. """
+        return await self.submit(self.io_executor, fn, *args)
+
+    def shutdown(self, wait: bool = True):
+        self.cpu_executor.shutdown(wait=wait, cancel_futures=not wait)
+        self.io_executor.shutdown(wait=wait, cancel_futures=not wait)
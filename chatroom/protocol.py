@@ -0,0 +1,166 @@
+from message import Message
+from framing import FrameTooLarge, scan_frames, split_frames
+from typing import Collection, Deque, List, Optional
+import asyncio
+import collections
+import enum
+import time
+
+# Reading pauses once this many decoded messages are waiting to be handled, and resumes once they are.
+INBOX_HIGH = 256
+
+class ServerEngine(enum.Enum):
+    """ How the server reads from its connections. """
+    STREAMS  = 'streams'        # A StreamReader per connection and one awaited read per message.
+    PROTOCOL = 'protocol'       # An asyncio.Protocol that decodes every complete frame per receive.
+
+class TransportWriter:
+    """ The part of the StreamWriter interface a Connection uses, over a bare transport. """
+
+    def __init__(self, transport: asyncio.Transport, protocol: 'ChatroomProtocol'):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data: Collection):
+        self.transport.writelines(data)
+
+    async def drain(self):
+        if self.protocol.lost:
+            raise ConnectionResetError('Connection lost')
+        if self.protocol.paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self.protocol.drain_waiters.append(waiter)
+            await waiter
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self.protocol.closed
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+class ChatroomProtocol(asyncio.Protocol):
+    """ Reads a connection for ChatroomServer without a StreamReader. Each receive is appended to one
+        buffer, every complete frame in it is decoded at once, and `listen` hands the decoded messages
+        to the server in a loop that only suspends when the inbox is empty. """
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = bytearray()
+        self.inbox: Deque[Optional[Message]] = collections.deque()
+        self.waiter: Optional[asyncio.Future] = None
+        self.held = False               # A join request that may change the framing is waiting to be handled.
+        self.eof = False
+        self.done = False               # The end of the stream, or an undecodable frame, is in the inbox.
+        self.skipping = False           # The rest of a JSON frame over the stream limit is still to be dropped.
+        self.skip_bytes = 0             # As are this many bytes of a binary frame over the limit.
+        self.reading = True
+        self.paused = False
+        self.lost = False
+        self.drain_waiters: List[asyncio.Future] = []
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        host, port = transport.get_extra_info('peername')
+        self.connection = self.server.open_connection(None, TransportWriter(transport, self), host, port)
+
+    def data_received(self, data: bytes):
+        self.connection.last_read = time.monotonic()
+        self.buffer += data
+        self.scan()
+
+    def scan(self):
+        """ Decode what is complete in the buffer, unless a join request must be handled first. """
+        if self.held or self.done:
+            return
+        if self.skipping:
+            end = self.buffer.find(b'\n')
+            del self.buffer[:end + 1 if end >= 0 else len(self.buffer)]
+            self.skipping = end < 0
+        if self.skip_bytes:
+            skipped = min(self.skip_bytes, len(self.buffer))
+            del self.buffer[:skipped]
+            self.skip_bytes -= skipped
+        if self.buffer:
+            started = time.perf_counter()
+            framing, limit = self.connection.framing, self.server.frame_limit(self.connection.framing)
+            # Once joined, big frames are left for `listen` to decode in the pool. Until then one may be
+            # the join request that switches the framing, which must be known before scanning on.
+            defer = self.server.config.offload_bytes if self.server.pool is not None and self.connection.key else None
+            messages, used = scan_frames(self.buffer, framing, limit, True, defer)
+            if messages:
+                self.server.received(len(messages), used, time.perf_counter() - started)
+                if self.server.recorder is not None:
+                    # One record per frame, as the streams listener makes, so captures match across engines.
+                    for frame in split_frames(self.buffer[:used], framing, limit):
+                        self.server.recorder.record(self.connection.capture_id, frame)
+                del self.buffer[:used]
+                last = messages[-1]
+                self.held = isinstance(last, Message) and last.framing is not None
+                self.done = last is None
+                if isinstance(last, FrameTooLarge) and not last.complete:
+                    self.skipping, self.skip_bytes = not last.remaining, last.remaining
+                self.inbox.extend(messages)
+                if self.reading and len(self.inbox) >= INBOX_HIGH:
+                    self.reading = False
+                    self.transport.pause_reading()
+        if self.eof and not self.held and not self.done:
+            self.done = True
+            self.inbox.append(None)
+        self.wake()
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        self.scan()
+        return True     # Keep the transport open so whatever is still queued can be flushed.
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.lost = self.eof = True
+        self.scan()
+        self.resume_writing()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters.clear()
+
+    async def listen(self, connection):
+        """ Hand every decoded message to the server in order until it stops reading the connection. """
+        while True:
+            while self.inbox:
+                message = self.inbox.popleft()
+                if isinstance(message, FrameTooLarge):
+                    await self.server.frame_too_large(connection)
+                    continue
+                if isinstance(message, tuple):
+                    message = await self.server.decode_in_pool(*message)
+                if not await self.server.handle_message(connection, message):
+                    return
+                if self.held and message is not None and message.framing is not None:
+                    self.held = False
+                    self.scan()
+            if not self.reading and not self.lost:
+                self.reading = True
+                self.transport.resume_reading()
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
@@ -0,0 +1,36 @@
+from connection import Connection
+from history import ChatHistory
+from search import SearchIndex
+from typing import Dict, Optional, Set
+
+DEFAULT_ROOM = 'lobby'
+
+class Room:
+    """ A named chat scope with its own members and history. Members are keyed by case-folded username;
+        `remote` holds the keys of members connected to other worker processes. """
+
+    __slots__ = ('name', 'key', 'members', 'remote', 'history', 'index')
+
+    def __init__(self, name: str, history: ChatHistory, index: Optional[SearchIndex] = None):
+        self.name = name
+        self.key = name.casefold()
+        self.members: Dict[str, Connection] = {}
+        self.remote: Set[str] = set()
+        self.history = history
+        self.index = index
+
+    def add(self, connection: Connection):
+        self.members[connection.key] = connection
+        connection.rooms.add(self.key)
+
+    def remove(self, connection: Connection):
+        if self.members.get(connection.key) is connection:
+            self.members.pop(connection.key)
+        connection.rooms.discard(self.key)
+
+    def __contains__(self, username: str) -> bool:
+        key = username.casefold()
+        return key in self.members or key in self.remote
+
+    def __len__(self):
+        return len(self.members) + len(self.remote)
@@ -0,0 +1,503 @@
+from server_address import ServerAddress
+from message import FLAG_KEYS, Message
+from framing import Framing, encode, read_message, scan_frames
+from admission import RejectReason
+from compressor import Codec, Inflater
+from pool import WorkerPool
+from blobs import blob_digest
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+import asyncio
+import collections
+import concurrent.futures
+import inspect
+import logging
+import os
+import random
+import uuid
+
+CHUNK_SIZE = 32 * 1024
+STREAM_LIMIT = 2 ** 27
+READ_SIZE = 2 ** 16
+RECONNECT_DELAY = 0.5           # Seconds before the first reconnect attempt, doubling up to RECONNECT_DELAY_MAX.
+RECONNECT_DELAY_MAX = 30.0
+OFFLOAD_BYTES = 16 * 1024       # Encode and decode attachments at least this large in the worker pool, if there is one.
+WRITE_BATCH = 256               # Most queued messages written at once before waiting for the socket to drain.
+
+Handler = Callable[..., Optional[Awaitable[None]]]
+
+class JoinRejected(Exception):
+    """ The server refused to let this client join; `message` is its rejection. """
+
+    def __init__(self, message: Message):
+        super().__init__(message.content)
+        self.message = message
+        self.reason = message.reason
+
+class ClientClosed(ConnectionError):
+    """ The connection ended before the reply being waited for arrived. """
+
+DIRECT = '@'        # What direct messages are tracked under alongside the rooms; no room name starts with it.
+
+def room_key(room: Optional[str]) -> Optional[str]:
+    """ The case-folded name a room is tracked under; None is the default room. """
+    return room.casefold() if room else None
+
+def stream_key(message: Message) -> Optional[str]:
+    """ What `message` is sequenced in: DIRECT for direct messages, else its room's `room_key`. """
+    return DIRECT if message.recipients is not None else room_key(message.room)
+
+def kind(message: Message) -> str:
+    """ What handlers a message goes to: the name of its flag, as in the JSON (`join_announce`, `room_join`,
+        `search_result`, ...), `ping` or `pong` for a heartbeat, `direct` for a direct message, or `chat` for
+        a chat message or attachment. """
+    for key, bit in FLAG_KEYS:
+        if message.flags & bit:
+            return key
+    if message.recipients is not None:
+        return 'direct'
+    if message.ping is not None:
+        return 'ping'
+    if message.pong is not None:
+        return 'pong'
+    return 'chat'
+
+def _resolve(future: Optional[asyncio.Future], result: Any = None, error: Optional[BaseException] = None):
+    if future is not None and not future.done():
+        future.set_exception(error) if error is not None else future.set_result(result)
+
+class ChatClient:
+    """ A chatroom client with no user interface, for bots and integrations, and under the interactive one.
+
+        Sends are pipelined: `send` queues a message and returns, and a writer task writes whatever is
+        queued in one go, encoding it in the framing the connection has negotiated by then. The queue holds
+        `queue_size` messages; past that `send` waits, so a sender is held to the pace of the socket.
+
+        What the server sends goes to the handlers registered with `on` for its `kind`, in order, and then,
+        once something iterates the client (`async for message in client`), to an inbox of `inbox_size`
+        messages. A full inbox stops the reads, which leaves the server to deal with a slow consumer as it
+        does for any other. Handlers run on the reading task, so they must not wait on a reply themselves.
+
+        Heartbeats are answered, messages already delivered are dropped when a replay repeats them, and a
+        dropped connection is resumed, with its rooms, using the session the server handed out. Messages
+        sent while it is down go out once it is back. """
+
+    def __init__(
+        self,
+        server_address: ServerAddress = ServerAddress(),
+        framing: Framing = Framing.JSON,
+        compression: List[Codec] = (),
+        queue_size: int = 1024,
+        inbox_size: int = 1024,
+        reconnect: bool = True,
+        pool: Optional[WorkerPool] = None
+    ):
+        self.server_addr: ServerAddress = server_address
+        self.requested_framing: Framing = framing
+        self.framing: Framing = Framing.JSON
+        self.compression: List[Codec] = list(compression)     # Codecs offered when joining, preferred first.
+        self.reconnect = reconnect
+        self.pool = pool        # Big attachments are encoded and decoded here; None keeps it all on the loop.
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.username: Optional[str] = None
+        self.session: Optional[str] = None      # Token to resume with if the connection drops.
+        self.joined = False
+        self.closed = False                     # Set by `close`, after which nothing reconnects.
+        self.cursors: Dict[Optional[str], int] = {}     # Newest sequence seen, by `stream_key`.
+        self.rooms: Set[str] = set()            # Rooms joined besides the default room.
+        self.replaying: Set[Optional[str]] = set()      # Replays that were asked for, by `stream_key`.
+        self.catching_up: Dict[Optional[str], Set[int]] = {}    # Sequences seen in each room catching up after a resume.
+        self.backoff = RECONNECT_DELAY
+        self.history_limit: Optional[int] = None
+        self.outbox: asyncio.Queue = asyncio.Queue(queue_size)
+        self.inbox_size = inbox_size
+        self.inbox: Optional[asyncio.Queue] = None      # Created when iteration starts.
+        self.handlers: Dict[str, List[Handler]] = {}
+        self.reader_task: Optional[asyncio.Task] = None
+        self.writer_task: Optional[asyncio.Task] = None
+        self.reconnect_task: Optional[asyncio.Task] = None
+        self.finished: Optional[asyncio.Future] = None  # Done once the client is closed or has given up reconnecting.
+        self.resuming = False
+        # Replies being waited for. The server answers each connection's requests in order.
+        self.accepted: Optional[asyncio.Future] = None
+        self.quitting: Optional[asyncio.Future] = None
+        self.searches: Deque[asyncio.Future] = collections.deque()
+        self.blobs: Dict[str, asyncio.Future] = {}
+
+    def on(self, event: str, handler: Optional[Handler] = None):
+        """ Call `handler(message)` for each message of the `kind` `event`, or, for `reconnecting`,
+            `handler(delay)` before each attempt to resume a dropped connection. A coroutine function's
+            result is awaited. Returns the handler, so this also works as a decorator. """
+        if handler is None:
+            return lambda handler: self.on(event, handler)
+        self.handlers.setdefault(event, []).append(handler)
+        return handler
+
+    async def emit(self, event: str, *args):
+        for handler in self.handlers.get(event, ()):
+            try:
+                if inspect.isawaitable(result := handler(*args)):
+                    await result
+            except Exception:
+                self.logger.exception(f'Handler For `{event}` Failed.')
+
+    async def connect(self):
+        """ Open a connection to the server and start reading from it. `join` connects if need be. """
+        self.loop = asyncio.get_running_loop()
+        self.reader, self.writer = await asyncio.open_connection(
+            host=self.server_addr.host,
+            port=self.server_addr.port,
+            limit=STREAM_LIMIT
+        )
+        self.framing = Framing.JSON
+        self.closed = False
+        if self.finished is None or self.finished.done():
+            self.finished = self.loop.create_future()
+        self.reader_task = asyncio.create_task(self.read_loop(self.reader, Inflater() if self.compression else None))
+
+    async def join(
+        self,
+        username: str,
+        session: Optional[str] = None,
+        cursor: Optional[int] = None,
+        history_limit: Optional[int] = None
+    ) -> Message:
+        """ Join the chatroom as `username` and return the server's accept, or raise JoinRejected. The
+            `session` and `cursor` of an earlier join resume it, replaying only what came after. """
+        self.username = username
+        self.session = session
+        self.history_limit = history_limit
+        if cursor is not None:
+            self.cursors[None] = cursor
+        if self.writer is None:
+            await self.connect()
+        return await self.handshake()
+
+    async def handshake(self) -> Message:
+        """ Send the join request on a fresh connection and start writing the queue once it is accepted. """
+        request = Message(
+            join_request=True, username=self.username, session=self.session,
+            cursor=self.cursors.get(None) if self.session is not None else None,
+            history_limit=self.history_limit if self.session is None else None,
+            framing=self.requested_framing.value if self.requested_framing is not Framing.JSON else None,
+            compression=','.join(codec.value for codec in self.compression) or None
+        )
+        self.accepted = self.loop.create_future()
+        self.writer.write(request.serialize())
+        await self.writer.drain()
+        accept = await self.accepted
+        self.writer_task = asyncio.create_task(self.write_loop(self.writer))
+        return accept
+
+    async def status(self) -> Message:
+        """ The server's status response, with its user count and metrics. It is asked on a connection
+            of its own, since the server closes the one it answers on. """
+        reader, writer = await asyncio.open_connection(host=self.server_addr.host, port=self.server_addr.port, limit=STREAM_LIMIT)
+        try:
+            writer.write(Message(status_request=True).serialize())
+            while (message := await read_message(reader)) is not None:
+                if message.is_status_response:
+                    return message
+            raise ClientClosed('Connection Lost.')
+        finally:
+            writer.close()
+
+    async def send(self, message: Message):
+        """ Queue `message` to be sent, waiting only while the queue is full. """
+        await self.outbox.put(message)
+
+    def send_nowait(self, message: Message):
+        """ Queue `message` to be sent, raising asyncio.QueueFull rather than waiting for room. """
+        self.outbox.put_nowait(message)
+
+    def send_threadsafe(self, message: Message) -> concurrent.futures.Future:
+        """ `send` from another thread, such as one reading a terminal. """
+        return asyncio.run_coroutine_threadsafe(self.send(message), self.loop)
+
+    async def drain(self):
+        """ Wait until everything queued so far has been written. """
+        await self.outbox.join()
+
+    async def say(self, content: str, room: Optional[str] = None):
+        await self.send(Message(username=self.username, room=room, content=content))
+
+    async def join_room(self, room: str):
+        await self.send(Message(username=self.username, room=room, room_join=True))
+
+    async def leave_room(self, room: str):
+        await self.send(Message(username=self.username, room=room, room_leave=True))
+
+    async def list_rooms(self):
+        await self.send(Message(username=self.username, room_list=True))
+
+    async def direct(self, recipients: List[str], content: str):
+        """ Send `content` to the named users alone. """
+        await self.send(Message(username=self.username, recipients=list(recipients), content=content))
+
+    async def direct_history(self, limit: Optional[int] = None):
+        """ Ask for this user's recent direct messages again, delivered up to a `history_end` with `recipients` set. """
+        self.replaying.add(DIRECT)
+        await self.send(Message(username=self.username, history_request=True, recipients=[], history_limit=limit))
+
+    async def history(self, room: Optional[str] = None, limit: Optional[int] = None):
+        """ Ask for a room's recent history again. It is delivered, repeats and all, up to its `history_end`. """
+        self.replaying.add(room_key(room))
+        await self.send(Message(username=self.username, room=room, history_request=True, history_limit=limit))
+
+    async def search(
+        self,
+        query: str,
+        room: Optional[str] = None,
+        author: Optional[str] = None,
+        before: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> Message:
+        """ Search a room's messages, newest first. Returns the `search_result`; its `cursor`, passed as
+            `before`, asks for the next page. """
+        future = self.loop.create_future()
+        self.searches.append(future)
+        await self.send(Message(
+            username=self.username, room=room, search_request=True, content=query, author=author,
+            cursor=before, history_limit=limit
+        ))
+        return await future
+
+    async def fetch(self, digest: str) -> Optional[bytes]:
+        """ The bytes of the stored attachment `digest`, or None if the server no longer has it. Raises
+            ValueError if what arrives does not match the digest. """
+        if (future := self.blobs.get(digest)) is None:
+            future = self.blobs[digest] = self.loop.create_future()
+            await self.send(Message(username=self.username, blob_request=True, digest=digest))
+        response = await asyncio.shield(future)
+        if response.total_size is None:
+            return None
+        data = await self.attachment(response)
+        if (await self.pool.cpu(blob_digest, data) if self.pool else blob_digest(data)) != digest:
+            raise ValueError(f'Attachment {digest} Arrived Corrupted.')
+        return data
+
+    async def send_file(self, path: str, room: Optional[str] = None, offset: int = 0, transfer_id: str = None):
+        """ Stream the file at `path` in chunks, starting at `offset`. Passing the `transfer_id`
+            of an interrupted transfer resumes it; receivers write each chunk at its offset. """
+        transfer_id = transfer_id or uuid.uuid4().hex
+        await self.send(Message(
+            username=self.username, room=room, transfer_begin=True, transfer_id=transfer_id,
+            filename=os.path.basename(path), total_size=os.path.getsize(path), offset=offset
+        ))
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while (chunk := await self.read_file(f)):
+                await self.send(Message(
+                    username=self.username, room=room, transfer_chunk=True, transfer_id=transfer_id,
+                    offset=offset, content=chunk
+                ))
+                offset += len(chunk)
+        await self.send(Message(
+            username=self.username, room=room, transfer_end=True, transfer_id=transfer_id, total_size=offset
+        ))
+
+    async def read_file(self, f) -> bytes:
+        if self.pool is not None:
+            return await self.pool.io(f.read, CHUNK_SIZE)
+        return await asyncio.to_thread(f.read, CHUNK_SIZE)
+
+    async def attachment(self, message: Message) -> bytes:
+        """ The decoded attachment of `message`, decoded in the pool if it is big. """
+        if self.pool is not None and message.content_length >= OFFLOAD_BYTES:
+            return await self.pool.cpu(getattr, message, 'attachment')
+        return message.attachment
+
+    async def quit(self, timeout: float = 5.0):
+        """ Leave the chatroom, after everything queued before, and close once the server confirms. """
+        self.quitting = self.loop.create_future()
+        await self.send(Message(username=self.username, quit_request=True))
+        try:
+            await asyncio.wait_for(asyncio.shield(self.quitting), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self.close()
+
+    async def close(self):
+        """ Close the connection without quitting, which leaves the server to hold the session for a while. """
+        self.closed = True
+        for task in (self.reconnect_task, self.writer_task, self.reader_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.lost()
+        self.finish()
+
+    async def wait_closed(self):
+        """ Wait until the client is closed, or has lost its connection for good. """
+        if self.finished is not None:
+            await asyncio.shield(self.finished)
+
+    def __aiter__(self):
+        if self.inbox is None:
+            self.inbox = asyncio.Queue(self.inbox_size)
+        return self
+
+    async def __anext__(self) -> Message:
+        if self.inbox.empty() and (self.finished is None or self.finished.done()):
+            raise StopAsyncIteration
+        if (message := await self.inbox.get()) is None:
+            raise StopAsyncIteration
+        return message
+
+    async def read_loop(self, reader: asyncio.StreamReader, inflater: Optional[Inflater]):
+        """ Dispatch every complete frame in each read, since the server may write many at once. """
+        buffer = bytearray()
+        try:
+            while (data := await reader.read(READ_SIZE)):
+                if inflater is not None:
+                    data = inflater.feed(data)
+                buffer += data
+                # Scan again after a frame that switches the framing, for the frames behind it.
+                while (scanned := scan_frames(buffer, self.framing, STREAM_LIMIT))[0]:
+                    messages, used = scanned
+                    del buffer[:used]
+                    for message in messages:
+                        if message is None:
+                            self.logger.warning('Undecodable Frame Received. Dropping Connection.')
+                            return
+                        await self.dispatch(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if reader is self.reader:
+                self.lost()
+
+    async def write_loop(self, writer: asyncio.StreamWriter):
+        """ Write everything queued in one go, then wait for the socket to take it before writing more. """
+        while True:
+            messages = [await self.outbox.get()]
+            while len(messages) < WRITE_BATCH and not self.outbox.empty():
+                messages.append(self.outbox.get_nowait())
+            try:
+                writer.writelines([await self.encode(message) for message in messages])
+                await writer.drain()
+            except OSError:
+                return
+            finally:
+                for _ in messages:
+                    self.outbox.task_done()
+
+    async def encode(self, message: Message) -> bytes:
+        if self.pool is not None and message.content_length >= OFFLOAD_BYTES:
+            return await self.pool.cpu(encode, message, self.framing)
+        return encode(message, self.framing)
+
+    async def dispatch(self, message: Message):
+        """ Track the session and rooms, settle whatever was waiting on `message`, then hand it on. """
+        if message.sequence is not None:
+            key = stream_key(message)
+            if (caught := self.catching_up.get(key)) is not None:
+                # Live messages and the catch-up replay arrive interleaved, so neither is older than the other.
+                if message.sequence in caught:
+                    return
+                caught.add(message.sequence)
+            elif message.sequence <= self.cursors.get(key, 0) and key not in self.replaying:
+                return      # Already delivered, e.g. live before a replay that repeats it.
+            self.cursors[key] = max(self.cursors.get(key, 0), message.sequence)
+        if message.ping is not None:
+            await self.send(Message(pong=message.ping))
+        elif message.is_join_accept:
+            self.username = message.username
+            self.session = message.session
+            self.joined = True
+            self.backoff = RECONNECT_DELAY
+            self.cursors[None] = max(self.cursors.get(None, 0), message.cursor or 0)
+            if message.framing == Framing.BINARY.value:
+                self.framing = Framing.BINARY
+            _resolve(self.accepted, message)
+        elif message.is_join_reject:
+            if message.reason != RejectReason.RATE_LIMITED.value:
+                self.session = None     # Only a busy server is worth retrying; anything else ends the session.
+            _resolve(self.accepted, error=JoinRejected(message))
+        elif message.is_quit_accept:
+            if message.username == self.username:
+                self.joined = False
+                _resolve(self.quitting, message)
+        elif message.is_history_end:
+            self.replaying.discard(stream_key(message))
+            self.catching_up.pop(stream_key(message), None)
+        elif message.is_room_join or message.is_room_leave:
+            if message.username == self.username:
+                if message.is_room_join:
+                    self.rooms.add(message.room)
+                    self.cursors[room_key(message.room)] = message.cursor or 0
+                else:
+                    self.rooms.discard(message.room)
+        elif message.is_blob_response:
+            _resolve(self.blobs.pop(message.digest, None), message)
+        elif message.is_search_result:
+            if self.searches:
+                _resolve(self.searches.popleft(), message)
+        await self.emit(kind(message), message)
+        if self.inbox is not None:
+            await self.inbox.put(message)
+
+    def lost(self):
+        """ The connection ended: fail what was waiting on it, then resume the session or give up. """
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        self.framing = Framing.JSON
+        error = ClientClosed('Connection Lost.')
+        _resolve(self.accepted, error=error)
+        for future in (*self.searches, *self.blobs.values()):
+            _resolve(future, error=error)
+        self.searches.clear()
+        self.blobs.clear()
+        was_joined, self.joined = self.joined, False
+        if self.closed or self.resuming:
+            return
+        if was_joined and self.reconnect and self.session is not None:
+            self.reconnect_task = asyncio.create_task(self.resume())
+        else:
+            self.finish()
+
+    async def resume(self):
+        """ Reconnect with exponential backoff and resume the session from the newest message seen. """
+        self.resuming = True
+        try:
+            while not self.closed and self.session is not None:
+                delay = random.uniform(self.backoff / 2, self.backoff)
+                self.backoff = min(self.backoff * 2, RECONNECT_DELAY_MAX)
+                await self.emit('reconnecting', delay)
+                await asyncio.sleep(delay)
+                # The server kept this user in its rooms, and its direct messages; catch up on them as on the default room.
+                self.catching_up = {key: set() for key in (DIRECT, *map(room_key, self.rooms))}
+                try:
+                    await self.connect()
+                    await self.handshake()
+                except (OSError, JoinRejected):
+                    continue
+                for room in self.rooms:
+                    await self.send(Message(
+                        username=self.username, history_request=True, room=room, cursor=self.cursors.get(room_key(room), 0)
+                    ))
+                await self.send(Message(
+                    username=self.username, history_request=True, recipients=[], cursor=self.cursors.get(DIRECT, 0)
+                ))
+                return
+        finally:
+            self.resuming = False
+        self.finish()
+
+    def finish(self):
+        _resolve(self.quitting)
+        _resolve(self.finished)
+        if self.inbox is not None and not self.inbox.full():
+            self.inbox.put_nowait(None)     # Wakes an iteration waiting on an empty inbox.
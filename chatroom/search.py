@@ -0,0 +1,128 @@
+from array import array
+from message import Message
+from typing import Dict, List, Optional, Tuple
+import bisect
+import re
+
+_TOKEN = re.compile(r'\w+')
+
+# Longer runs of word characters are pasted data rather than words anyone searches for.
+MAX_TOKEN_LENGTH = 64
+
+def tokenize(text: str) -> List[str]:
+    """ The distinct case-folded words of `text`, in the order they first appear. """
+    return list(dict.fromkeys(
+        token for token in _TOKEN.findall(text.casefold()) if len(token) <= MAX_TOKEN_LENGTH
+    ))
+
+class SearchIndex:
+    """ An inverted index over a room's messages: each word maps to the ascending sequence numbers of
+        the messages that contain it, and each author to the sequence numbers of their messages.
+
+        Messages are added in sequence order, so every posting list is appended to and stays sorted,
+        and receive times line up with sequence numbers, so a time range is a binary search. A query
+        walks its rarest word's postings from the newest match backwards and checks the other words
+        by binary search, so a page costs about what it returns rather than the size of the room.
+        Past `max_messages`, the oldest fall out of results at once and out of memory in batches. """
+
+    def __init__(self, max_messages: Optional[int] = 1_000_000):
+        self.max_messages = max_messages
+        self.postings: Dict[str, array] = {}
+        self.authors: Dict[str, array] = {}
+        self.sequences = array('Q')         # Every message indexed, with its receive time alongside.
+        self.times = array('Q')
+        self.first = 0                      # Offset into `sequences` of the oldest message still searchable.
+
+    def __len__(self):
+        return len(self.sequences) - self.first
+
+    def add(self, message: Message):
+        """ Index a recorded message, by the words of its text or its attachment's filename. """
+        text = message.filename if message.filename is not None else message.content
+        if message.sequence is None or not isinstance(text, str):
+            return
+        sequence = message.sequence
+        for token in tokenize(text):
+            if (postings := self.postings.get(token)) is None:
+                postings = self.postings[token] = array('Q')
+            postings.append(sequence)
+        if (author := self.authors.get(key := (message.username or '').casefold())) is None:
+            author = self.authors[key] = array('Q')
+        author.append(sequence)
+        self.sequences.append(sequence)
+        self.times.append(message.time_ns or 0)
+        if self.max_messages is not None and len(self) > self.max_messages:
+            self.first += 1
+            if self.first >= self.max_messages:
+                self._compact()
+
+    def _compact(self):
+        """ Drop every posting older than the oldest searchable message, once as many are dead as alive. """
+        oldest = self.sequences[self.first]
+        for table in (self.postings, self.authors):
+            for key in list(table):
+                postings = table[key]
+                if postings[-1] < oldest:
+                    del table[key]
+                elif postings[0] < oldest:
+                    del postings[:bisect.bisect_left(postings, oldest)]
+        del self.sequences[:self.first]
+        del self.times[:self.first]
+        self.first = 0
+
+    def search(
+        self,
+        query: str,
+        author: Optional[str] = None,
+        since_ns: Optional[int] = None,
+        until_ns: Optional[int] = None,
+        before: Optional[int] = None,
+        limit: int = 20
+    ) -> Tuple[List[int], Optional[int]]:
+        """ The sequence numbers of up to `limit` messages containing every word of `query`, newest first,
+            optionally only those by `author`, received in [since_ns, until_ns), and older than sequence
+            `before`. Also returns the `before` to ask for the next page with, or None after the last. """
+        if len(self) == 0:
+            return [], None
+        # The range of sequence numbers the filters allow, as [low, high).
+        low = self.sequences[self.first]
+        high = self.sequences[-1] + 1
+        if since_ns is not None:
+            i = bisect.bisect_left(self.times, since_ns, self.first)
+            low = self.sequences[i] if i < len(self.sequences) else high
+        if until_ns is not None:
+            i = bisect.bisect_left(self.times, until_ns, self.first)
+            high = min(high, self.sequences[i] if i < len(self.sequences) else high)
+        if before is not None:
+            high = min(high, before)
+        lists = []
+        for token in tokenize(query):
+            if (postings := self.postings.get(token)) is None:
+                return [], None
+            lists.append(postings)
+        if author is not None:
+            if (postings := self.authors.get(author.casefold())) is None:
+                return [], None
+            lists.append(postings)
+        if not lists or low >= high:
+            return [], None
+        # Walk the shortest list from the newest, checking each posting against the others by binary
+        # search. Walking down, each search can stop where the previous one landed.
+        lists.sort(key=len)
+        driver, others = lists[0], lists[1:]
+        bounds = [len(postings) for postings in others]
+        results: List[int] = []
+        i = bisect.bisect_left(driver, high) - 1
+        stop = bisect.bisect_left(driver, low)
+        while i >= stop:
+            sequence = driver[i]
+            i -= 1
+            for k, postings in enumerate(others):
+                j = bounds[k] = bisect.bisect_left(postings, sequence, 0, bounds[k])
+                if j == len(postings) or postings[j] != sequence:
+                    break
+            else:
+                results.append(sequence)
+                if len(results) == limit:
+                    return results, sequence if i >= stop else None
+        return results, None
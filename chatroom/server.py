@@ -1,96 +1,929 @@
-from message import Message, MessageDecoder
+from message import Message
 from server_address import ServerAddress
+from server_config import ServerConfig
 from connection import Connection
-from typing import List, Dict
+from framing import Framing, FrameTooLarge, read_frame, decode_frame, frame_size, frame_bytes
+from frame import Frame
+from history import ChatHistory, DirectHistory, HistoryEntry, render
+from chatlog import ChatLog
+from capture import Recorder
+from rooms import Room, DEFAULT_ROOM
+from admission import RejectReason, TokenBucket
+from bus import BusClient
+from sessions import Session, SessionTable
+from blobs import BlobStore, Upload, digest_attachment, is_digest, move_blob, write_blob
+from search import SearchIndex
+from compressor import Compression, negotiate
+from metrics import Metrics, COUNT_BUCKETS, watch_loop_lag
+from pool import PoolKind, WorkerPool
+from loops import LoopBackend
+from protocol import ChatroomProtocol, ServerEngine
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import argparse
 import datetime
 import asyncio
-import json
 import logging
-import base64
+import loops
+import signal
+import socket
+import time
 
 logging.basicConfig(
     level = logging.INFO,
     format = '%(asctime)s:%(levelname)s:%(name)s - %(message)s'
 )
 
+ACCEPT_BACKOFF = (0.01, 1.0)    # Seconds to wait after a failed accept, doubling from the first to the second.
+
 class ChatroomServer:
 
-    def __init__(self, address: ServerAddress = ServerAddress()):
+    def __init__(self, address: ServerAddress = ServerAddress(), config: ServerConfig = ServerConfig()):
         
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(config.log_level)
 
-        self.event_loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
         self.address = address
-        self.users: Dict[str, Connection] = {}
-        self.chat_history: List[Message] = []
+        self.config = config
+        self.users: Dict[str, Connection] = {}      # Keyed by case-folded username.
+        self.blobs: Optional[BlobStore] = BlobStore(config.blob_directory, config.blob_quota_bytes) \
+            if config.blob_directory else None
+        self.lobby = Room(
+            DEFAULT_ROOM, ChatHistory(config.history_size, config.history_bytes, self.blobs),
+            # The chat log keeps every message of the default room to render, so its index can outgrow the history.
+            self.new_index(None if config.log_directory and config.worker_id == 0 else config.history_size)
+        )
+        self.rooms: Dict[str, Room] = {self.lobby.key: self.lobby}
+        self.chat_history = self.lobby.history
+        self.direct_history = DirectHistory(config.direct_history_size, config.history_bytes, config.direct_history_user)
+        self.transfers: Dict[str, Message] = {}
+        self.uploads: Dict[Tuple[str, str], Upload] = {}   # Transfers written to the blob store, by user key and transfer id.
+        self.blob_writes: Dict[str, asyncio.Future] = {}    # Blobs being written, done once they are on disk or discarded.
+        self.open_connections = 0
+        self.connections_per_ip: Dict[str, int] = {}
+        self.join_bucket = TokenBucket(config.join_rate, config.join_burst)
+        self.slot_free = asyncio.Event()
+        self.handlers: Set[asyncio.Task] = set()
+        self.connections: Set[Connection] = set()   # Every open connection, joined or not.
+        self.server_task: Optional[asyncio.Task] = None
+        self.stopping = False
+        self.bus: Optional[BusClient] = None
+        self.chat_log: Optional[ChatLog] = None
+        self.metrics = self.register_metrics()
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.lag_task: Optional[asyncio.Task] = None
+        # Big frames are decoded, encoded and compressed here rather than on the loop.
+        self.pool = WorkerPool(config.pool, config.pool_workers, config.pool_pending) \
+            if config.offload_bytes is not None else None
+        self.sessions = SessionTable(config.session_ttl)
+        self.snapshot: Optional[Tuple[Tuple, Frame]] = None     # The last join history sent as a frame of its own, by range.
+        if config.log_directory:
+            self.open_chat_log()
+        # Every frame read from a client is recorded here when capturing, each worker to a file of its own.
+        self.recorder: Optional[Recorder] = None
+        if config.capture_path:
+            self.recorder = Recorder(config.capture_path if not config.worker_id else f'{config.capture_path}.{config.worker_id}')
+            self.logger.info(f'Capturing Client Traffic To {self.recorder.path}')
 
         self.logger.debug('ChatroomServer class initialized.')
 
+    def new_index(self, retained: Optional[int]) -> Optional[SearchIndex]:
+        """ A room's search index, covering no more messages than the room retains (`retained`, None if all). """
+        if self.config.search_index_size is None:
+            return None
+        return SearchIndex(min(self.config.search_index_size, retained or self.config.search_index_size))
+
+    def register_metrics(self) -> Metrics:
+        """ The counters and histograms kept on the hot paths, and gauges read from the server's state
+            whenever the metrics are collected. """
+        metrics = Metrics()
+        metrics.counter('messages_received', 'Messages read from clients.')
+        metrics.counter('bytes_received', 'Bytes of the messages read from clients.')
+        metrics.counter('frames_sent', 'Frames written to clients.')
+        metrics.counter('bytes_sent', 'Bytes written to clients.')
+        metrics.counter('writes', 'Writes to client transports; below frames_sent when frames share a write.')
+        metrics.counter('frames_dropped', 'Frames evicted from full queues by the drop_oldest policy.')
+        metrics.counter('broadcasts', 'Messages relayed to a room or to every user.')
+        metrics.histogram('decode_seconds', 'Time to decode one received message.')
+        metrics.histogram('encode_seconds', 'Time to encode one frame for one framing.')
+        metrics.histogram('compress_seconds', 'Time to compress one frame on its own, or one write through a stream context.')
+        metrics.histogram('fanout_seconds', 'Time to queue one broadcast for all of its recipients.')
+        metrics.histogram('fanout_recipients', 'Recipients of each broadcast.', COUNT_BUCKETS)
+        metrics.counter('direct_messages', 'Direct messages delivered to their recipients.')
+        metrics.histogram('direct_seconds', 'Time to queue one direct message for its recipients on this worker.')
+        metrics.histogram('heartbeat_rtt_seconds', 'Round trip from a ping to its pong.')
+        metrics.histogram('search_seconds', 'Time to find and render one page of search results.')
+        metrics.histogram('loop_lag_seconds', 'How late the event loop ran a timer, sampled every loop_lag_interval.')
+        metrics.counter('offloaded', 'Frames decoded in the worker pool, or queued to wait for their encoding there.')
+        metrics.counter('reaped', 'Connections closed for an idle or write timeout.')
+        metrics.counter('blobs_deduplicated', 'Attachments received that were already in the blob store.')
+        metrics.gauge('connections', 'Open connections, joined or not.', lambda: len(self.connections))
+        metrics.gauge('users', 'Joined users.', lambda: len(self.users))
+        metrics.gauge('rooms', 'Open rooms.', lambda: len(self.rooms))
+        metrics.gauge('transfers', 'File transfers in progress.', lambda: len(self.transfers))
+        metrics.gauge('blobs', 'Attachments in the blob store.', lambda: len(self.blobs) if self.blobs is not None else 0)
+        metrics.gauge('blob_bytes', 'Bytes of the attachments in the blob store.',
+                      lambda: self.blobs.size_bytes if self.blobs is not None else 0)
+        metrics.gauge('pool_pending', 'Jobs submitted to the worker pool and not yet finished.',
+                      lambda: self.pool.pending if self.pool is not None else 0)
+        metrics.gauge('history_messages', 'Messages held in memory across room histories.',
+                      lambda: sum(len(room.history) for room in self.rooms.values()))
+        metrics.gauge('history_bytes', 'Approximate bytes held in memory across room histories.',
+                      lambda: sum(room.history.size_bytes for room in self.rooms.values()))
+        metrics.gauge('direct_history_messages', 'Direct messages held in memory.', lambda: len(self.direct_history))
+        metrics.gauge('search_messages', 'Messages searchable across room indexes.',
+                      lambda: sum(len(room.index) for room in self.rooms.values() if room.index is not None))
+        metrics.gauge('queued_frames', 'Frames waiting in outbound queues.',
+                      lambda: sum(connection.queue.qsize() for connection in self.connections))
+        metrics.gauge('queue_depth', 'Frames waiting in the outbound queue of each connection.', lambda: {
+            connection.username or f'{connection.host}:{connection.port}': connection.queue.qsize()
+            for connection in self.connections
+        }, label='connection')
+        return metrics
+
+    def received(self, messages: int, size: int, decode_seconds: float):
+        """ Count `messages` read from a client in `size` bytes, which took `decode_seconds` to decode. """
+        self.metrics.messages_received.inc(messages)
+        self.metrics.bytes_received.inc(size)
+        self.metrics.decode_seconds.observe(decode_seconds / messages, messages)
+
+    def open_chat_log(self):
+        """ Recover the on-disk chat log and warm the in-memory history with its newest messages. """
+        started = time.perf_counter()
+        self.chat_log = ChatLog(
+            self.config.log_directory,
+            segment_bytes=self.config.log_segment_bytes,
+            fsync_interval=self.config.log_fsync_interval,
+            read_only=self.config.worker_id > 0,
+            executor=self.pool.io_executor if self.pool is not None else None
+        )
+        for data in self.chat_log.tail(self.config.join_history_max):
+            self.chat_history.restore(message := Message.deserialize(data))
+            if self.lobby.index is not None:
+                self.lobby.index.add(message)
+        self.chat_history.next_sequence = self.chat_log.last_sequence + 1
+        self.logger.info(
+            f'Recovered Chat Log Through Sequence {self.chat_log.last_sequence} '
+            f'In {time.perf_counter() - started:.3f}s.'
+        )
+        if self.chat_log.read_only:
+            # Only the first worker appends; the others serve history from memory once warmed.
+            self.chat_log.close()
+            self.chat_log = None
+
     def startup(self):
-        self.server_task = self.event_loop.create_task(self._run(), name='Server')
-        self.event_loop.run_forever()
-        
-        #self.server = await asyncio.start_server(self.awk, self.address.host, self.address.port)
-        #await self.server.serve_forever()
+        """ Run the server on the configured loop backend until SIGINT or SIGTERM. """
+        loops.run(self.serve(handle_signals=True), self.config.loop)
+
+    async def serve(self, handle_signals: bool = False):
+        """ Serve until `stop()` is called (or, with `handle_signals`, SIGINT or SIGTERM arrives),
+            then shut down gracefully. """
+        self.server_task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        if handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.stop)
+        try:
+            await self._run()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.shutdown()
+            if handle_signals:
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    loop.remove_signal_handler(signum)
+
+    def stop(self):
+        """ Begin a graceful shutdown. Further calls while it is under way are ignored. """
+        if self.server_task is not None and not self.stopping:
+            self.stopping = True
+            self.server_task.cancel()
+
+    async def shutdown(self):
+        """ Stop reading from clients, give every connection up to `shutdown_timeout` to flush its
+            outbound queue, then close the connections, the bus and the chat log. """
+        connections = list(self.connections)
+        self.logger.info(f'Shutting Down. Draining {len(connections)} Connections.')
+        for task in list(self.handlers):
+            task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await asyncio.gather(
+            *(connection.close(self.config.shutdown_timeout) for connection in connections),
+            return_exceptions=True
+        )
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.bus is not None:
+            self.bus.task.remove_done_callback(self.bus_lost)
+            await self.bus.close()
+        if self.chat_log is not None:
+            self.log_sync_task.cancel()
+            self.chat_log.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.logger.info(f'Captured {self.recorder.records} Records To {self.recorder.path}')
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.logger.info('Server Stopped.')
 
     async def _run(self):
-        self.server = await asyncio.start_server(self.awk, host=self.address.host, port=self.address.port)
-        async with self.server:
+        if self.config.bus_path:
+            self.bus = BusClient(self.config.worker_id, self.dispatch, self.remote_member, self.remote_release)
+            await self.bus.connect(self.config.bus_path)
+            self.bus.task.add_done_callback(self.bus_lost)
+            await self.bus.ready.wait()
+        self.server = socket.create_server(
+            (self.address.host, self.address.port),
+            backlog=self.config.accept_backlog,
+            reuse_port=self.config.reuse_port
+        )
+        self.server.setblocking(False)
+        if self.chat_log is not None:
+            self.log_sync_task = asyncio.create_task(self._sync_chat_log(), name='ChatLogSync')
+        if any(timeout is not None for timeout in (
+            self.config.ping_interval, self.config.idle_timeout, self.config.write_timeout, self.config.session_ttl
+        )):
+            self.reaper_task = asyncio.create_task(self.reaper(), name='Reaper')
+        if self.config.loop_lag_interval is not None:
+            self.lag_task = asyncio.create_task(
+                watch_loop_lag(self.metrics.loop_lag_seconds, self.config.loop_lag_interval), name='LoopLag'
+            )
+        if self.config.metrics_port is not None:
+            # Workers share the chat port but each serves its own metrics, on consecutive ports.
+            port = self.config.metrics_port + self.config.worker_id
+            self.metrics_server = await asyncio.start_server(self.serve_metrics, self.address.host, port)
+            self.logger.info(f'Serving Metrics on {self.address.host}:{port}')
+        with self.server:
             self.logger.info(f'Listening on {self.address.host}:{self.address.port}')
-            await self.server.serve_forever()
+            await self.accept_loop()
+
+    def bus_lost(self, task: asyncio.Task):
+        """ Without the bus this worker can no longer keep in step with the others, so it stops. """
+        error = None if task.cancelled() else task.exception()
+        self.logger.error('Lost Connection To The Bus. Stopping Worker.', exc_info=error)
+        self.stop()
+
+    async def accept_loop(self):
+        """ Accept connections while fewer than `max_connections` are open. At the limit the loop stops
+            accepting, so new clients queue in the kernel's listen backlog instead of loading the server.
+            A failed accept is logged and retried after a pause, rather than ending the server. """
+        loop = asyncio.get_running_loop()
+        backoff = ACCEPT_BACKOFF[0]
+        while True:
+            if self.open_connections >= self.config.max_connections:
+                self.logger.debug(f'Holding Off Accepting At {self.open_connections} Open Connections.')
+                self.slot_free.clear()
+                while self.open_connections >= self.config.max_connections:
+                    await self.slot_free.wait()
+                    self.slot_free.clear()
+            try:
+                sock, address = await loop.sock_accept(self.server)
+            except OSError as error:
+                # Out of descriptors (EMFILE, ENFILE) or a client gone before it was accepted (ECONNABORTED):
+                # the listener is fine, so wait for descriptors to be freed and accept again.
+                self.logger.warning(f'Failed To Accept A Connection: {error}. Retrying In {backoff:g}s.')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, ACCEPT_BACKOFF[1])
+                continue
+            backoff = ACCEPT_BACKOFF[0]
+            self.configure_socket(sock)
+            ip = address[0]
+            self.open_connections += 1
+            self.connections_per_ip[ip] = self.connections_per_ip.get(ip, 0) + 1
+            task = asyncio.create_task(self.handle(sock, ip))
+            self.handlers.add(task)
+            task.add_done_callback(self.handlers.discard)
+
+    def configure_socket(self, sock: socket.socket):
+        """ Have the kernel probe idle connections, so a peer that vanished without closing is noticed
+            even while nothing is sent to it, and bound how long written data may go unacknowledged. """
+        if self.config.keepalive_idle is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.config.keepalive_idle)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.config.keepalive_interval)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.config.keepalive_count)
+        if self.config.write_timeout is not None and hasattr(socket, 'TCP_USER_TIMEOUT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(self.config.write_timeout * 1000))
+
+    async def handle(self, sock: socket.socket, ip: str):
+        """ Serve one accepted socket, returning its connection slot when it closes. """
+        try:
+            if self.config.engine is ServerEngine.PROTOCOL:
+                _, protocol = await asyncio.get_running_loop().connect_accepted_socket(lambda: ChatroomProtocol(self), sock)
+                await self.serve_connection(protocol.connection, protocol.listen)
+            else:
+                reader, writer = await asyncio.open_connection(sock=sock, limit=self.config.stream_limit)
+                await self.awk(reader, writer)
+        finally:
+            self.open_connections -= 1
+            if (remaining := self.connections_per_ip[ip] - 1):
+                self.connections_per_ip[ip] = remaining
+            else:
+                del self.connections_per_ip[ip]
+            self.slot_free.set()
+
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Answer one HTTP request, whatever its path, with the metrics in the Prometheus text format. """
+        try:
+            while await reader.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            body = self.metrics.render().encode('utf-8')
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def reaper(self):
+        """ Every `reap_interval`, ping connections that have gone quiet, evict those that stay silent
+            past `idle_timeout` or cannot drain their writes within `write_timeout`, and end sessions
+            that were not resumed in time. """
+        ping_interval, idle_timeout, write_timeout = (
+            self.config.ping_interval, self.config.idle_timeout, self.config.write_timeout
+        )
+        while True:
+            await asyncio.sleep(self.config.reap_interval)
+            now = time.monotonic()
+            for session in self.sessions.expired(now):
+                await self.expire(session)
+            ping = None
+            for connection in list(self.connections):
+                if connection.is_closing:
+                    continue
+                if idle_timeout is not None and now - connection.last_read > idle_timeout:
+                    await self.reap(connection, 'Idle Timeout')
+                elif write_timeout is not None and connection.draining_since is not None \
+                        and now - connection.draining_since > write_timeout:
+                    await self.reap(connection, 'Write Timeout')
+                elif ping_interval is not None and now - max(connection.last_read, connection.last_ping) > ping_interval \
+                        and not connection.queue.full():
+                    # One frame for every ping this round; the token is when it was sent, in milliseconds.
+                    ping = ping or Frame.from_message(Message(ping=int(now * 1000)))
+                    connection.last_ping = now
+                    await connection.send(ping)
+
+    async def reap(self, connection: Connection, reason: str):
+        """ Drop a dead connection, discarding what is queued for it, and tell the rooms its user was in
+            that they left. """
+        self.logger.info(f'Reaping {f"@{connection.username}" if connection.username else connection.host}. Reason: {reason}.')
+        self.metrics.reaped.inc()
+        connection.abort()
+        if connection.key and self.users.get(connection.key) is connection:
+            await self.drop(connection)
+
+    async def _sync_chat_log(self):
+        """ Bound how long an appended record can sit unsynced when no further appends arrive. """
+        while True:
+            await asyncio.sleep(self.config.log_fsync_interval)
+            self.chat_log.sync()
+
+    def room_for(self, name: Optional[str]) -> Optional[Room]:
+        return self.rooms.get(name.casefold()) if name else self.lobby
+
+    def record(self, message: Message, room: Optional[Room] = None) -> Frame:
+        """ Add `message` to its room's history (and the chat log, for the default room),
+            returning the frame to broadcast it with. """
+        if room is None:
+            room = self.lobby
+        room.history.append(message)
+        if room.index is not None:
+            room.index.add(message)
+        frame = Frame.from_message(message)
+        if self.chat_log is not None and room is self.lobby:
+            stored = room.history.newest.message
+            stored_frame = frame if stored is message else Frame.from_message(stored)
+            self.chat_log.append(message.sequence, stored_frame.encoded(Framing.JSON, self.metrics.encode_seconds))
+        return frame
+
+    async def broadcast(self, message: Message, room: Optional[Room] = None):
+        """ Record `message` in its room and deliver it to the room's members. With worker processes
+            it goes through the bus, which hands it back to every worker (this one included) in one order. """
+        message.time_ns = time.time_ns()
+        if self.bus is not None:
+            return await self.bus.publish(message)
+        await self.deliver(message, room)
+
+    async def deliver(self, message: Message, room: Optional[Room] = None):
+        if message.recipients is not None:
+            return await self.deliver_direct(message)
+        if room is None:
+            room = self.room_named(message.room)
+        await self.relay(message, frame=self.record(message, room), room=room)
+
+    async def dispatch(self, message: Message):
+        """ Apply a message published on the bus by any worker. """
+        if message.is_transfer:
+            await self.apply_transfer(message)
+        else:
+            await self.deliver(message)
+
+    async def relay(
+        self,
+        message: Message,
+        droppable: bool = True,
+        frame: Optional[Frame] = None,
+        room: Optional[Room] = None
+    ):
+        """ Send `message` to the members of `room` (or every connected user) without recording it. """
+        frame = frame if frame is not None else Frame.from_message(message)
+        recipients = list((room.members if room is not None else self.users).values())
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Forwarding Content From @{message.username} To {len(recipients)} Users.')
+        started = time.perf_counter()
+        for user in recipients:
+            await user.send(frame, droppable)
+        self.metrics.fanout_seconds.observe(time.perf_counter() - started)
+        self.metrics.fanout_recipients.observe(len(recipients))
+        self.metrics.broadcasts.inc()
+
+    async def send_direct(self, connection: Connection, message: Message):
+        """ Send a direct message from the user on `connection` to the users it names. Without worker
+            processes a recipient who is neither connected nor holding a session is reported back to the
+            sender; with them, a name not on any worker is dropped by every worker. """
+        recipients = message.recipients
+        if not isinstance(recipients, list) or not 0 < len(recipients) <= self.config.direct_recipients_max \
+                or not all(isinstance(name, str) and name.strip() for name in recipients):
+            return await self.reply(
+                connection, content=f'A Direct Message Needs 1 To {self.config.direct_recipients_max} Recipients.'
+            )
+        names: Dict[str, str] = {}
+        for name in recipients:
+            names.setdefault(name.strip().lstrip('@').casefold(), name.strip().lstrip('@'))
+        names.pop(connection.key, None)
+        if self.bus is None:
+            missing = [name for key, name in names.items() if key not in self.users and key not in self.sessions]
+            if missing:
+                await self.reply(connection, content=f'No User Named {", ".join(f"@{name}" for name in missing)}.')
+                for name in missing:
+                    names.pop(name.casefold())
+        if not names:
+            return
+        await self.broadcast(Message(
+            username=connection.username, recipients=list(names.values()),
+            content=message.content, filename=message.filename
+        ))
+
+    async def deliver_direct(self, message: Message):
+        """ Record a direct message and queue it for its sender and those of its recipients connected here.
+            Each is looked up by name, so the cost is in the recipients, not the users or any room. """
+        keys = {name.casefold() for name in message.recipients}
+        keys.add(message.username.casefold())
+        self.direct_history.append(message, keys)
+        frame = Frame.from_message(message)
+        started = time.perf_counter()
+        for key in keys:
+            if (connection := self.users.get(key)) is not None:
+                await connection.send(frame)
+        self.metrics.direct_seconds.observe(time.perf_counter() - started)
+        self.metrics.direct_messages.inc()
+
+    async def relay_transfer(self, connection: Connection, message: Message):
+        """ Forward one part of a chunked file transfer as it arrives. Chunks are never dropped and
+            never kept; only a reference to the finished file is added to the chat history. With a blob
+            store the transfer is uploaded into it instead. """
+        if message.is_transfer_begin and ((room := self.room_for(message.room)) is None or connection.key not in room.members):
+            self.logger.info(f'Ignoring Transfer To A Room @{message.username} Is Not In.')
+            return
+        if self.blobs is not None:
+            return await self.upload(connection, message)
+        # The end is recorded as a reference to the file, received when the last of it was.
+        message.time_ns = time.time_ns() if message.is_transfer_end else None
+        if self.bus is not None:
+            return await self.bus.publish(message)
+        await self.apply_transfer(message)
+
+    async def apply_transfer(self, message: Message):
+        if message.is_transfer_begin:
+            self.logger.info(f'@{message.username} Started Transfer {message.transfer_id} Of `{message.filename}`.')
+            self.transfers[message.transfer_id] = message
+            begin = message
+        elif (begin := self.transfers.get(message.transfer_id)) is None or begin.username != message.username:
+            self.logger.info(f'Ignoring Transfer Message For Unknown Transfer {message.transfer_id}.')
+            return
+        room = self.room_named(begin.room)
+        await self.relay(message, droppable=False, room=room)
+        if message.is_transfer_end:
+            self.transfers.pop(message.transfer_id)
+            self.logger.info(f'@{begin.username} Finished Transfer {begin.transfer_id} Of `{begin.filename}`.')
+            self.record(
+                Message(
+                    username=begin.username,
+                    filename=begin.filename,
+                    transfer_id=begin.transfer_id,
+                    total_size=begin.total_size,
+                    room=begin.room,
+                    time_ns=message.time_ns
+                ),
+                room
+            )
+
+    async def upload(self, connection: Connection, message: Message):
+        """ Write a chunked transfer to disk as it arrives rather than forward it, and once it is complete
+            store it like an inline attachment: one reference broadcast in its place. """
+        key = (connection.key, message.transfer_id)
+        if message.is_transfer_begin:
+            self.discard_upload(key)
+            if message.offset:
+                return await self.reply(connection, content='Transfers Cannot Be Resumed. Send The File Again.')
+            if not isinstance(message.total_size, int) or message.total_size > self.config.blob_quota_bytes:
+                return await self.reply(connection, content='The Server Has No Room To Store Your Attachment.')
+            self.logger.info(f'@{message.username} Started Upload {message.transfer_id} Of `{message.filename}`.')
+            self.uploads[key] = await self.io(Upload, message, self.blobs.uploads)
+            return
+        if (upload := self.uploads.get(key)) is None:
+            self.logger.info(f'Ignoring Transfer Message For Unknown Transfer {message.transfer_id}.')
+            return
+        if message.is_transfer_chunk:
+            try:
+                if self.pool is not None and message.content_length >= self.config.offload_bytes:
+                    data = await self.pool.cpu(getattr, message, 'attachment')
+                else:
+                    data = message.attachment
+                if not isinstance(message.offset, int) or not 0 <= message.offset <= upload.begin.total_size - len(data):
+                    raise ValueError('Chunk outside the announced size.')
+                await self.io(upload.write, data, message.offset)
+            except (OSError, TypeError, ValueError) as error:
+                self.discard_upload(key)
+                self.logger.info(f'Abandoned Upload {message.transfer_id} From @{connection.username}: {error}')
+                await self.reply(connection, content='The Server Could Not Store Your Attachment.')
+            return
+        self.uploads.pop(key)
+        try:
+            digest = await self.io(upload.finish)
+            if not await self.keep_blob(connection, upload.begin.filename, digest, upload.size, move_blob, upload.path):
+                return
+        except OSError as error:
+            self.logger.error(f'Could Not Store Attachment `{upload.begin.filename}`: {error}')
+            return await self.reply(connection, content='The Server Could Not Store Your Attachment.')
+        finally:
+            await self.io(upload.discard)
+        self.logger.info(f'@{upload.begin.username} Finished Upload {message.transfer_id} Of `{upload.begin.filename}`.')
+        try:
+            await self.broadcast(Message(
+                username=upload.begin.username, filename=upload.begin.filename, room=upload.begin.room,
+                digest=digest, total_size=upload.size
+            ), self.room_named(upload.begin.room))
+        finally:
+            self.blobs.release(digest)
+
+    def discard_upload(self, key: Tuple[str, str]):
+        if (upload := self.uploads.pop(key, None)) is not None:
+            upload.discard()
+
+    async def store_attachment(self, connection: Connection, message: Message, room: Room):
+        """ Keep an attachment in the blob store and broadcast a reference to it in its place, which
+            clients fetch only if they want the file and have not got it already. """
+        if self.pool is not None and message.content_length >= self.config.offload_bytes:
+            digest, data = await self.pool.cpu(digest_attachment, message)
+        else:
+            digest, data = digest_attachment(message)
+        if not await self.keep_blob(connection, message.filename, digest, len(data), write_blob, data):
+            return
+        try:
+            await self.broadcast(Message(
+                username=message.username, filename=message.filename, room=message.room,
+                digest=digest, total_size=len(data)
+            ), room)
+        finally:
+            self.blobs.release(digest)
+
+    async def keep_blob(self, connection: Connection, filename: str, digest: str, size: int, write: Callable, *args) -> bool:
+        """ Have `write(path, *args)` put blob `digest` on disk unless it is stored already, holding a
+            reference to it for the caller to release. False, with the sender told why, if it is not kept. """
+        # The same file sent again while it is written waits for that write, and makes its own if it fails.
+        while (writing := self.blob_writes.get(digest)) is not None:
+            await asyncio.shield(writing)
+        if digest in self.blobs:
+            self.blobs.retain(digest)
+            self.metrics.blobs_deduplicated.inc()
+            return True
+        if not self.blobs.reserve(size):
+            self.logger.warning(f'Blob Store Full. Dropping Attachment `{filename}` From @{connection.username}.')
+            await self.reply(connection, content='The Server Has No Room To Store Your Attachment.')
+            return False
+        self.blobs.add(digest, size)
+        writing = self.blob_writes[digest] = asyncio.get_running_loop().create_future()
+        try:
+            await self.io(write, self.blobs.path(digest), *args)
+        except OSError as error:
+            self.blobs.discard(digest)
+            self.logger.error(f'Could Not Store Attachment `{filename}`: {error}')
+            await self.reply(connection, content='The Server Could Not Store Your Attachment.')
+            return False
+        finally:
+            del self.blob_writes[digest]
+            writing.set_result(None)
+        return True
+
+    async def io(self, function: Callable, *args):
+        """ Run blocking file I/O in the pool, or on the loop without one. """
+        if self.pool is not None:
+            return await self.pool.io(function, *args)
+        return function(*args)
+
+    async def send_blob(self, connection: Connection, request: Message):
+        """ Send one stored attachment, or a response without a `total_size` if it is not stored. """
+        data = None
+        if self.blobs is not None and is_digest(request.digest):
+            self.blobs.touch(request.digest)
+            data = await self.io(self.blobs.read, request.digest)
+        await connection.send(Frame.from_message(Message(
+            blob_response=True, digest=request.digest, content=data,
+            total_size=len(data) if data is not None else None
+        )), droppable=False)
+
+    async def send_history(self, connection: Connection, request: Message):
+        """ Replay the requested range of history to one connection, then mark its end. With a chat log
+            the stored frames are sent straight from the mapped segments without being decoded. """
+        limit = min(request.history_limit if request.history_limit is not None else self.config.join_history,
+                    self.config.join_history_max)
+        if request.recipients is not None:
+            cursor = request.cursor or 0
+            for entry in self.direct_history.select(connection.key, limit=limit, cursor=request.cursor):
+                await connection.send(Frame.from_message(entry.message), droppable=False)
+                cursor = entry.sequence
+            return await connection.send(Frame.from_message(Message(history_end=True, cursor=cursor, recipients=[])))
+        room = self.room_for(request.room)
+        if room is None or connection.key not in room.members:
+            room = None
+        elif self.chat_log is not None and room is self.lobby:
+            # The newest `limit` records after the cursor, the same window the in-memory history gives.
+            first = max(self.chat_log.first_sequence, self.chat_log.last_sequence - limit + 1)
+            if request.cursor is not None:
+                first = max(first, request.cursor + 1)
+            sent = 0
+            for data in self.chat_log.read(first, limit):
+                await connection.send(Frame.from_encoded(data), droppable=False)
+                sent += 1
+            # Sequence numbers are contiguous, so the last one sent follows from the count.
+            cursor = first + sent - 1 if sent else (request.cursor or 0)
+        else:
+            cursor = request.cursor or 0
+            for entry in (room.history.select(limit=limit, cursor=request.cursor) if room else ()):
+                await connection.send(Frame.from_message(entry.message), droppable=False)
+                cursor = entry.sequence
+        await connection.send(Frame.from_message(Message(history_end=True, cursor=cursor, room=request.room)))
+
+    async def search(self, connection: Connection, request: Message):
+        """ Send one page of the messages in the requested room that match the search, rendered as in the
+            history, newest first. Only the matches are looked up, never the rest of the history. """
+        started = time.perf_counter()
+        room = self.room_for(request.room)
+        results, cursor = [], None
+        if room is not None and room.index is not None and connection.key in room.members:
+            results, cursor = room.index.search(
+                request.content or '',
+                author=request.author,
+                since_ns=request.since_epoch * 1_000_000_000 if request.since_epoch is not None else None,
+                until_ns=request.until_epoch * 1_000_000_000 if request.until_epoch is not None else None,
+                before=request.cursor,
+                limit=max(1, min(request.history_limit or self.config.search_page_max, self.config.search_page_max))
+            )
+        rendered = [(sequence, self.render_sequence(room, sequence)) for sequence in results]
+        results = [sequence for sequence, text in rendered if text]
+        content = ''.join(text for _, text in rendered)
+        self.metrics.search_seconds.observe(time.perf_counter() - started)
+        await connection.send(Frame.from_message(Message(
+            search_result=True, room=request.room, content=content, results=results, cursor=cursor
+        )))
+
+    def render_sequence(self, room: Room, sequence: int) -> str:
+        """ The rendered message `sequence` of `room`, from its history or, once evicted, the chat log. """
+        if (entry := room.history.get(sequence)) is not None:
+            return entry.rendered
+        if self.chat_log is not None and room is self.lobby and sequence >= self.chat_log.first_sequence:
+            for data in self.chat_log.read(sequence, 1):
+                return render(Message.deserialize(data))
+        return ''
 
-    async def broadcast(self, message: Message):
-        self.chat_history.append(message)
-        serialized_message = message.serialize()
-        for username, user in self.users.items():
-            self.logger.info(f'Forwarding Content From @{message.username} to @{username}.')
-            user.writer.write(serialized_message)
-            await user.writer.drain()
+    async def join_room(self, connection: Connection, request: Message):
+        """ Add the requesting user to the named room, creating it if needed, and send them its recent history. """
+        name = (request.room or '').strip()
+        if not name or len(name) > self.config.room_name_max or name.startswith('@'):
+            return await self.reply(connection, room_join=True, content=f'Invalid Room Name `{name}`.')
+        if (room := self.rooms.get(name.casefold())) is None:
+            if len(self.rooms) >= self.config.max_rooms:
+                return await self.reply(connection, room_join=True, content='The Server Has Reached Its Room Limit.')
+            room = self.open_room(name)
+        if connection.key in room.members:
+            return await self.reply(connection, room_join=True, room=room.name, content=f'You Are Already In #{room.name}.')
+        self.add_to_room(connection, room)
+        entries = room.history.select(limit=min(
+            request.history_limit if request.history_limit is not None else self.config.join_history,
+            self.config.join_history_max
+        ), cursor=request.cursor)
+        await self.reply(
+            connection, room_join=True, room=room.name, username=connection.username,
+            content=ChatHistory.render(entries), cursor=room.history.last_sequence
+        )
+        await self.broadcast(
+            Message(join_announce=True, room=room.name, content=f'@{connection.username} Has Joined #{room.name}.'),
+            room
+        )
+
+    async def leave_room(self, connection: Connection, request: Message):
+        """ Remove the requesting user from the named room. Leaving the default room stops its broadcasts
+            reaching the user, who can still rejoin it by name. """
+        room = self.room_for(request.room)
+        if room is None or connection.key not in room.members:
+            return await self.reply(connection, room_leave=True, room=request.room, content=f'You Cannot Leave #{request.room}.')
+        await self.reply(connection, room_leave=True, room=room.name, username=connection.username,
+                         content=f'You Have Left #{room.name}.')
+        self.remove_from_room(connection, room)
+        if room.key in self.rooms:
+            await self.broadcast(Message(room=room.name, content=f'@{connection.username} Has Left #{room.name}.'), room)
+
+    def room_named(self, name: Optional[str]) -> Room:
+        """ The room called `name`, opening it if this worker has not seen it yet. """
+        room = self.room_for(name)
+        return room if room is not None else self.open_room(name)
+
+    def open_room(self, name: str) -> Room:
+        self.logger.info(f'Creating Room #{name}.')
+        room = self.rooms[name.casefold()] = Room(
+            name, ChatHistory(self.config.room_history_size, self.config.history_bytes, self.blobs),
+            self.new_index(self.config.room_history_size)
+        )
+        return room
+
+    def add_to_room(self, connection: Connection, room: Room):
+        room.add(connection)
+        if self.bus is not None:
+            self.bus.member(Message(room_join=True, username=connection.username, room=room.name))
+
+    def remove_from_room(self, connection: Connection, room: Room):
+        room.remove(connection)
+        if self.bus is not None:
+            self.bus.member(Message(room_leave=True, username=connection.username, room=room.name))
+        self.close_if_empty(room)
+
+    def close_if_empty(self, room: Room):
+        if not room.members and not room.remote and room is not self.lobby:
+            self.logger.info(f'Closing Empty Room #{room.name}.')
+            self.rooms.pop(room.key, None)
+            room.history.clear()        # Releasing the attachments it referenced.
+
+    def remote_member(self, message: Message):
+        """ Track a user on another worker joining or leaving a room. """
+        if message.is_room_join:
+            self.room_named(message.room).remote.add(message.username.casefold())
+        elif (room := self.room_for(message.room)) is not None:
+            room.remote.discard(message.username.casefold())
+            self.close_if_empty(room)
+
+    def remote_release(self, key: str):
+        """ Forget a user who left from another worker. """
+        for room in list(self.rooms.values()):
+            if key in room.remote:
+                room.remote.discard(key)
+                self.close_if_empty(room)
+        self.abandon_transfers(key)
+        self.direct_history.forget(key)
+
+    async def list_rooms(self, connection: Connection):
+        content = ''.join(f'#{room.name} ({len(room)} Members)\n' for room in self.rooms.values())
+        await self.reply(connection, room_list=True, user_count=len(self.rooms), content=content)
+
+    async def reply(self, connection: Connection, **kwargs):
+        """ Send a server message to a single connection. """
+        await connection.send(Frame.from_message(Message(**kwargs)))
 
     async def server_status(self, connection: Connection):
         message = Message()
         message.is_status_response = True
         message.user_count = len(self.users)
+        message.stats = self.metrics.snapshot()
         content = ''
-        for i, (username, user) in enumerate(self.users.items()):
-            content += f'{i+1}) @{username} is Connected at {user.host}:{user.port}\n'
+        for i, user in enumerate(self.users.values()):
+            content += f'{i+1}) @{user.username} is Connected at {user.host}:{user.port}\n'
         message.content = content
         self.logger.info('Sending Server Status and Statistics')
-        connection.writer.write(message.serialize())
-        await connection.writer.drain()
-        connection.writer.close()
-        await connection.writer.wait_closed()
+        await connection.send(Frame.from_message(message))
+        await connection.close()
 
     async def listener(
         self,
         connection: Connection
     ):
         while True:
-            data = (await connection.reader.readline()).decode('utf-8')
-            if not data:
-                self.logger.info('Empty Data Received. Killing Connection.')
-                connection.writer.close()
-                await connection.writer.wait_closed()
+            try:
+                message = None
+                if (frame := await read_frame(connection.reader, connection.framing, self.config.max_frame_bytes)) is not None:
+                    connection.last_read = time.monotonic()
+                    if self.recorder is not None:
+                        self.recorder.record(connection.capture_id, frame_bytes(*frame))
+                    started = time.perf_counter()
+                    size = frame_size(*frame)
+                    if self.pool is not None and size >= self.config.offload_bytes:
+                        message = await self.decode_in_pool(*frame)
+                    else:
+                        message = decode_frame(*frame)
+                    self.received(1, size, time.perf_counter() - started)
+            except FrameTooLarge:
+                await self.frame_too_large(connection)
+                continue
+            except (OSError, ValueError):
+                message = None
+            if not await self.handle_message(connection, message):
                 break
-            self.logger.debug(f'Recieved Client Message: {data.strip()}')
-            message = json.loads(data, cls=MessageDecoder)
-
-            if message.is_join_request:
-                self.logger.info(f'Received New User Join Request From User @{message.username}.')
-                await self.new_user(username=message.username, connection=connection)
-            elif message.is_status_request:
-                self.logger.info('Received Server Status Request.')
-                await self.server_status(connection)
-            elif message.is_quit_request:
-                self.logger.info(f'Received Quit Request From User @{message.username}.')
-                await self.disconnect_user(message.username)
-            else:
-                if not self.is_user_connected(message.username):
-                    self.logger.info('Received Unknown Request Type. Killing Connection.')
-                    connection.writer.close()
-                    await connection.writer.wait_closed()
-                await self.broadcast(message)
+
+    async def decode_in_pool(self, header: Optional[Tuple], data: bytes) -> Optional[Message]:
+        """ Decode a big frame read from a client in the pool, off the loop. None if it cannot be decoded. """
+        self.metrics.offloaded.inc()
+        try:
+            return await self.pool.cpu(decode_frame, header, data)
+        except ValueError:
+            return None
+
+    def frame_limit(self, framing: Framing) -> int:
+        """ The longest frame read from a client using `framing`. """
+        return self.config.max_frame_bytes if framing is Framing.BINARY else self.config.stream_limit
+
+    async def frame_too_large(self, connection: Connection):
+        """ Tell a client its frame was skipped for being over the limit for its framing, rather than drop it. """
+        self.logger.info(f'Skipped A Frame Over The Stream Limit From @{connection.username}.')
+        await self.reply(
+            connection, content=f'Messages Are Limited To {self.frame_limit(connection.framing):,} Bytes. Send Larger Files As Transfers.'
+        )
+
+    async def handle_message(self, connection: Connection, message: Optional[Message]) -> bool:
+        """ Act on one message read from `connection`, where None means the stream ended or could not
+            be decoded. Returns False once the connection should no longer be read from. """
+        if message is None:
+            self.logger.info('Empty Data Received. Killing Connection.')
+            if connection.key and self.users.get(connection.key) is connection:
+                connection.is_closing = True
+                await self.drop(connection)
+            await connection.close()
+            return False
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Recieved Client Message From @{message.username} ({connection.framing.value}).')
+
+        if message.ping is not None:
+            await connection.send(Frame.from_message(Message(pong=message.ping)))
+            return True
+        if message.pong is not None:
+            if isinstance(message.pong, int):
+                self.metrics.heartbeat_rtt_seconds.observe(max(0.0, time.monotonic() - message.pong / 1000))
+            return True
+
+        if message.is_join_request and connection.key and self.users.get(connection.key) is connection:
+            # Joining again would orphan the first name, held in `users` with nothing left to release it.
+            self.logger.info(f'Ignoring Join Request As @{message.username} From @{connection.username}, Who Has Joined.')
+            await self.reply(connection, content=f'You Have Already Joined As @{connection.username}.')
+            return True
+        if message.is_join_request:
+            self.logger.info(f'Received New User Join Request From User @{message.username}.')
+            await self.new_user(username=message.username, connection=connection, request=message)
+            return True
+        if message.is_status_request:
+            self.logger.info('Received Server Status Request.')
+            await self.server_status(connection)
+            return True
+        if not self.is_sender(connection, message):
+            self.logger.info(f'Received A Message As @{message.username} On A Connection Not Joined As Them. Killing Connection.')
+            await connection.close()
+            return False
+        # The name the user joined with, whatever case the message spelled it in.
+        message.username = connection.username
+
+        if message.is_quit_request:
+            self.logger.info(f'Accepting Quit Request From @{connection.username}.')
+            await self.depart(connection)
+        elif message.is_room_join:
+            await self.join_room(connection, message)
+        elif message.is_room_leave:
+            await self.leave_room(connection, message)
+        elif message.is_room_list:
+            await self.list_rooms(connection)
+        elif message.is_history_request:
+            await self.send_history(connection, message)
+        elif message.is_search_request:
+            await self.search(connection, message)
+        elif message.is_blob_request:
+            await self.send_blob(connection, message)
+        elif message.is_transfer:
+            await self.relay_transfer(connection, message)
+        elif message.recipients is not None:
+            await self.send_direct(connection, message)
+        elif (room := self.room_for(message.room)) is None or connection.key not in room.members:
+            self.logger.info(f'Dropping Message From @{message.username} To A Room They Are Not In.')
+        elif message.filename is not None and message.content and self.blobs is not None:
+            await self.store_attachment(connection, message, room)
+        else:
+            await self.broadcast(message, room)
+        return True
 
     async def awk(
         self,
@@ -98,91 +931,291 @@ class ChatroomServer:
         writer: asyncio.StreamWriter
     ):
         ip, port = writer.get_extra_info('peername')
-        connection = Connection(reader, writer, ip, port)
-        await self.listener(connection)
+        await self.serve_connection(self.open_connection(reader, writer, ip, port), self.listener)
+
+    def open_connection(self, reader: Optional[asyncio.StreamReader], writer, host: str, port: int) -> Connection:
+        connection = Connection(
+            reader, writer, host, port,
+            max_queue=self.config.queue_size,
+            policy=self.config.slow_consumer_policy,
+            coalesce_delay=self.config.coalesce_delay,
+            coalesce_bytes=self.config.coalesce_bytes,
+            metrics=self.metrics,
+            pool=self.pool,
+            offload_bytes=self.config.offload_bytes
+        )
+        if self.recorder is not None:
+            connection.capture_id = self.recorder.open()
+        connection.start()
+        return connection
 
+    async def serve_connection(self, connection: Connection, listener: Callable[[Connection], Awaitable[None]]):
+        """ Apply the per-address limit, then read from `connection` with `listener` until it is done. """
+        self.connections.add(connection)
+        try:
+            if self.connections_per_ip[connection.host] > self.config.max_connections_per_ip:
+                self.logger.info(f'Rejecting Connection From {connection.host}. Reason: Per-Address Limit.')
+                return await self.reject(
+                    connection, RejectReason.PER_IP_LIMIT, f'Too Many Connections From {connection.host}.'
+                )
+            await listener(connection)
+        finally:
+            self.connections.discard(connection)
+            if self.recorder is not None:
+                self.recorder.end(connection.capture_id)
+            if connection.key and self.users.get(connection.key) is connection and not self.stopping:
+                # The listener stopped without handling the end of the stream, so its user is dropped here,
+                # where the reaper, which only sees open connections, cannot miss it.
+                connection.abort()
+                await self.drop(connection)
 
-    async def new_user(self, username: str, connection: Connection):
+    def release(self, connection: Connection):
+        """ Forget the user bound to `connection`, if it still owns that username. """
+        if connection.key and self.users.get(connection.key) is connection:
+            self.logger.info(f'Releasing Username @{connection.username}.')
+            self.users.pop(connection.key)
+            self.forget(connection)
 
-        self.logger.debug(f'Currently Connected Users: {list(self.users.keys())}')
-        
-        if len(self.users) >= 2:
+    def forget(self, connection: Connection):
+        """ Take a user already removed from `users` out of its rooms and transfers. """
+        for key in list(connection.rooms):
+            self.remove_from_room(connection, self.rooms[key])
+        self.abandon_transfers(connection.key)
+        self.direct_history.forget(connection.key)
+        if connection.session is not None:
+            self.sessions.end(connection.session)
+            connection.session = None
+        if self.bus is not None:
+            self.bus.release(connection.key)
+
+    def abandon_transfers(self, key: str):
+        """ Forget any transfers the user with case-folded name `key` started but never finished. """
+        for transfer_id, begin in list(self.transfers.items()):
+            if begin.username.casefold() == key:
+                self.transfers.pop(transfer_id)
+        for upload_key in [upload_key for upload_key in self.uploads if upload_key[0] == key]:
+            self.discard_upload(upload_key)
+
+
+    async def new_user(self, username: str, connection: Connection, request: Optional[Message] = None):
+
+        if not username or not username.strip():
+            self.logger.info('Rejecting New User Join Request. Reason: No Username.')
+            await self.reject(connection, RejectReason.INVALID_USERNAME, 'A Username Is Required To Join The Chatroom.')
+
+        elif request is not None and (session := self.sessions.resumable(request.session, username)) is not None:
+            await self.resume(connection, session, request)
+
+        elif len(self.users) + len(self.sessions.detached) >= self.config.capacity:
             self.logger.info('Rejecting New User Join Request. Reason: Maximum Capacity.')
-            connection.writer.write(
-                Message(
-                    join_reject=True,
-                    content=f'Sorry @{username}, The Server Is At Maximum Capacity.'
-                ).serialize()
-            )
-            await connection.writer.drain()
-            connection.writer.close()
-            await connection.writer.wait_closed()
+            await self.reject(connection, RejectReason.CAPACITY, f'Sorry @{username}, The Server Is At Maximum Capacity.')
 
-        elif username in list(self.users.keys()):
+        elif username.casefold() in self.users or username.casefold() in self.sessions:
             self.logger.info('Rejecting New User Join Request. Reason: User Exists.')
-            connection.writer.write(
-                Message(
-                    join_reject=True,
-                    content=f'A User By The Name @{username} Is Already In This Chatroom.'
-                ).serialize()
+            await self.reject(
+                connection, RejectReason.USERNAME_TAKEN, f'A User By The Name @{username} Is Already In This Chatroom.'
             )
-            await connection.writer.drain()
-            connection.writer.close()
-            await connection.writer.wait_closed()
+
+        elif not self.join_bucket.take():
+            self.logger.info('Rejecting New User Join Request. Reason: Join Rate Limit.')
+            await self.reject(
+                connection, RejectReason.RATE_LIMITED, 'The Server Is Busy Accepting Other Users, Please Try Again Shortly.'
+            )
+
+        elif self.bus is not None and (reason := await self.bus.claim(username.casefold())):
+            self.logger.info(f'Rejecting New User Join Request. Reason: {reason} On Another Worker.')
+            await self.reject(connection, RejectReason(reason), (
+                f'A User By The Name @{username} Is Already In This Chatroom.' if reason == RejectReason.USERNAME_TAKEN.value
+                else f'Sorry @{username}, The Server Is At Maximum Capacity.'
+            ))
 
         else:
             self.logger.info('Accepting New User Join Request.')
-            self.users[username] = connection
-            self.logger.info('Sending Chat History To New User.')
-            connection.writer.write(
-                Message(
-                    join_accept=True,
-                    username=username,
-                    content=self.formatted_chat_history
-                ).serialize()
-            )
-            await connection.writer.drain()
+            connection.username = username
+            connection.key = username.casefold()
+            self.users[connection.key] = connection
+            connection.session = self.sessions.issue(connection)
+            self.add_to_room(connection, self.lobby)
+            await self.accept(connection, request or Message(join_request=True, username=username))
             self.logger.info('Broadcasting New User Announcement.')
             await self.broadcast(
                 Message(
                     join_announce=True,
                     username='Server',
                     content=f'@{username} Has Joined The Chat.'
-                )
+                ),
+                self.lobby
             )
 
-        self.logger.debug(f'Currently Connected Users: {list(self.users.keys())}')
+    async def accept(self, connection: Connection, request: Message):
+        """ Send the join accept, with the history the request asked for and the session token, and switch
+            to binary framing if that was requested and allowed. With compression negotiated, everything from
+            the accept on is enveloped, and the history follows the accept in a frame shared between joins. """
+        self.logger.info('Sending Chat History To New User.')
+        binary = request.framing == Framing.BINARY.value and self.config.allow_binary
+        if (codec := negotiate(request.compression, self.config.compression)) is not None:
+            self.logger.info(f'Compressing Frames To @{connection.username} With {codec.value}.')
+            connection.compression = Compression(
+                codec, self.config.compression_threshold, self.config.compression_level, self.config.compression_stream
+            )
+        await connection.send(Frame.from_message(
+            Message(
+                join_accept=True,
+                username=connection.username,
+                content=self.history_for(request) if codec is None else None,
+                cursor=self.chat_history.last_sequence,
+                framing=Framing.BINARY.value if binary else None,
+                compression=codec.value if codec is not None else None,
+                session=connection.session.token
+            )
+        ))
+        if binary:
+            self.logger.info(f'Switching @{connection.username} To Binary Framing.')
+            connection.framing = Framing.BINARY
+        if codec is not None:
+            await connection.send(self.history_frame(request))
 
-    def is_user_connected(self, username: str) -> bool:
-        return username.lower() in list(map(lambda s: s.lower(), list(self.users.keys())))
-    
-    async def disconnect_user(self, username: str):
-        if (connection := self.users.get(username)):
-            try:
-                self.logger.info(f'Accepting Quit Request From @{username}')
-                message = Message(
-                    quit_accept = True,
-                    content=f'@{username} Has Left The Chat.',
-                    username=username
-                )
-                await self.broadcast(message)
-                self.users.pop(username) # AKA True
-            except KeyError:
-                return
-        return
+    async def resume(self, connection: Connection, session: Session, request: Message):
+        """ Put a returning user back in its rooms without announcing it, sending only the history after
+            the cursor in its request. A connection the session is still attached to is taken to be dead. """
+        self.logger.info(f'Resuming Session For @{session.username}.')
+        if (old := session.connection) is not None:
+            old.session = None
+            old.abort()
+            self.users.pop(old.key, None)
+            session.rooms = set(old.rooms)
+            for key in session.rooms:
+                self.rooms[key].remove(old)
+        self.sessions.attach(session, connection)
+        connection.username = session.username
+        connection.key = session.key
+        connection.session = session
+        self.users[connection.key] = connection
+        for key in session.rooms:
+            # A room that emptied and closed while the user was away is not reopened.
+            if (room := self.rooms.get(key)) is not None:
+                room.add(connection)
+        await self.accept(connection, request)
+
+    async def drop(self, connection: Connection):
+        """ Handle a joined user whose connection ended without a quit request. With sessions its name
+            and rooms are held for `session_ttl` so it can resume unannounced; otherwise it departs. """
+        if connection.session is None or not self.sessions.ttl or self.bus is not None:
+            return await self.depart(connection)
+        self.logger.info(f'Holding Session For @{connection.username} For {self.sessions.ttl:g}s.')
+        self.users.pop(connection.key)
+        rooms = set(connection.rooms)
+        for key in rooms:
+            # Out of the members, so nothing more is queued for it, but its rooms are not left.
+            self.rooms[key].remove(connection)
+        self.abandon_transfers(connection.key)
+        self.sessions.detach(connection.session, rooms)
+        connection.session = None
+
+    async def expire(self, session: Session):
+        """ End a session that was not resumed in time, announcing that its user left. """
+        self.logger.info(f'Session For @{session.username} Expired.')
+        self.sessions.end(session)
+        self.direct_history.forget(session.key)
+        for key in session.rooms:
+            if (room := self.rooms.get(key)) is not None:
+                await self.broadcast(self.quit_announcement(session.username, room), room)
+                self.close_if_empty(room)
+
+    def quit_announcement(self, username: str, room: Room) -> Message:
+        return Message(
+            quit_accept = True,
+            content=f'@{username} Has Left The Chat.',
+            username=username,
+            room=None if room is self.lobby else room.name
+        )
+
+    async def reject(self, connection: Connection, reason: RejectReason, content: str):
+        """ Refuse a join with a reason the client can act on, then close the connection. """
+        await connection.send(Frame.from_message(Message(join_reject=True, reason=reason.value, content=content)))
+        await connection.close()
+
+    def is_sender(self, connection: Connection, message: Message) -> bool:
+        """ Whether `message` names the user joined on `connection` as its sender. Anything but a join
+            or status request must, so no connection speaks for a user joined on another. """
+        return connection.key is not None and self.users.get(connection.key) is connection \
+            and isinstance(message.username, str) and message.username.casefold() == connection.key
+
+    async def depart(self, connection: Connection):
+        """ Release the user on `connection` and announce that it left every room it was in. The
+            username is released first, so nothing else departs it while the announcements are sent. """
+        self.logger.info(f'Releasing Username @{connection.username}.')
+        self.users.pop(connection.key)
+        if not connection.rooms:
+            await self.reply(
+                connection, quit_accept=True, username=connection.username,
+                content=f'@{connection.username} Has Left The Chat.'
+            )
+        for key in list(connection.rooms):
+            room = self.rooms[key]
+            await self.broadcast(self.quit_announcement(connection.username, room), room)
+        self.forget(connection)
+
+    def join_entries(self, request: Message) -> List[HistoryEntry]:
+        """ The history a joining user asked for: messages after its `cursor` or `since_epoch`, capped to
+            `history_limit` (or the configured default) newest messages. """
+        limit = request.history_limit if request.history_limit is not None else self.config.join_history
+        return self.chat_history.select(
+            limit=min(limit, self.config.join_history_max),
+            cursor=request.cursor,
+            since_epoch=request.since_epoch
+        )
+
+    def history_for(self, request: Message) -> str:
+        """ The pre-rendered history a joining user asked for. """
+        return ChatHistory.render(self.join_entries(request))
+
+    def history_frame(self, request: Message) -> Frame:
+        """ The history a joining user asked for as a history end frame. Joins asking for the same range
+            before the next message share the frame, so it is rendered and compressed once for all of them. """
+        entries = self.join_entries(request)
+        key = (entries[0].sequence if entries else None, self.chat_history.last_sequence)
+        if self.snapshot is None or self.snapshot[0] != key:
+            self.snapshot = key, Frame.from_message(
+                Message(history_end=True, content=ChatHistory.render(entries), cursor=self.chat_history.last_sequence)
+            )
+        return self.snapshot[1]
 
     @property
     def formatted_chat_history(self):
-        message_history = ""
-        for message in self.chat_history:
-            if message.filename is not None:
-                file_contents = base64.b64decode(message.content).decode()
-                message_history += f'[{message.timestamp}] @{message.username}: * sent an attachment: `{message.filename}`\n'
-                message_history += f'----\nFile Contents\n----\n{file_contents}\n'
-            else:
-                message_history += f'[{message.timestamp}] @{message.username}: {message.content.strip()}\n'
-        return message_history
+        return self.history_for(Message())
 
 if __name__ == '__main__':
-    server = ChatroomServer()
-    server.startup()
+    parser = argparse.ArgumentParser(description='Run the chatroom server.')
+    parser.add_argument('--host', default=ServerAddress().host)
+    parser.add_argument('--port', type=int, default=ServerAddress().port)
+    parser.add_argument('--workers', type=int, default=1, help='server processes sharing the port')
+    parser.add_argument('--coalesce-ms', type=float, default=0.0, help='hold outgoing frames up to this long to write them together')
+    parser.add_argument('--engine', default=ServerEngine.STREAMS.value, choices=[engine.value for engine in ServerEngine])
+    parser.add_argument('--loop', default=LoopBackend.AUTO.value, choices=[backend.value for backend in LoopBackend],
+                        help='event loop backend; auto picks uvloop when it is installed')
+    parser.add_argument('--pool', default=PoolKind.THREAD.value, choices=[kind.value for kind in PoolKind] + ['off'],
+                        help='where big frames are decoded, encoded and compressed; off keeps it all on the loop')
+    parser.add_argument('--blob-directory', help='keep attachments here and send references to them instead')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics over HTTP on this port')
+    parser.add_argument('--capture', help='record every frame read from clients to this file, for bench/capture_replay.py')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+    address = ServerAddress(args.host, args.port)
+    config = ServerConfig(
+        loop=LoopBackend(args.loop),
+        engine=ServerEngine(args.engine),
+        coalesce_delay=args.coalesce_ms / 1000,
+        log_level=getattr(logging, args.log_level),
+        metrics_port=args.metrics_port,
+        blob_directory=args.blob_directory,
+        capture_path=args.capture,
+        offload_bytes=None if args.pool == 'off' else ServerConfig().offload_bytes,
+        pool=PoolKind(args.pool) if args.pool != 'off' else ServerConfig().pool
+    )
+    if args.workers > 1:
+        from workers import serve_workers
+        loops.run(serve_workers(address, config, args.workers, config.log_level), config.loop)
+    else:
+        server = ChatroomServer(address, config)
+        server.startup()
@@ -0,0 +1,79 @@
+from compressor import Codec
+from connection import SlowConsumerPolicy
+from loops import LoopBackend
+from pool import PoolKind
+from protocol import ServerEngine
+from typing import NamedTuple, Optional, Tuple
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DESCRIPTOR_HEADROOM = 64    # Descriptors left for the listener, logs, blobs, the bus and the metrics server.
+
+def connection_limit(wanted: int) -> int:
+    """ `wanted`, or fewer when the process may not open that many descriptors besides its own. """
+    if resource is None:
+        return wanted
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return wanted if soft == resource.RLIM_INFINITY else max(1, min(wanted, soft - DESCRIPTOR_HEADROOM))
+
+class ServerConfig(NamedTuple):
+    loop:                   LoopBackend         = LoopBackend.AUTO
+    engine:                 ServerEngine        = ServerEngine.STREAMS
+    capacity:               int                 = 1000
+    max_connections:        int                 = connection_limit(1100)  # Capped below RLIMIT_NOFILE.
+    max_connections_per_ip: int                 = 100
+    join_rate:              float               = 100.0
+    join_burst:             int                 = 200
+    accept_backlog:         int                 = 1024
+    reuse_port:             bool                = False
+    bus_path:               Optional[str]       = None      # Set for each process in `--workers` mode.
+    worker_id:              int                 = 0
+    queue_size:             int                 = 1024
+    slow_consumer_policy:   SlowConsumerPolicy  = SlowConsumerPolicy.DROP_OLDEST
+    coalesce_delay:         float               = 0.0       # Seconds frames may wait to share a write; 0 disables coalescing.
+    coalesce_bytes:         int                 = 64 * 1024 # Write as soon as this much is waiting, whatever the delay.
+    allow_binary:           bool                = True
+    compression:            Tuple[Codec, ...]   = (Codec.ZSTD, Codec.ZLIB)  # Codecs clients may negotiate; () disables.
+    compression_threshold:  int                 = 512       # Compress frames this large on their own, once for all recipients.
+    compression_level:      Optional[int]       = None      # None uses each codec's default.
+    compression_stream:     bool                = False     # Compress smaller frames too, through a context per connection.
+    stream_limit:           int                 = 2 ** 16   # Longest JSON frame read from a client.
+    max_frame_bytes:        int                 = 2 ** 24   # Longest binary frame body read from a client.
+    offload_bytes:          Optional[int]       = 32 * 1024 # Decode, encode and compress frames this large in the pool; None keeps it all on the loop.
+    pool:                   PoolKind            = PoolKind.THREAD
+    pool_workers:           int                 = 2
+    pool_pending:           int                 = 64        # Jobs in the pool at once; past this, submitters wait.
+    history_size:           int                 = 10_000
+    history_bytes:          int                 = 64 * 1024 * 1024
+    join_history:           int                 = 100
+    join_history_max:       int                 = 1000
+    max_rooms:              int                 = 1000
+    room_name_max:          int                 = 32
+    room_history_size:      int                 = 1000
+    direct_recipients_max:  int                 = 20
+    direct_history_size:    int                 = 10_000    # Direct messages kept in all, apart from any room's history.
+    direct_history_user:    int                 = 1000      # Direct messages kept for each user, until the name is released.
+    search_index_size:      Optional[int]       = 1_000_000 # Newest messages of each room kept searchable; None disables search.
+    search_page_max:        int                 = 100
+    log_directory:          Optional[str]       = None
+    log_segment_bytes:      int                 = 256 * 1024 * 1024
+    log_fsync_interval:     float               = 0.05
+    capture_path:           Optional[str]       = None      # Record every frame read from clients to this file (a worker's gets its id appended).
+    blob_directory:         Optional[str]       = None      # Keep attachments here and broadcast references; None relays them inline.
+    blob_quota_bytes:       int                 = 1024 ** 3 # Unreferenced blobs are evicted, least recently used first, to stay under this.
+    shutdown_timeout:       float               = 5.0       # Seconds each connection gets to drain its queue on shutdown.
+    ping_interval:          Optional[float]     = 30.0      # Ping a connection silent for this long; None disables pings.
+    idle_timeout:           Optional[float]     = 75.0      # Reap a connection silent for this long, pings unanswered.
+    write_timeout:          Optional[float]     = 30.0      # Reap a connection whose writes have not drained for this long.
+    reap_interval:          float               = 5.0       # Seconds between checks for the timeouts above.
+    keepalive_idle:         Optional[int]       = 60        # TCP keepalive: seconds idle before probing; None disables.
+    keepalive_interval:     int                 = 10
+    keepalive_count:        int                 = 5
+    session_ttl:            Optional[float]     = 60.0      # Hold a dropped user's name and rooms this long for a resume.
+    log_level:              int                 = logging.INFO  # DEBUG adds a line for every message handled.
+    metrics_port:           Optional[int]       = None      # Serve Prometheus metrics over HTTP here (plus the worker id).
+    loop_lag_interval:      Optional[float]     = 0.05      # Seconds between event loop lag samples; None disables them.
@@ -0,0 +1,60 @@
+from connection import Connection
+from typing import Dict, List, Optional, Set
+import secrets
+import time
+
+class Session:
+    """ A joined user's claim to resume after its connection drops: its username and the rooms it was in.
+        While detached (`connection` is None) the username stays reserved until `expires`. """
+
+    __slots__ = ('token', 'username', 'key', 'rooms', 'connection', 'expires')
+
+    def __init__(self, token: str, connection: Connection):
+        self.token = token
+        self.username = connection.username
+        self.key = connection.key
+        self.rooms: Set[str] = set()        # Room keys, kept while detached.
+        self.connection: Optional[Connection] = connection
+        self.expires: Optional[float] = None
+
+class SessionTable:
+    """ Sessions by token, and the detached ones by case-folded username. """
+
+    def __init__(self, ttl: Optional[float]):
+        self.ttl = ttl
+        self.sessions: Dict[str, Session] = {}
+        self.detached: Dict[str, Session] = {}
+
+    def issue(self, connection: Connection) -> Session:
+        session = Session(secrets.token_urlsafe(16), connection)
+        self.sessions[session.token] = session
+        return session
+
+    def resumable(self, token: Optional[str], username: str) -> Optional[Session]:
+        """ The session `token` names, if it exists and belongs to `username`. """
+        session = self.sessions.get(token) if token else None
+        return session if session is not None and session.key == username.casefold() else None
+
+    def detach(self, session: Session, rooms: Set[str]):
+        """ Hold `session` for `ttl` seconds after its connection was lost in `rooms`. """
+        session.connection = None
+        session.rooms = set(rooms)
+        session.expires = time.monotonic() + self.ttl
+        self.detached[session.key] = session
+
+    def attach(self, session: Session, connection: Connection):
+        session.connection = connection
+        session.expires = None
+        self.detached.pop(session.key, None)
+
+    def end(self, session: Session):
+        self.sessions.pop(session.token, None)
+        if self.detached.get(session.key) is session:
+            self.detached.pop(session.key)
+
+    def expired(self, now: float) -> List[Session]:
+        return [session for session in self.detached.values() if session.expires <= now]
+
+    def __contains__(self, key: str) -> bool:
+        """ Whether a detached session holds the case-folded username `key`. """
+        return key in self.detached
@@ -0,0 +1,68 @@
+from blobs import BlobStore, blob_digest, write_blob
+from server import ChatroomServer
+from server_address import ServerAddress
+from server_config import ServerConfig
+import asyncio
+import logging
+
+class Sink:
+    """ Stands in for the sender's connection, keeping what it is sent. """
+    username = 'eve'
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame, droppable=True):
+        self.frames.append(frame)
+
+def test_discard_forgets_a_referenced_blob(tmp_path):
+    blobs = BlobStore(str(tmp_path), quota_bytes=100)
+    blobs.add('a' * 64, 60)
+    blobs.discard('a' * 64)
+    assert 'a' * 64 not in blobs and blobs.size_bytes == 0 and blobs.reserve(100)
+
+def test_unreferenced_blobs_are_evicted_oldest_first(tmp_path):
+    blobs = BlobStore(str(tmp_path), quota_bytes=100)
+    for digest in ('a' * 64, 'b' * 64):
+        blobs.add(digest, 40)
+        blobs.release(digest)
+    blobs.touch('a' * 64)
+    assert blobs.reserve(40) and 'b' * 64 not in blobs and 'a' * 64 in blobs
+    blobs.retain('a' * 64)
+    assert not blobs.reserve(80)
+
+def test_blobs_on_disk_are_indexed_on_start(tmp_path):
+    data = b'attachment'
+    digest = blob_digest(data)
+    blobs = BlobStore(str(tmp_path))
+    write_blob(blobs.path(digest), data)
+    reloaded = BlobStore(str(tmp_path))
+    assert len(reloaded) == 1 and reloaded.size_bytes == len(data) and reloaded.read(digest) == data
+
+def test_duplicate_waits_for_the_first_write_and_retries_after_a_failure(tmp_path):
+    async def main():
+        server = ChatroomServer(ServerAddress(), ServerConfig(
+            blob_directory=str(tmp_path), offload_bytes=None, log_level=logging.WARNING
+        ))
+        data = b'attachment'
+        digest = blob_digest(data)
+        writes = []
+
+        async def write(function, *args):
+            writes.append(len(writes))
+            await asyncio.sleep(0.01)
+            if len(writes) == 1:
+                raise OSError('disk full')
+            function(*args)
+        server.io = write
+
+        first, second = Sink(), Sink()
+        kept = await asyncio.gather(
+            server.keep_blob(first, 'a.txt', digest, len(data), write_blob, data),
+            server.keep_blob(second, 'a.txt', digest, len(data), write_blob, data)
+        )
+        assert kept == [False, True] and len(writes) == 2
+        assert first.frames and not second.frames
+        assert server.blobs.read(digest) == data and server.blobs.refs == {digest: 1}
+        assert not server.blob_writes
+    asyncio.run(main())
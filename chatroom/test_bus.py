@@ -0,0 +1,43 @@
+from bus import BusClient, BusHub
+from conftest import until
+from message import Message
+import asyncio
+
+class Worker:
+    """ A bus client that keeps what the hub hands it. """
+
+    def __init__(self, worker: int):
+        self.published, self.members, self.released = [], [], []
+        self.client = BusClient(worker, self.on_publish, self.members.append, self.released.append)
+
+    async def on_publish(self, message: Message):
+        self.published.append(message.content)
+
+def test_workers_apply_publishes_in_one_order_and_share_usernames(tmp_path):
+    async def main():
+        hub = BusHub(str(tmp_path / 'bus'), capacity=2)
+        await hub.start()
+        first, second = Worker(1), Worker(2)
+        for worker in (first, second):
+            await worker.client.connect(hub.path)
+        await hub.wait_for(2)
+        assert await first.client.claim('alice') == ''
+        assert await second.client.claim('alice') == 'username_taken'
+        assert await second.client.claim('bob') == ''
+        assert await first.client.claim('carol') == 'capacity'
+
+        await asyncio.gather(*(worker.client.publish(Message(content=f'{worker.client.worker}:{i}'))
+                               for i in range(20) for worker in (first, second)))
+        await until(lambda: len(first.published) == len(second.published) == 40)
+        assert first.published == second.published
+
+        second.client.member(Message(username='bob', room='dev', room_join=True))
+        await until(lambda: first.members)
+        assert first.members[0].room == 'dev' and not second.members
+
+        await second.client.close()
+        await until(lambda: first.released == ['bob'])
+        assert await first.client.claim('bob') == ''
+        await first.client.close()
+        await hub.close()
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+from capture import read_capture
+from conftest import running_server, join, until
+from message import Message
+from protocol import ServerEngine
+import asyncio
+import pytest
+
+@pytest.mark.parametrize('engine', list(ServerEngine))
+def test_each_frame_is_one_record(engine, tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    first, second = Message(username='eve', content='one').serialize(), Message(username='eve', content='two').serialize()
+
+    async def main():
+        async with running_server(engine=engine, capture_path=path, stream_limit=1024) as (server, port):
+            reader, writer = await join(port, 'eve')
+            writer.write(first + Message(username='eve', content='x' * 2000).serialize() + second[:10])
+            await writer.drain()
+            await asyncio.sleep(0.05)
+            writer.write(second[10:])
+            await until(lambda: server.recorder.records == 3)
+            writer.close()
+            await until(lambda: not server.users)
+    asyncio.run(main())
+    records = [data for _, _, data in read_capture(path) if data]
+    assert len(records) == 3 and Message.deserialize(records[0]).is_join_request
+    assert records[1:] == [first, second]
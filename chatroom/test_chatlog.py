@@ -0,0 +1,55 @@
+from chatlog import ChatLog
+from concurrent.futures import ThreadPoolExecutor
+import chatlog
+import os
+import threading
+
+def fill(directory: str, count: int, **options) -> ChatLog:
+    log = ChatLog(directory, **options)
+    for sequence in range(1, count + 1):
+        log.append(sequence, f'frame {sequence}\n'.encode())
+    return log
+
+def test_recovery_serves_what_was_appended(tmp_path):
+    fill(str(tmp_path), 50, segment_bytes=200, index_interval=64).close()
+    log = ChatLog(str(tmp_path), segment_bytes=200, index_interval=64)
+    assert len(log.segments) > 1 and (log.first_sequence, log.last_sequence) == (1, 50)
+    assert [bytes(data) for data in log.read(20, 3)] == [b'frame 20\n', b'frame 21\n', b'frame 22\n']
+    assert [bytes(data) for data in log.tail(2)] == [b'frame 49\n', b'frame 50\n']
+    log.append(51, b'frame 51\n')
+    assert [bytes(data) for data in log.tail(1)] == [b'frame 51\n']
+    log.close()
+
+def test_recovery_cuts_off_a_torn_tail(tmp_path):
+    fill(str(tmp_path), 10).close()
+    path = os.path.join(str(tmp_path), f'{1:020d}.log')
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    log = ChatLog(str(tmp_path), read_only=True)
+    assert log.last_sequence == 9 and os.path.getsize(path) > log.segments[-1].size
+    log = ChatLog(str(tmp_path))
+    assert log.last_sequence == 9 and os.path.getsize(path) == log.segments[-1].size
+    log.append(10, b'frame 10 again\n')
+    log.close()
+    assert [bytes(data) for data in ChatLog(str(tmp_path)).tail(2)] == [b'frame 9\n', b'frame 10 again\n']
+
+def test_recovery_stops_at_a_corrupt_record(tmp_path):
+    fill(str(tmp_path), 10).close()
+    path = os.path.join(str(tmp_path), f'{1:020d}.log')
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) - 2)
+        f.write(b'?')
+    assert ChatLog(str(tmp_path)).last_sequence == 9
+
+def test_batches_are_fsynced_in_the_executor(tmp_path, monkeypatch):
+    fsync, threads = os.fsync, []
+
+    def record(fd):
+        threads.append(threading.current_thread().name)
+        fsync(fd)
+    monkeypatch.setattr(chatlog.os, 'fsync', record)
+    with ThreadPoolExecutor(1, thread_name_prefix='Sync') as executor:
+        log = fill(str(tmp_path), 10, fsync_batch=5, executor=executor)
+    assert len(threads) == 2 and all(name.startswith('Sync') for name in threads)
+    log.close()
+    assert [bytes(data) for data in ChatLog(str(tmp_path)).tail(1)] == [b'frame 10\n']
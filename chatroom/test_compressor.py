@@ -0,0 +1,28 @@
+from compressor import Codec, Compression, Envelope, Inflater, available, negotiate, seal
+from message import Message
+import pytest
+
+@pytest.mark.parametrize('codec', available())
+def test_sealed_and_streamed_frames_inflate_back(codec):
+    frames = [Message(username='eve', content=f'hello, everyone, this is message {i}').serialize() for i in range(20)]
+    compression = Compression(codec, threshold=256, stream=True)
+    sent = [seal(codec, frames[0], 256), seal(codec, frames[1] * 20, 256)]
+    sent += [bytes(data) for data in compression.pack([memoryview(frame) for frame in frames[2:]])]
+    assert sent[0][0] == Envelope.RAW and len(sent[1]) < len(frames[1] * 20) and len(sent) == 3
+    inflater = Inflater()
+    wire = b''.join(sent)
+    plain = inflater.feed(wire[:7]) + inflater.feed(wire[7:])
+    assert plain == frames[0] + frames[1] * 20 + b''.join(frames[2:])
+
+def test_an_unenveloped_stream_passes_through():
+    frame = Message(username='eve', content='hi').serialize()
+    assert Inflater().feed(frame) == frame
+
+def test_a_bad_envelope_is_a_value_error():
+    with pytest.raises(ValueError):
+        Inflater().feed(bytes([Envelope.ZLIB, 0, 0, 0, 3]) + b'bad')
+
+def test_negotiate_picks_the_first_offered_codec_that_is_allowed():
+    assert negotiate('lz4, zlib', [Codec.ZLIB, Codec.ZSTD]) is Codec.ZLIB
+    assert negotiate('zlib', [Codec.ZSTD]) is None
+    assert negotiate(None, list(Codec)) is None
@@ -0,0 +1,136 @@
+from connection import Connection, SlowConsumerPolicy
+from frame import Frame
+from message import Message
+import asyncio
+
+class StalledWriter:
+    """ A writer whose peer reads nothing, so whatever is queued stays queued. """
+
+    class Transport:
+        aborted = False
+
+        def abort(self):
+            self.aborted = True
+
+    def __init__(self):
+        self.transport = self.Transport()
+
+class RecordingWriter:
+    """ A writer whose peer takes everything at once, keeping each write as the list of frames it carried. """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append([bytes(data)])
+
+    def writelines(self, data):
+        self.writes.append([bytes(item) for item in data])
+
+    async def drain(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+def frame(content: str) -> Frame:
+    return Frame.from_message(Message(username='eve', content=content))
+
+def queued(connection: Connection) -> list:
+    return [Message.deserialize(bytes(data)).content for data in connection.queue._queue]
+
+def test_drop_oldest_evicts_the_oldest_frame():
+    async def main():
+        connection = Connection(None, StalledWriter(), 'test', 0, max_queue=2)
+        for content in ('one', 'two', 'three'):
+            await connection.send(frame(content))
+        assert queued(connection) == ['two', 'three']
+        assert connection.dropped == 1
+    asyncio.run(main())
+
+def test_drop_oldest_evicts_the_oldest_droppable_frame():
+    async def main():
+        connection = Connection(None, StalledWriter(), 'test', 0, max_queue=3)
+        await connection.send(frame('chunk'), droppable=False)
+        await connection.send(frame('one'))
+        await connection.send(frame('two'))
+        await connection.send(frame('three'))
+        assert queued(connection) == ['chunk', 'two', 'three']
+        assert connection.dropped == 1
+    asyncio.run(main())
+
+def test_drop_oldest_drops_the_new_frame_when_nothing_queued_can_go():
+    async def main():
+        connection = Connection(None, StalledWriter(), 'test', 0, max_queue=2)
+        await connection.send(frame('chunk 0'), droppable=False)
+        await connection.send(frame('chunk 1'), droppable=False)
+        await connection.send(frame('chat'))
+        assert queued(connection) == ['chunk 0', 'chunk 1']
+        assert connection.dropped == 1
+        assert connection.queued_bytes == sum(map(len, connection.queue._queue))
+    asyncio.run(main())
+
+def test_drop_oldest_evicts_a_droppable_frame_for_one_that_must_arrive():
+    async def main():
+        connection = Connection(None, StalledWriter(), 'test', 0, max_queue=2)
+        await connection.send(frame('chunk 0'), droppable=False)
+        await connection.send(frame('chat'))
+        await connection.send(frame('chunk 1'), droppable=False)
+        assert queued(connection) == ['chunk 0', 'chunk 1']
+        assert connection.dropped == 1
+    asyncio.run(main())
+
+def test_drop_oldest_disconnects_when_a_frame_that_must_arrive_finds_no_room():
+    async def main():
+        writer = StalledWriter()
+        connection = Connection(None, writer, 'test', 0, max_queue=1)
+        await connection.send(frame('chunk 0'), droppable=False)
+        await asyncio.wait_for(connection.send(frame('chunk 1'), droppable=False), 1)
+        assert writer.transport.aborted and connection.is_closing
+        assert connection.queue.empty()
+    asyncio.run(main())
+
+def test_block_waits_for_room():
+    async def main():
+        connection = Connection(None, StalledWriter(), 'test', 0, max_queue=1, policy=SlowConsumerPolicy.BLOCK)
+        await connection.send(frame('one'))
+        waiting = asyncio.create_task(connection.send(frame('two')))
+        await asyncio.sleep(0.01)
+        assert not waiting.done() and connection.dropped == 0
+        waiting.cancel()
+    asyncio.run(main())
+
+def test_disconnect_aborts_a_full_connection():
+    async def main():
+        writer = StalledWriter()
+        connection = Connection(None, writer, 'test', 0, max_queue=1, policy=SlowConsumerPolicy.DISCONNECT)
+        await connection.send(frame('one'))
+        await connection.send(frame('two'))
+        assert writer.transport.aborted and connection.is_closing
+        assert connection.queue.empty()
+    asyncio.run(main())
+
+def test_coalescing_writes_a_burst_at_once():
+    async def main():
+        writer = RecordingWriter()
+        connection = Connection(None, writer, 'test', 0, coalesce_delay=0.2)
+        connection.start()
+        for content in ('one', 'two', 'three'):
+            await connection.send(frame(content))
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(connection.queue.join(), 1)
+        assert [len(frames) for frames in writer.writes] == [3]
+        connection.writer_task.cancel()
+    asyncio.run(main())
+
+def test_coalescing_writes_once_coalesce_bytes_are_queued():
+    async def main():
+        writer = RecordingWriter()
+        connection = Connection(None, writer, 'test', 0, coalesce_delay=10.0, coalesce_bytes=100)
+        connection.start()
+        for content in ('x' * 60, 'y' * 60):
+            await connection.send(frame(content))
+        await asyncio.wait_for(connection.queue.join(), 1)
+        assert [len(frames) for frames in writer.writes] == [2]
+        connection.writer_task.cancel()
+    asyncio.run(main())
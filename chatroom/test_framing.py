@@ -0,0 +1,66 @@
+from framing import HEADER, Framing, FrameTooLarge, PayloadKind, decode_frame, encode, read_frame, scan_frames
+from message import Message
+import asyncio
+import pytest
+
+def header_announcing(size: int) -> bytes:
+    return HEADER.pack(PayloadKind.BYTES, 0, -1, 0, 0, 0, 0, size, 0, 0)
+
+def reader_of(data: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader(limit=64)
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+def test_read_frame_skips_an_oversized_binary_frame():
+    async def main():
+        reader = reader_of(header_announcing(2000) + bytes(2000) + encode(Message(content='next'), Framing.BINARY))
+        with pytest.raises(FrameTooLarge):
+            await read_frame(reader, Framing.BINARY, max_frame_bytes=1024)
+        _, data = await read_frame(reader, Framing.BINARY, max_frame_bytes=1024)
+        assert data.endswith(b'next')
+    asyncio.run(main())
+
+def test_read_frame_ends_at_the_stream_end_while_skipping():
+    async def main():
+        assert await read_frame(reader_of(header_announcing(2 ** 62) + bytes(10)), Framing.BINARY, max_frame_bytes=1024) is None
+    asyncio.run(main())
+
+def test_scan_binary_stops_at_an_oversized_frame():
+    buffer = bytearray(encode(Message(content='hi'), Framing.BINARY) + header_announcing(2 ** 62))
+    messages, used = scan_frames(buffer, Framing.BINARY, 1024)
+    assert [message and message.content for message in messages] == ['hi', None] and used == len(buffer)
+
+def test_scan_binary_skips_oversized_frames_when_asked():
+    frames = header_announcing(2000) + bytes(2000) + encode(Message(content='next'), Framing.BINARY)
+    messages, used = scan_frames(bytearray(frames), Framing.BINARY, 1024, skip_oversized=True)
+    assert isinstance(messages[0], FrameTooLarge) and messages[0].complete
+    assert messages[1].content == 'next' and used == len(frames)
+    messages, used = scan_frames(bytearray(header_announcing(2000) + bytes(500)), Framing.BINARY, 1024, skip_oversized=True)
+    assert isinstance(messages[0], FrameTooLarge) and not messages[0].complete and messages[0].remaining == 1500
+
+@pytest.mark.parametrize('framing', list(Framing))
+def test_scan_leaves_big_frames_undecoded_when_asked(framing):
+    frames = b''.join(encode(Message(content=content), framing) for content in ('a', 'x' * 2000, 'b'))
+    messages, used = scan_frames(bytearray(frames), framing, 4096, True, defer_bytes=1024)
+    assert used == len(frames) and messages[0].content == 'a' and messages[2].content == 'b'
+    assert isinstance(messages[1], tuple) and decode_frame(*messages[1]).content == 'x' * 2000
+
+def test_read_frame_skips_an_oversized_json_frame():
+    async def main():
+        reader = reader_of(b'{"content": "' + b'x' * 200 + b'"}\n{"content": "next"}\n')
+        with pytest.raises(FrameTooLarge):
+            await read_frame(reader)
+        _, data = await read_frame(reader)
+        assert Message.deserialize(data).content == 'next'
+    asyncio.run(main())
+
+def test_scan_json_skips_oversized_frames_when_asked():
+    frames = Message(content='x' * 2000).serialize() + Message(content='next').serialize()
+    messages, _ = scan_frames(bytearray(frames), Framing.JSON, 1024)
+    assert messages == [None]
+    messages, used = scan_frames(bytearray(frames), Framing.JSON, 1024, skip_oversized=True)
+    assert isinstance(messages[0], FrameTooLarge) and messages[0].complete
+    assert messages[1].content == 'next' and used == len(frames)
+    messages, _ = scan_frames(bytearray(b'{"content": "' + b'x' * 2000), Framing.JSON, 1024, skip_oversized=True)
+    assert isinstance(messages[0], FrameTooLarge) and not messages[0].complete
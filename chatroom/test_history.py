@@ -0,0 +1,55 @@
+from history import ENTRY_OVERHEAD, ChatHistory, DirectHistory
+from message import Message
+
+def filled(count: int, **options) -> ChatHistory:
+    history = ChatHistory(**options)
+    for i in range(count):
+        history.append(Message(username='eve', content=str(i), time_ns=(i + 1) * 1_000_000_000))
+    return history
+
+def contents(entries) -> list:
+    return [entry.message.content for entry in entries]
+
+def test_the_oldest_entries_are_evicted_past_max_messages():
+    history = filled(10, max_messages=4)
+    assert len(history) == 4 and (history.first_sequence, history.last_sequence) == (7, 10)
+    assert contents(history) == ['6', '7', '8', '9']
+    assert history.get(6) is None and history.get(7).message.content == '6'
+
+def test_the_oldest_entries_are_evicted_past_max_bytes():
+    history = filled(10, max_bytes=3 * (ENTRY_OVERHEAD + 1))
+    assert contents(history) == ['7', '8', '9'] and history.size_bytes == 3 * (ENTRY_OVERHEAD + 1)
+
+def test_select_after_a_cursor_keeps_the_newest():
+    history = filled(10, max_messages=8)
+    assert contents(history.select(cursor=7)) == ['7', '8', '9']
+    assert contents(history.select(limit=2, cursor=3)) == ['8', '9']
+    assert contents(history.select(cursor=0)) == contents(history)
+    assert history.select(cursor=10) == []
+
+def test_select_since_an_epoch():
+    history = filled(10)
+    assert contents(history.select(since_epoch=8)) == ['7', '8', '9']
+    assert contents(history.select(limit=1, since_epoch=2)) == ['9']
+
+def test_clear_keeps_counting_sequences():
+    history = filled(3)
+    history.clear()
+    assert len(history) == 0 and history.append(Message(content='next')) == 4
+
+def test_direct_history_replays_only_a_users_own_messages():
+    direct = DirectHistory(per_user=2)
+    for i, keys in enumerate((['alice', 'bob'], ['alice', 'carol'], ['bob', 'carol'], ['alice', 'bob'])):
+        direct.append(Message(username=keys[0], content=str(i), recipients=keys[1:]), keys)
+    assert contents(direct.select('alice')) == ['1', '3']
+    assert contents(direct.select('bob', cursor=3)) == ['3']
+    direct.forget('bob')
+    assert direct.select('bob') == []
+
+def test_append_keeps_receive_times_increasing():
+    history = ChatHistory()
+    same = [Message(content=str(i), time_ns=5_000_000_000) for i in range(3)]
+    assert [history.append(message) for message in same] == [1, 2, 3]
+    assert [message.time_ns for message in same] == [5_000_000_000, 5_000_000_001, 5_000_000_002]
+    assert history.append(Message(content='late', time_ns=1)) == 4 and history.get(4).received == 5_000_000_003
+    assert history.get(4).message.epoch == 5
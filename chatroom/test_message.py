@@ -0,0 +1,57 @@
+from framing import HEADER, PayloadKind, decode_binary, encode_binary
+from message import Message
+import json
+import pytest
+
+@pytest.mark.parametrize('frame', [
+    b'[]\n',
+    b'5\n',
+    b'{"username": 5}\n',
+    b'{"content": {"text": "hi"}}\n',
+    b'{"room": 5}\n',
+    b'{"recipients": "bob"}\n',
+    b'{"epoch": [1]}\n',
+    b'{"user_count": "many"}\n',
+])
+def test_deserialize_rejects_bad_types(frame):
+    with pytest.raises(ValueError):
+        Message.deserialize(frame)
+
+def test_deserialize_keeps_null_fields_unset():
+    message = Message.deserialize(b'{"username": null, "room": null}\n')
+    assert message.username is None and message.room is None
+
+def test_decode_binary_rejects_bad_extensions():
+    for extensions in (b'[]', b'{"room": 5}'):
+        header = HEADER.pack(PayloadKind.NONE, 0, -1, 0, 0, len(extensions), 0, 0, 0, 0)
+        with pytest.raises(ValueError):
+            decode_binary(HEADER.unpack(header), extensions)
+
+def test_decode_binary_ignores_fields_outside_the_extensions():
+    extensions = json.dumps({'username': 'mallory', 'room': 'dev', 'sequence': 7}).encode()
+    header = HEADER.pack(PayloadKind.NONE, 0, -1, 3, 0, len(extensions), 0, 0, 0, 0)
+    message = decode_binary(HEADER.unpack(header), b'eve' + extensions)
+    assert (message.username, message.room, message.sequence) == ('eve', 'dev', None)
+
+def test_binary_round_trip():
+    message = Message(username='eve', room='dev', content='hi', recipients=['bob'], sequence=3)
+    data = encode_binary(message)
+    decoded = decode_binary(HEADER.unpack(data[:HEADER.size]), data[HEADER.size:])
+    assert (decoded.username, decoded.room, decoded.content, decoded.recipients, decoded.sequence) == ('eve', 'dev', 'hi', ['bob'], 3)
+
+def test_only_set_flags_are_written():
+    frame = json.loads(Message(username='eve', content='hi', join_request=True).serialize())
+    assert frame['join_request'] is True
+    assert not {key for key, value in frame.items() if value is False}
+    assert Message.deserialize(Message(content='hi').serialize()).flags == 0
+
+def test_optional_fields_are_unset_until_given():
+    message = Message(content='hi')
+    assert message.room is None and message.digest is None and message.stats is None
+    assert message.extensions() == {}
+    message.digest, message.sequence = 'a' * 64, 3
+    assert message.extensions() == {'digest': 'a' * 64, 'sequence': 3}
+    message.digest = None
+    assert message.extensions() == {'sequence': 3}
+    decoded = Message.deserialize(Message(content='hi', room='dev', stats={'users': {'n': 1}}, ping=7).serialize())
+    assert (decoded.room, decoded.stats, decoded.ping, decoded.pong) == ('dev', {'users': {'n': 1}}, 7, None)
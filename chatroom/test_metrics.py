@@ -0,0 +1,43 @@
+from conftest import running_server, connect, join
+from framing import read_message
+from message import Message
+from metrics import Histogram, Metrics
+import asyncio
+import pytest
+
+def test_histogram_percentiles_fall_in_their_buckets():
+    histogram = Histogram('latency', 'Test.', bounds=(1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+    histogram.observe(10.0, times=4)
+    assert histogram.count == 8 and histogram.sum == 46.5
+    assert 1.0 <= histogram.percentile(25) <= 2.0 <= histogram.percentile(40) <= 4.0 and histogram.percentile(99) > 4.0
+
+def test_render_is_prometheus_text():
+    metrics = Metrics()
+    metrics.counter('sent', 'Frames sent.').inc(3)
+    metrics.gauge('depth', 'Queue depth.', lambda: {'a"b': 2}, label='connection')
+    with pytest.raises(ValueError):
+        metrics.counter('sent', 'Again.')
+    assert metrics.render().splitlines() == [
+        '# HELP chatroom_sent Frames sent.', '# TYPE chatroom_sent counter', 'chatroom_sent 3',
+        '# HELP chatroom_depth Queue depth.', '# TYPE chatroom_depth gauge', 'chatroom_depth{connection="a\\"b"} 2'
+    ]
+    assert metrics.snapshot() == {'sent': 3, 'depth': {'a"b': 2}}
+
+def test_metrics_are_served_over_http_and_in_the_status_response():
+    async def main():
+        async with running_server(metrics_port=0) as (server, port):
+            _, writer = await join(port, 'eve')
+            writer.write(Message(username='eve', content='hi').serialize())
+            reader, scraper = await asyncio.open_connection('127.0.0.1', server.metrics_server.sockets[0].getsockname()[1])
+            scraper.write(b'GET /metrics HTTP/1.1\r\nHost: test\r\n\r\n')
+            response = (await asyncio.wait_for(reader.read(), 5)).decode()
+            assert response.startswith('HTTP/1.1 200') and '\nchatroom_messages_received ' in response
+            reader, status = await connect(port)
+            status.write(Message(status_request=True).serialize())
+            while not (message := await asyncio.wait_for(read_message(reader), 5)).is_status_response:
+                pass
+            assert message.stats['messages_received'] >= 2
+            writer.close()
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+from pool import PoolKind, WorkerPool
+import asyncio
+import threading
+
+def test_io_runs_in_order_on_one_thread():
+    async def main():
+        pool = WorkerPool(PoolKind.THREAD, workers=2)
+        done = []
+
+        def write(i):
+            done.append((i, threading.current_thread().name))
+        await asyncio.gather(*(pool.io(write, i) for i in range(20)))
+        assert [i for i, _ in done] == list(range(20)) and len({name for _, name in done}) == 1
+        pool.shutdown()
+    asyncio.run(main())
+
+def test_submitters_wait_past_max_pending():
+    async def main():
+        pool = WorkerPool(PoolKind.THREAD, workers=1, max_pending=2)
+        release = threading.Event()
+        running = [await pool.submit(pool.cpu_executor, release.wait) for _ in range(2)]
+        waiting = asyncio.create_task(pool.cpu(sum, [1, 2]))
+        await asyncio.sleep(0.05)
+        assert not waiting.done() and pool.pending == 2
+        release.set()
+        await asyncio.gather(*running)
+        assert await asyncio.wait_for(waiting, 5) == 3 and pool.pending == 0
+        pool.shutdown()
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+from conftest import running_server
+from message import Message
+from sdk import WRITE_BATCH, ChatClient, JoinRejected, kind
+from server_address import ServerAddress
+import asyncio
+import pytest
+import threading
+
+def test_kind_names_the_handlers_a_message_goes_to():
+    assert kind(Message(join_announce=True)) == 'join_announce'
+    assert kind(Message(content='hi', recipients=['bob'])) == 'direct'
+    assert kind(Message(ping=1)) == 'ping'
+    assert kind(Message(content='hi')) == 'chat'
+
+def test_queued_sends_are_written_in_batches_and_arrive_in_order():
+    async def main():
+        async with running_server() as (server, port):
+            alice, bob = ChatClient(ServerAddress('127.0.0.1', port)), ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            await bob.join('bob')
+            received = []
+            everything = asyncio.get_running_loop().create_future()
+            @bob.on('chat')
+            def chat(message):
+                received.append(message.content)
+                if len(received) == 200:
+                    everything.set_result(None)
+            writes = []
+            writelines = alice.writer.writelines
+            alice.writer.writelines = lambda frames: (writes.append(len(frames)), writelines(frames))
+            for i in range(200):
+                alice.send_nowait(Message(username='alice', content=str(i)))
+            await asyncio.wait_for(alice.drain(), 5)
+            await asyncio.wait_for(everything, 5)
+            assert received == [str(i) for i in range(200)]
+            assert sum(writes) == 200 and len(writes) <= 200 // WRITE_BATCH + 1
+            await alice.close()
+            await bob.close()
+    asyncio.run(main())
+
+def test_send_threadsafe_queues_from_another_thread():
+    async def main():
+        async with running_server() as (server, port):
+            alice = ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            messages = aiter(alice)
+            thread = threading.Thread(target=lambda: alice.send_threadsafe(Message(username='alice', content='from a thread')).result(5))
+            thread.start()
+            while (await asyncio.wait_for(anext(messages), 5)).content != 'from a thread':
+                pass
+            thread.join()
+            await alice.close()
+    asyncio.run(main())
+
+def test_a_taken_name_raises_join_rejected():
+    async def main():
+        async with running_server() as (server, port):
+            alice, other = ChatClient(ServerAddress('127.0.0.1', port)), ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            with pytest.raises(JoinRejected) as rejected:
+                await other.join('ALICE')
+            assert rejected.value.reason == 'username_taken'
+            await alice.close()
+            await other.close()
+    asyncio.run(main())
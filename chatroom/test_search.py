@@ -0,0 +1,33 @@
+from message import Message
+from search import SearchIndex, tokenize
+
+def indexed(texts, **options) -> SearchIndex:
+    index = SearchIndex(**options)
+    for i, (author, text) in enumerate(texts):
+        index.add(Message(username=author, content=text, sequence=i + 1, time_ns=(i + 1) * 1000))
+    return index
+
+TEXTS = [('alice', 'Deploy the API'), ('bob', 'api is down'), ('alice', 'rolling back the deploy'),
+         ('carol', 'API back up'), ('bob', 'deploy again? The API looks fine')]
+
+def test_tokenize_folds_case_and_drops_repeats_and_pasted_runs():
+    assert tokenize('The API, the api! ' + 'x' * 65) == ['the', 'api']
+
+def test_search_matches_every_word_newest_first():
+    index = indexed(TEXTS)
+    assert index.search('api') == ([5, 4, 2, 1], None)
+    assert index.search('deploy API') == ([5, 1], None)
+    assert index.search('api', author='BOB') == ([5, 2], None)
+    assert index.search('api', author='dave') == ([], None)
+    assert index.search('missing') == ([], None)
+
+def test_search_pages_and_time_ranges():
+    index = indexed(TEXTS)
+    assert index.search('api', limit=2) == ([5, 4], 4)
+    assert index.search('api', limit=2, before=4) == ([2, 1], None)
+    assert index.search('api', since_ns=2000, until_ns=5000) == ([4, 2], None)
+
+def test_old_messages_fall_out_past_max_messages():
+    index = indexed(TEXTS * 2, max_messages=3)
+    assert len(index) == 3 and index.search('api') == ([10, 9], None)
+    assert index.search('rolling') == ([8], None) and index.search('down') == ([], None)
@@ -0,0 +1,327 @@
+from conftest import running_server, connect, join, until
+from compressor import Codec
+from framing import Framing, decode_frame, encode, read_message
+from message import Message
+from protocol import ServerEngine
+from sdk import ChatClient
+from server_address import ServerAddress
+import asyncio
+import errno
+import os
+import pytest
+import server_config
+
+@pytest.mark.parametrize('frame', [b'[]\n', b'{"username": "eve", "room": 5}\n', b'not json\n'])
+def test_malformed_frame_drops_the_user(frame):
+    async def main():
+        async with running_server(session_ttl=None) as (server, port):
+            _, writer = await join(port, 'eve')
+            writer.write(frame)
+            await until(lambda: not server.users and not server.connections)
+    asyncio.run(main())
+
+def test_join_without_a_username_is_rejected():
+    async def main():
+        async with running_server() as (server, port):
+            reader, writer = await connect(port)
+            writer.write(b'{"join_request": true, "username": null}\n')
+            message = await asyncio.wait_for(read_message(reader), 5)
+            assert message.is_join_reject and message.reason == 'invalid_username'
+            assert not server.users
+    asyncio.run(main())
+
+def test_chunked_transfer_is_stored_and_referenced(tmp_path):
+    async def main():
+        async with running_server(blob_directory=str(tmp_path / 'blobs')) as (server, port):
+            alice, bob = ChatClient(ServerAddress('127.0.0.1', port)), ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            await bob.join('bob')
+            messages = aiter(bob)
+            data = os.urandom(100_000)
+            (tmp_path / 'file.bin').write_bytes(data)
+            await alice.send_file(str(tmp_path / 'file.bin'))
+            while (message := await asyncio.wait_for(anext(messages), 5)).digest is None:
+                assert not message.is_transfer
+            assert message.filename == 'file.bin' and message.total_size == len(data)
+            assert await asyncio.wait_for(bob.fetch(message.digest), 5) == data
+            assert not server.uploads and not os.listdir(server.blobs.uploads)
+            await alice.close()
+            await bob.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('engine', list(ServerEngine))
+def test_oversized_frame_is_refused_without_disconnecting(engine):
+    async def main():
+        async with running_server(engine=engine, stream_limit=4096) as (server, port):
+            reader, writer = await join(port, 'eve')
+            writer.write(Message(username='eve', filename='big.txt', content='x' * 10_000).serialize())
+            writer.write(Message(username='eve', content='still here').serialize())
+            replies = []
+            while (message := await asyncio.wait_for(read_message(reader), 5)).content != 'still here':
+                replies.append(message.content)
+            assert any('Limited To 4,096 Bytes' in (reply or '') for reply in replies)
+            assert 'eve' in server.users
+    asyncio.run(main())
+
+@pytest.mark.parametrize('engine', list(ServerEngine))
+def test_oversized_binary_frame_is_refused_without_disconnecting(engine):
+    async def main():
+        async with running_server(engine=engine, max_frame_bytes=4096) as (server, port):
+            reader, writer = await connect(port)
+            writer.write(Message(join_request=True, username='eve', framing=Framing.BINARY.value).serialize())
+            assert (await asyncio.wait_for(read_message(reader), 5)).is_join_accept
+            writer.write(encode(Message(username='eve', filename='big.bin', content=bytes(10_000)), Framing.BINARY))
+            writer.write(encode(Message(username='eve', content='still here'), Framing.BINARY))
+            replies = []
+            while (message := await asyncio.wait_for(read_message(reader, Framing.BINARY), 5)).content != 'still here':
+                replies.append(message.content)
+            assert any('Limited To 4,096 Bytes' in (reply or '') for reply in replies)
+            assert 'eve' in server.users
+            writer.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('engine', list(ServerEngine))
+def test_big_frames_are_decoded_in_the_pool(engine):
+    async def main():
+        async with running_server(engine=engine, offload_bytes=1024) as (server, port):
+            cpu, decoded = server.pool.cpu, []
+
+            async def record(fn, *args):
+                decoded.append(fn)
+                return await cpu(fn, *args)
+            server.pool.cpu = record
+            reader, writer = await join(port, 'eve')
+            writer.write(Message(username='eve', content='small').serialize())
+            writer.write(Message(username='eve', content='x' * 2000).serialize())
+            while (await asyncio.wait_for(read_message(reader), 5)).content != 'x' * 2000:
+                pass
+            assert decoded.count(decode_frame) == 1
+            writer.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('spoofed', [
+    Message(username='alice', content='hi from alice'),
+    Message(username='alice', quit_request=True),
+    Message(username='alice', room='dev', room_join=True),
+    Message(username='alice', recipients=['bob'], content='hi'),
+])
+def test_a_message_naming_another_user_drops_the_sender(spoofed):
+    async def main():
+        async with running_server(session_ttl=None) as (server, port):
+            alice, alice_writer = await join(port, 'alice')
+            _, writer = await join(port, 'mallory')
+            writer.write(spoofed.serialize())
+            await until(lambda: 'mallory' not in server.users)
+            assert 'alice' in server.users and not server.rooms.get('dev')
+            while (message := await asyncio.wait_for(read_message(alice), 5)).username != 'mallory':
+                assert message.content != spoofed.content or spoofed.content is None
+            alice_writer.close()
+    asyncio.run(main())
+
+def test_a_message_is_sent_under_the_name_its_sender_joined_with():
+    async def main():
+        async with running_server() as (server, port):
+            reader, writer = await join(port, 'Alice')
+            writer.write(Message(username='ALICE', content='hello').serialize())
+            while (message := await asyncio.wait_for(read_message(reader), 5)).content != 'hello':
+                pass
+            assert message.username == 'Alice'
+    asyncio.run(main())
+
+def test_a_second_join_on_a_joined_connection_is_ignored():
+    async def main():
+        async with running_server(session_ttl=None) as (server, port):
+            reader, writer = await join(port, 'alice')
+            writer.write(Message(join_request=True, username='mallory').serialize())
+            message = await asyncio.wait_for(read_message(reader), 5)
+            assert not message.is_join_accept and 'mallory' not in server.users
+            writer.close()
+            await until(lambda: not server.users)
+            _, writer = await join(port, 'alice')
+            writer.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('logged', [False, True])
+def test_history_after_a_cursor_is_the_newest_limit_messages(logged, tmp_path):
+    async def main():
+        config = {'log_directory': str(tmp_path)} if logged else {}
+        async with running_server(**config) as (server, port):
+            reader, writer = await join(port, 'alice')
+            for i in range(30):
+                writer.write(Message(username='alice', content=str(i)).serialize())
+            while (message := await asyncio.wait_for(read_message(reader), 5)).content != '29':
+                pass
+            last = message.sequence
+            writer.write(Message(username='alice', history_request=True, cursor=5, history_limit=3).serialize())
+            sequences = []
+            while not (message := await asyncio.wait_for(read_message(reader), 5)).is_history_end:
+                sequences.append(message.sequence)
+            assert sequences == [last - 2, last - 1, last] and message.cursor == last
+            writer.close()
+    asyncio.run(main())
+
+def test_a_failed_accept_does_not_stop_the_server():
+    async def main():
+        loop = asyncio.get_running_loop()
+        accept, failures = loop.sock_accept, [OSError(errno.EMFILE, 'Too many open files')]
+
+        async def sock_accept(sock):
+            if failures:
+                raise failures.pop()
+            return await accept(sock)
+        loop.sock_accept = sock_accept
+        async with running_server() as (server, port):
+            _, writer = await join(port, 'eve')
+            assert not failures and 'eve' in server.users
+            writer.close()
+    asyncio.run(main())
+
+def test_max_connections_leaves_descriptors_for_the_server(monkeypatch):
+    monkeypatch.setattr(server_config.resource, 'getrlimit', lambda _: (256, 4096))
+    assert server_config.connection_limit(1100) == 256 - server_config.DESCRIPTOR_HEADROOM
+    monkeypatch.setattr(server_config.resource, 'getrlimit', lambda _: (65536, 65536))
+    assert server_config.connection_limit(1100) == 1100
+
+def test_a_room_message_reaches_only_its_members():
+    async def main():
+        async with running_server() as (server, port):
+            alice, alice_writer = await join(port, 'alice')
+            bob, bob_writer = await join(port, 'bob')
+            alice_writer.write(Message(username='alice', room='Dev', room_join=True).serialize())
+            while not (message := await asyncio.wait_for(read_message(alice), 5)).is_room_join or message.username != 'alice':
+                pass
+            assert server.rooms['dev'].members.keys() == {'alice'}
+            alice_writer.write(Message(username='alice', room='dev', content='in dev').serialize())
+            while (message := await asyncio.wait_for(read_message(alice), 5)).content != 'in dev':
+                pass
+            assert message.room == 'dev'
+            bob_writer.write(Message(username='bob', content='in the lobby').serialize())
+            while (message := await asyncio.wait_for(read_message(bob), 5)).content != 'in the lobby':
+                assert message.content != 'in dev'
+            alice_writer.write(Message(username='alice', room='dev', room_leave=True).serialize())
+            await until(lambda: 'dev' not in server.rooms or not server.rooms['dev'].members)
+            alice_writer.close()
+            bob_writer.close()
+    asyncio.run(main())
+
+def test_a_dropped_session_holds_its_name_and_resumes_with_what_it_missed():
+    async def main():
+        async with running_server(session_ttl=30.0) as (server, port):
+            reader, writer = await connect(port)
+            writer.write(Message(join_request=True, username='alice').serialize())
+            accept = await asyncio.wait_for(read_message(reader), 5)
+            writer.transport.abort()
+            await until(lambda: 'alice' in server.sessions)
+            _, bob = await join(port, 'bob')
+            for content in ('one', 'two'):
+                bob.write(Message(username='bob', content=content).serialize())
+            await until(lambda: server.chat_history.last_sequence == accept.cursor + 4)
+            with pytest.raises(AssertionError):
+                await join(port, 'Alice')
+            reader, writer = await connect(port)
+            writer.write(Message(join_request=True, username='alice', session=accept.session, cursor=accept.cursor).serialize())
+            accept = await asyncio.wait_for(read_message(reader), 5)
+            assert accept.is_join_accept and not accept.is_join_announce
+            missed = [line for line in accept.content.splitlines() if 'bob' in line]
+            assert len(missed) == 3 and 'one' in missed[1] and 'two' in missed[2]
+            writer.close()
+            bob.close()
+    asyncio.run(main())
+
+def test_the_client_resumes_a_dropped_connection_and_sends_what_was_queued():
+    async def main():
+        async with running_server(session_ttl=30.0) as (server, port):
+            alice, bob = ChatClient(ServerAddress('127.0.0.1', port)), ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            await bob.join('bob')
+            messages = aiter(bob)
+            resumed = asyncio.get_running_loop().create_future()
+            alice.on('reconnecting', lambda delay: resumed.done() or resumed.set_result(delay))
+            alice.writer.transport.abort()
+            await asyncio.wait_for(resumed, 5)
+            await alice.say('after the drop')
+            while (message := await asyncio.wait_for(anext(messages), 10)).content != 'after the drop':
+                assert not message.is_quit_accept
+            assert server.users['alice'].username == 'alice'
+            await alice.close()
+            await bob.close()
+    asyncio.run(main())
+
+def test_broadcasts_carry_increasing_sequences_and_receive_times():
+    async def main():
+        async with running_server() as (server, port):
+            reader, writer = await join(port, 'eve')
+            for i in range(5):
+                writer.write(Message(username='eve', content=str(i)).serialize())
+            received = []
+            while len(received) < 5:
+                if (message := await asyncio.wait_for(read_message(reader), 5)).content in set('01234'):
+                    received.append(message)
+            sequences = [message.sequence for message in received]
+            assert sequences == list(range(sequences[0], sequences[0] + 5))
+            times = [message.time_ns for message in received]
+            assert all(type(time_ns) is int for time_ns in times) and times == sorted(set(times))
+            writer.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_a_client_that_negotiates_compression_reads_the_chat(stream):
+    async def main():
+        async with running_server(compression_stream=stream, compression_threshold=64) as (server, port):
+            alice = ChatClient(ServerAddress('127.0.0.1', port), compression=[Codec.ZLIB])
+            accept = await alice.join('alice')
+            assert accept.compression == Codec.ZLIB.value and server.users['alice'].compression is not None
+            messages = aiter(alice)
+            _, writer = await join(port, 'bob')
+            for content in ('short', 'long ' * 100):
+                writer.write(Message(username='bob', content=content).serialize())
+            while (await asyncio.wait_for(anext(messages), 5)).content != 'short':
+                pass
+            assert (await asyncio.wait_for(anext(messages), 5)).content == 'long ' * 100
+            await alice.close()
+            writer.close()
+    asyncio.run(main())
+
+def test_search_pages_through_a_rooms_messages():
+    async def main():
+        async with running_server() as (server, port):
+            alice = ChatClient(ServerAddress('127.0.0.1', port))
+            await alice.join('alice')
+            for i in range(5):
+                await alice.say(f'release {i}')
+            await alice.say('something else')
+            await until(lambda: server.lobby.history.last_sequence >= 7)
+            first = await asyncio.wait_for(alice.search('release', limit=3), 5)
+            assert first.is_search_result and len(first.results) == 3 and first.cursor is not None
+            second = await asyncio.wait_for(alice.search('release', before=first.cursor, limit=3), 5)
+            assert len(second.results) == 2 and second.cursor is None
+            assert 'release 0' in second.content and 'something' not in first.content + second.content
+            await alice.close()
+    asyncio.run(main())
+
+def test_a_direct_message_reaches_only_its_sender_and_recipients():
+    async def main():
+        async with running_server() as (server, port):
+            alice, bob, carol = (ChatClient(ServerAddress('127.0.0.1', port)) for _ in range(3))
+            for client, name in ((alice, 'alice'), (bob, 'bob'), (carol, 'carol')):
+                await client.join(name)
+            direct = {name: [] for name in ('alice', 'bob', 'carol')}
+            for client, name in ((alice, 'alice'), (bob, 'bob'), (carol, 'carol')):
+                client.on('direct', lambda message, name=name: direct[name].append(message.content))
+            await alice.direct(['@Bob', 'dave'], 'just us')
+            await alice.say('everyone')
+            await until(lambda: direct['bob'] and direct['alice'])
+            await carol.say('done')
+            messages = aiter(carol)
+            while (message := await asyncio.wait_for(anext(messages), 5)).content != 'done':
+                assert message.recipients is None
+            assert direct == {'alice': ['just us'], 'bob': ['just us'], 'carol': []}
+            assert 'just us' not in server.history_for(Message())
+            await bob.direct_history()
+            messages = aiter(bob)
+            while not (message := await asyncio.wait_for(anext(messages), 5)).is_history_end:
+                pass
+            assert direct['bob'] == ['just us', 'just us']
+            for client in (alice, bob, carol):
+                await client.close()
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+from server import ChatroomServer
+from server_address import ServerAddress
+from server_config import ServerConfig
+from bus import BusHub, BusKind, pack
+from typing import List
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+
+logger = logging.getLogger('Workers')
+
+def run_worker(address: ServerAddress, config: ServerConfig, log_level: int):
+    server = ChatroomServer(address, config)
+    server.logger.setLevel(log_level)
+    server.startup()
+
+async def serve_workers(address: ServerAddress, config: ServerConfig, workers: int, log_level: int = logging.INFO):
+    """ Run `workers` server processes that all listen on `address` with SO_REUSEPORT, so the kernel
+        spreads connections across them, joined by a bus hub running in this process. """
+    directory = tempfile.mkdtemp(prefix='chatroom-')
+    hub = BusHub(os.path.join(directory, 'bus.sock'), config.capacity)
+    await hub.start()
+    loop = asyncio.get_running_loop()
+    main = asyncio.current_task()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, main.cancel)
+    context = multiprocessing.get_context('spawn')
+    processes: List[multiprocessing.Process] = []
+    try:
+        for worker in range(workers):
+            process = context.Process(
+                target=run_worker,
+                args=(address, config._replace(bus_path=hub.path, worker_id=worker, reuse_port=True), log_level),
+                name=f'ChatroomWorker-{worker}',
+                daemon=True
+            )
+            process.start()
+            processes.append(process)
+            # The first worker recovers (and may repair) the chat log before the others read it.
+            await hub.wait_for(worker + 1)
+        hub.forward(pack(BusKind.HELLO, 0, b''))
+        logger.info(f'{workers} Workers Listening on {address.host}:{address.port}')
+        while all(process.is_alive() for process in processes):
+            await asyncio.sleep(0.5)
+        logger.error('A Worker Exited. Shutting Down.')
+    except asyncio.CancelledError:
+        logger.info('Shutting Down Workers.')
+    finally:
+        # Workers drain their connections on SIGTERM; the hub stays up until they are gone.
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(config.shutdown_timeout + 5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        await hub.close()
+        os.unlink(hub.path)
+        os.rmdir(directory)